@@ -0,0 +1,28 @@
+"""
+Loss settings, random batches and timing shared by the benchmarks in this directory.
+"""
+import time
+import numpy as np
+
+loss_weights = {
+    'w_D': 0.1, 'w_recon': 1., 'w_edge': 0.1, 'w_eyes': 30., 'w_pl': (0.01, 0.1, 0.3, 0.1)
+}
+loss_config = {
+    'gan_training': "mixup_LSGAN", 'use_PL': False, 'PL_before_activ': False, 'use_mask_hinge_loss': False,
+    'm_mask': 0., 'lr_factor': 1., 'use_cyclic_loss': False
+}
+
+def random_batch(batch_size, res):
+    warped = np.random.uniform(-1, 1, (batch_size, res, res, 3)).astype(np.float32)
+    target = np.random.uniform(-1, 1, (batch_size, res, res, 3)).astype(np.float32)
+    bm_eyes = (np.random.uniform(size=(batch_size, res, res, 3)) > 0.9).astype(np.float32)
+    layout = np.random.uniform(0, 1, (batch_size, res, res, 3)).astype(np.float32)
+    return warped, target, bm_eyes, layout
+
+def time_fn(fn, inputs, num_warmup, num_steps):
+    for _ in range(num_warmup):
+        fn(inputs)
+    t0 = time.time()
+    for _ in range(num_steps):
+        fn(inputs)
+    return (time.time() - t0) / num_steps * 1000 # ms
@@ -0,0 +1,107 @@
+"""
+Compare FLOPs, parameters and step time of the standard and OctConv encoders (arch_config['encoder_type']).
+
+Each encoder runs in its own process. FLOPs are counted by the TF profiler on a standalone encoder
+with batch size 1, step times are measured on the full model.
+
+Usage:
+    python benchmarks/encoder_benchmark.py --resolution 64 --octconv_alphas 0.25 0.5 0.75
+"""
+import sys
+import json
+import argparse
+import subprocess
+from pathlib import Path
+
+REPO_DIR = Path(__file__).resolve().parents[1]
+if str(REPO_DIR) not in sys.path:
+    sys.path.insert(0, str(REPO_DIR))
+
+from benchmarks.common import loss_weights, loss_config, random_batch, time_fn
+
+def encoder_flops(arch_config):
+    import tensorflow as tf
+    from keras.layers import Input
+    import keras.backend as K
+    from networks.faceswap_gan_model import FaceswapGANModel
+
+    graph = tf.Graph()
+    with graph.as_default():
+        K.set_session(tf.Session(graph=graph))
+        encoder = FaceswapGANModel.build_encoder(nc_in=3,
+                                                 input_size=arch_config['IMAGE_SHAPE'][0],
+                                                 use_self_attn=arch_config['use_self_attn'],
+                                                 norm=arch_config['norm'],
+                                                 model_capacity=arch_config['model_capacity'],
+                                                 encoder_type=arch_config['encoder_type'],
+                                                 octconv_alpha=arch_config['octconv_alpha'])
+        encoder(Input(batch_shape=(1,) + tuple(arch_config['IMAGE_SHAPE'])))
+        opts = tf.profiler.ProfileOptionBuilder.float_operation()
+        opts['output'] = 'none'
+        flops = tf.profiler.profile(graph, options=opts).total_float_ops
+        params = encoder.count_params()
+    K.clear_session()
+    # Only the batch size 1 call has fully defined shapes, so these are the FLOPs of a single image
+    return flops, params
+
+def run_variant(encoder_type, octconv_alpha, args):
+    import keras.backend as K
+    from networks.faceswap_gan_model import FaceswapGANModel
+
+    arch_config = {
+        'IMAGE_SHAPE': (args.resolution, args.resolution, 3),
+        'use_self_attn': args.use_self_attn,
+        'norm': args.norm,
+        'model_capacity': args.model_capacity,
+        'encoder_type': encoder_type,
+        'octconv_alpha': octconv_alpha
+    }
+    result = {"encoder_type": encoder_type, "octconv_alpha": octconv_alpha}
+    result["encoder_gflops"], result["encoder_params"] = encoder_flops(arch_config)
+    result["encoder_gflops"] /= 1e9
+
+    K.set_learning_phase(1)
+    model = FaceswapGANModel(**arch_config)
+    model.build_train_functions(loss_weights=loss_weights, **loss_config)
+    warped, target, bm_eyes, layout = random_batch(args.batch_size, args.resolution)
+    result["netGA_train_ms"] = time_fn(model.netGA_train, [warped, target, bm_eyes, layout],
+                                       args.num_warmup, args.num_steps)
+    result["path_abgr_A_ms"] = time_fn(model.path_abgr_A, [warped[:1], layout[:1]],
+                                       args.num_warmup, args.num_steps)
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="Encoder cost benchmark of faceswap-GAN.")
+    parser.add_argument("--resolution", type=int, default=64)
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--norm", default="instancenorm")
+    parser.add_argument("--model_capacity", default="standard")
+    parser.add_argument("--use_self_attn", type=int, default=1)
+    parser.add_argument("--octconv_alphas", type=float, nargs="+", default=[0.25, 0.5, 0.75])
+    parser.add_argument("--num_warmup", type=int, default=5)
+    parser.add_argument("--num_steps", type=int, default=30)
+    parser.add_argument("--variant", type=str, default=None, help="internal: run a single 'encoder_type,octconv_alpha'")
+    args = parser.parse_args()
+    args.use_self_attn = bool(args.use_self_attn)
+
+    if args.variant is not None:
+        encoder_type, octconv_alpha = args.variant.split(",")
+        print (json.dumps(run_variant(encoder_type, float(octconv_alpha), args)))
+        return
+
+    variants = [("standard", 0.5)] + [("octconv", alpha) for alpha in args.octconv_alphas]
+    results = []
+    for encoder_type, alpha in variants:
+        out = subprocess.run([sys.executable, __file__, "--variant", f"{encoder_type},{alpha}"] + sys.argv[1:],
+                             stdout=subprocess.PIPE, check=True)
+        results.append(json.loads(out.stdout.decode("utf-8").strip().splitlines()[-1]))
+
+    base = results[0]
+    print (f"{'encoder':>16s}{'GFLOPs':>10s}{'params(M)':>11s}{'G step ms':>11s}{'infer ms':>10s}{'speedup':>9s}")
+    for r in results:
+        name = r["encoder_type"] if r["encoder_type"] == "standard" else f"octconv a={r['octconv_alpha']}"
+        print (f"{name:>16s}{r['encoder_gflops']:10.3f}{r['encoder_params']/1e6:11.2f}"
+               f"{r['netGA_train_ms']:11.1f}{r['path_abgr_A_ms']:10.1f}{base['netGA_train_ms']/r['netGA_train_ms']:9.2f}")
+
+if __name__ == "__main__":
+    main()
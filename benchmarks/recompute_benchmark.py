@@ -0,0 +1,82 @@
+"""
+Report peak memory and step time of generator training with and without gradient checkpointing
+(arch_config['use_recompute']) for each resolution.
+
+Each configuration runs in its own process so that peak RSS is measured independently.
+Allocator peaks are read from a fully traced netGA_train call (see profiling/timeline_profiler.peak_memory_bytes).
+
+Usage:
+    python benchmarks/recompute_benchmark.py --resolutions 64 128 256 --batch_size 4
+"""
+import sys
+import json
+import resource
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+
+REPO_DIR = Path(__file__).resolve().parents[1]
+if str(REPO_DIR) not in sys.path:
+    sys.path.insert(0, str(REPO_DIR))
+
+from benchmarks.common import loss_weights, loss_config, random_batch, time_fn
+
+def run_config(resolution, use_recompute, args):
+    import keras.backend as K
+    from networks.faceswap_gan_model import FaceswapGANModel
+    from profiling.timeline_profiler import peak_memory_bytes
+
+    K.set_learning_phase(1)
+    arch_config = {
+        'IMAGE_SHAPE': (resolution, resolution, 3),
+        'use_self_attn': args.use_self_attn,
+        'norm': args.norm,
+        'model_capacity': args.model_capacity,
+        'use_recompute': use_recompute
+    }
+    model = FaceswapGANModel(**arch_config)
+    model.build_train_functions(loss_weights=loss_weights, **loss_config)
+    inputs = list(random_batch(args.batch_size, resolution))
+
+    result = {"resolution": resolution, "use_recompute": use_recompute}
+    result["netGA_train_ms"] = time_fn(model.netGA_train, inputs, args.num_warmup, args.num_steps)
+    model.profile_next_calls(1, ["netGA_train"], log_dir=tempfile.mkdtemp())
+    model.netGA_train(inputs)
+    peaks = peak_memory_bytes(model.netGA_train.last_run_metadata)
+    result["allocator_peak_mb"] = max(peaks.values()) / 2**20 if peaks else None
+    result["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # ru_maxrss is in KB on Linux
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="Gradient checkpointing memory benchmark of faceswap-GAN.")
+    parser.add_argument("--resolutions", type=int, nargs="+", default=[64, 128, 256])
+    parser.add_argument("--batch_size", type=int, default=4)
+    parser.add_argument("--norm", default="instancenorm")
+    parser.add_argument("--model_capacity", default="standard")
+    parser.add_argument("--use_self_attn", type=int, default=1)
+    parser.add_argument("--num_warmup", type=int, default=2)
+    parser.add_argument("--num_steps", type=int, default=10)
+    parser.add_argument("--config", type=str, default=None, help="internal: run a single 'resolution,use_recompute'")
+    args = parser.parse_args()
+    args.use_self_attn = bool(args.use_self_attn)
+
+    if args.config is not None:
+        resolution, use_recompute = args.config.split(",")
+        print (json.dumps(run_config(int(resolution), bool(int(use_recompute)), args)))
+        return
+
+    print (f"{'res':>5s}{'recompute':>10s}{'step ms':>10s}{'alloc MB':>10s}{'RSS MB':>10s}")
+    for resolution in args.resolutions:
+        results = []
+        for use_recompute in [0, 1]:
+            out = subprocess.run([sys.executable, __file__, "--config", f"{resolution},{use_recompute}"] + sys.argv[1:],
+                                 stdout=subprocess.PIPE, check=True)
+            results.append(json.loads(out.stdout.decode("utf-8").strip().splitlines()[-1]))
+        for r in results:
+            alloc = f"{r['allocator_peak_mb']:10.1f}" if r['allocator_peak_mb'] is not None else f"{'n/a':>10s}"
+            print (f"{r['resolution']:5d}{str(r['use_recompute']):>10s}{r['netGA_train_ms']:10.1f}{alloc}{r['peak_rss_mb']:10.1f}")
+        print (f"{resolution:5d}{'saved':>10s}{'':10s}{'':10s}{results[0]['peak_rss_mb'] - results[1]['peak_rss_mb']:10.1f}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Compare step time and peak memory of FaceswapGANModel with and without XLA JIT (arch_config['use_xla_jit']).
+
+Each variant runs in its own process so that peak RSS is measured independently.
+
+Usage:
+    python benchmarks/xla_benchmark.py --resolution 64 --batch_size 8 --num_steps 50
+"""
+import sys
+import json
+import time
+import resource
+import argparse
+import subprocess
+from pathlib import Path
+
+REPO_DIR = Path(__file__).resolve().parents[1]
+if str(REPO_DIR) not in sys.path:
+    sys.path.insert(0, str(REPO_DIR))
+
+from benchmarks.common import loss_weights, loss_config, random_batch, time_fn
+
+def run_variant(use_xla_jit, args):
+    import keras.backend as K
+    from networks.faceswap_gan_model import FaceswapGANModel
+
+    K.set_learning_phase(1)
+    arch_config = {
+        'IMAGE_SHAPE': (args.resolution, args.resolution, 3),
+        'use_self_attn': args.use_self_attn,
+        'norm': args.norm,
+        'model_capacity': args.model_capacity,
+        'use_xla_jit': use_xla_jit
+    }
+    t0 = time.time()
+    model = FaceswapGANModel(**arch_config)
+    model.build_train_functions(loss_weights=loss_weights, **loss_config)
+    build_time = time.time() - t0
+
+    warped, target, bm_eyes, layout = random_batch(args.batch_size, args.resolution)
+    result = {"use_xla_jit": use_xla_jit, "build_time_s": build_time}
+    # The first call includes XLA compilation
+    t0 = time.time()
+    model.netGA_train([warped, target, bm_eyes, layout])
+    result["first_step_s"] = time.time() - t0
+    result["netGA_train_ms"] = time_fn(model.netGA_train, [warped, target, bm_eyes, layout],
+                                       args.num_warmup, args.num_steps)
+    result["netDA_train_ms"] = time_fn(model.netDA_train, [warped, target, layout],
+                                       args.num_warmup, args.num_steps)
+    result["path_abgr_A_ms"] = time_fn(model.path_abgr_A, [warped[:1], layout[:1]],
+                                       args.num_warmup, args.num_steps)
+    result["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 # ru_maxrss is in KB on Linux
+    return result
+
+def main():
+    parser = argparse.ArgumentParser(description="XLA JIT benchmark of faceswap-GAN train and inference functions.")
+    parser.add_argument("--resolution", type=int, default=64)
+    parser.add_argument("--batch_size", type=int, default=8)
+    parser.add_argument("--norm", default="instancenorm")
+    parser.add_argument("--model_capacity", default="standard")
+    parser.add_argument("--use_self_attn", type=int, default=1)
+    parser.add_argument("--num_warmup", type=int, default=5)
+    parser.add_argument("--num_steps", type=int, default=50)
+    parser.add_argument("--variant", type=int, default=None, help="internal: run a single variant (0/1)")
+    args = parser.parse_args()
+    args.use_self_attn = bool(args.use_self_attn)
+
+    if args.variant is not None:
+        print (json.dumps(run_variant(bool(args.variant), args)))
+        return
+
+    results = []
+    for variant in [0, 1]:
+        out = subprocess.run([sys.executable, __file__, "--variant", str(variant)] + sys.argv[1:],
+                             stdout=subprocess.PIPE, check=True)
+        results.append(json.loads(out.stdout.decode("utf-8").strip().splitlines()[-1]))
+
+    keys = ["build_time_s", "first_step_s", "netGA_train_ms", "netDA_train_ms", "path_abgr_A_ms", "peak_rss_mb"]
+    print (f"{'':16s}{'no JIT':>12s}{'XLA JIT':>12s}{'ratio':>8s}")
+    for k in keys:
+        base, jit = results[0][k], results[1][k]
+        print (f"{k:16s}{base:12.2f}{jit:12.2f}{jit/base:8.2f}")
+
+if __name__ == "__main__":
+    main()
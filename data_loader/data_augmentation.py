@@ -3,6 +3,7 @@ import cv2
 from umeyama import umeyama
 from scipy import ndimage
 from pathlib import PurePath, Path
+from .image_cache import imread
 
 random_transform_args = {
     'rotation_range': 10,
@@ -71,7 +72,7 @@ def random_warp_rev(image, res=64):
 def random_color_match(image, fns_all_trn_data):
     rand_idx = np.random.randint(len(fns_all_trn_data))    
     fn_match = fns_all_trn_data[rand_idx]
-    tar_img = cv2.imread(fn_match)
+    tar_img = imread(fn_match)
     if tar_img is None:
         print(f"Failed reading image {fn_match} in random_color_match().")
         return image
@@ -109,8 +110,26 @@ def random_color_match(image, fns_all_trn_data):
         result = cv2.cvtColor(result.astype(np.uint8), cv2.COLOR_XYZ2BGR)
     return result
 
+def get_target_pyramid_sizes(res=64):
+    # Sizes of the intermediate decoder outputs, see FaceswapGANModel.build_decoder()
+    sizes = []
+    size = 64
+    while size < res:
+        sizes.append(size)
+        size *= 2
+    return sizes
+
+def build_target_pyramid(target_img, bm_eyes, res=64):
+    # Area downsampling of the target image for every intermediate decoder output,
+    # plus the eye mask at the size of the first order (edge) maps, i.e. (res-1, res-1).
+    res = int(res)
+    pyramid = [cv2.resize(target_img, (sz, sz), interpolation=cv2.INTER_AREA) 
+               for sz in get_target_pyramid_sizes(res)]
+    bm_eyes_edge = cv2.resize(bm_eyes, (res-1, res-1), interpolation=cv2.INTER_AREA)
+    return pyramid + [bm_eyes_edge]
+
 def read_image(fn, fns_all_trn_data, dir_bm_eyes=None, dir_layout=None, res=64, prob_random_color_match=0.5, 
-               use_da_motion_blur=True, use_bm_eyes=True, use_layout=True,
+               use_da_motion_blur=True, use_bm_eyes=True, use_layout=True, use_target_pyramid=False,
                random_transform_args=random_transform_args):
     if dir_bm_eyes is None:
         raise ValueError(f"dir_bm_eyes is not set.")
@@ -124,7 +143,7 @@ def read_image(fn, fns_all_trn_data, dir_bm_eyes=None, dir_layout=None, res=64,
         fns_all_trn_data = [fn_all.decode("utf-8") for fn_all in fns_all_trn_data]
     
     raw_fn = PurePath(fn).parts[-1]
-    image = cv2.imread(fn)
+    image = imread(fn)
     if image is None:
         print(f"Failed reading image {fn}.")
         raise IOError(f"Failed reading image {fn}.")        
@@ -133,7 +152,7 @@ def read_image(fn, fns_all_trn_data, dir_bm_eyes=None, dir_layout=None, res=64,
     image = cv2.resize(image, (256,256)) / 255 * 2 - 1
     
     if use_bm_eyes:
-        bm_eyes = cv2.imread(f"{dir_bm_eyes}/{raw_fn}")
+        bm_eyes = imread(f"{dir_bm_eyes}/{raw_fn}")
         if bm_eyes is None:
             print(f"Failed reading binary mask {dir_bm_eyes}/{raw_fn}. \
             If this message keeps showing, please check for existence of binary masks folder \
@@ -145,7 +164,7 @@ def read_image(fn, fns_all_trn_data, dir_bm_eyes=None, dir_layout=None, res=64,
         bm_eyes = np.zeros_like(image)
 
     if use_layout:
-        layout = cv2.imread(f"{dir_layout}/{raw_fn}")
+        layout = imread(f"{dir_layout}/{raw_fn}")
         if layout is None:
             print(f"Failed reading binary mask {dir_layout}/{raw_fn}. \
             If this message keeps showing, please check for existence of binary masks folder \
@@ -173,4 +192,6 @@ def read_image(fn, fns_all_trn_data, dir_bm_eyes=None, dir_layout=None, res=64,
     warped_img, target_img, bm_eyes, layout = \
     warped_img.astype(np.float32), target_img.astype(np.float32), bm_eyes.astype(np.float32), layout.astype(np.float32)
     
+    if use_target_pyramid:
+        return (warped_img, target_img, bm_eyes, layout, *build_target_pyramid(target_img, bm_eyes, res))
     return warped_img, target_img, bm_eyes, layout
\ No newline at end of file
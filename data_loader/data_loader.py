@@ -4,7 +4,7 @@ from .data_augmentation import *
 
 class DataLoader(object):
     def __init__(self, filenames, all_filenames, batch_size, dir_bm_eyes, 
-                 dir_layout, resolution, num_cpus, sess, **da_config):
+                 dir_layout, resolution, num_cpus, sess, use_target_pyramid=False, **da_config):
         self.filenames = filenames
         self.all_filenames = all_filenames
         self.batch_size = batch_size
@@ -13,6 +13,9 @@ class DataLoader(object):
         self.resolution = resolution
         self.num_cpus = num_cpus
         self.sess = sess
+        # If True, each batch additionally contains the target image at every intermediate
+        # decoder output size and the eye mask resized for edge loss (see build_target_pyramid).
+        self.use_target_pyramid = use_target_pyramid
         
         self.set_data_augm_config(
             da_config["prob_random_color_match"], 
@@ -30,7 +33,8 @@ class DataLoader(object):
             self.prob_random_color_match,
             self.use_da_motion_blur,
             self.use_bm_eyes,
-            self.use_layout
+            self.use_layout,
+            self.use_target_pyramid
         )
         
     def set_data_augm_config(self, prob_random_color_match=0.5, 
@@ -41,7 +45,11 @@ class DataLoader(object):
         self.use_layout = use_layout
         
     def create_tfdata_iter(self, filenames, fns_all_trn_data, batch_size, dir_bm_eyes, dir_layout, resolution, 
-                           prob_random_color_match, use_da_motion_blur, use_bm_eyes, use_layout):
+                           prob_random_color_match, use_da_motion_blur, use_bm_eyes, use_layout, 
+                           use_target_pyramid=False):
+        num_outputs = 4
+        if use_target_pyramid:
+            num_outputs += len(get_target_pyramid_sizes(resolution)) + 1
         tf_fns = tf.constant(filenames, dtype=tf.string) # use tf_fns=filenames is also fine
         dataset = tf.data.Dataset.from_tensor_slices(tf_fns) 
         dataset = dataset.shuffle(len(filenames))
@@ -57,8 +65,9 @@ class DataLoader(object):
                          prob_random_color_match, 
                          use_da_motion_blur, 
                          use_bm_eyes,
-                         use_layout], 
-                    Tout=[tf.float32, tf.float32, tf.float32, tf.float32]
+                         use_layout,
+                         use_target_pyramid], 
+                    Tout=[tf.float32] * num_outputs
                 ), 
                 batch_size=batch_size,
                 num_parallel_batches=self.num_cpus, # cpu cores
@@ -0,0 +1,76 @@
+import numpy as np
+import cv2
+import json
+from pathlib import Path
+
+CACHE_SIZE = 256 # read_image() resizes every input to 256x256
+
+def cache_filenames(filenames, dir_bm_eyes=None, dir_layout=None):
+    """
+    Paths read by read_image() for the given face images, i.e. the images plus their eye masks and layouts.
+    """
+    fns = list(filenames)
+    for fn in filenames:
+        raw_fn = Path(fn).name
+        if dir_bm_eyes is not None:
+            fns.append(f"{dir_bm_eyes}/{raw_fn}")
+        if dir_layout is not None:
+            fns.append(f"{dir_layout}/{raw_fn}")
+    return fns
+
+def build_image_cache(filenames, cache_dir):
+    """
+    Decode images once into a single uint8 array (cache_dir/images.npy) with an index from path to row.
+    Files that fail to decode are not cached and keep going through cv2.imread().
+    """
+    Path(cache_dir).mkdir(parents=True, exist_ok=True)
+    filenames = list(dict.fromkeys(filenames))
+    index = {}
+    data = np.lib.format.open_memmap(f"{cache_dir}/images.npy", mode="w+", dtype=np.uint8,
+                                     shape=(len(filenames), CACHE_SIZE, CACHE_SIZE, 3))
+    for fn in filenames:
+        image = cv2.imread(fn)
+        if image is None:
+            continue
+        data[len(index)] = cv2.resize(image, (CACHE_SIZE, CACHE_SIZE))
+        index[fn] = len(index)
+    data.flush()
+    del data
+    with open(f"{cache_dir}/index.json", "w") as f:
+        json.dump(index, f)
+    print (f"Cached {len(index)}/{len(filenames)} images in {cache_dir}.")
+    return cache_dir
+
+class ImageCache():
+    """
+    Read-only, memory-mapped view on a cache written by build_image_cache().
+    Processes mapping the same cache share its pages through the OS page cache.
+    """
+    def __init__(self, cache_dir):
+        if not Path(f"{cache_dir}/index.json").exists():
+            raise IOError(f"No image cache found in {cache_dir}.")
+        with open(f"{cache_dir}/index.json", "r") as f:
+            self.index = json.load(f)
+        self.data = np.load(f"{cache_dir}/images.npy", mmap_mode="r")
+
+    def get(self, fn):
+        idx = self.index.get(fn)
+        if idx is None:
+            return None
+        return np.array(self.data[idx])
+
+_image_cache = None
+
+def set_image_cache(cache_dir):
+    """
+    Make imread() (and thus read_image()) serve images from cache_dir. Pass None to disable.
+    """
+    global _image_cache
+    _image_cache = None if cache_dir is None else ImageCache(cache_dir)
+
+def imread(fn):
+    if _image_cache is not None:
+        image = _image_cache.get(fn)
+        if image is not None:
+            return image
+    return cv2.imread(fn)
@@ -1,6 +1,6 @@
 import mtcnn_detect_face
+from profiling.timeline_profiler import TimelineProfiler
 import tensorflow as tf
-from keras import backend as K
 import numpy as np
 import cv2
 import os
@@ -11,11 +11,13 @@ class MTCNNFaceDetector():
     
     Attributes:
         model_path: path to the MTCNN weights files
+        profiler: TimelineProfiler instance, traces pnet/rnet/onet on demand (see profile_next_calls)
     """
     def __init__(self, sess, model_path="./mtcnn_weights/"):
         self.pnet = None
         self.rnet = None
         self.onet = None
+        self.profiler = TimelineProfiler.from_env()
         self.create_mtcnn(sess, model_path)
         
     def create_mtcnn(self, sess, model_path):
@@ -34,9 +36,20 @@ class MTCNNFaceDetector():
             data = tf.placeholder(tf.float32, (None,48,48,3), 'input')
             onet = mtcnn_detect_face.ONet({'data':data})
             onet.load(os.path.join(model_path, 'det3.npy'), sess)
-        self.pnet = K.function([pnet.layers['data']], [pnet.layers['conv4-2'], pnet.layers['prob1']])
-        self.rnet = K.function([rnet.layers['data']], [rnet.layers['conv5-2'], rnet.layers['prob1']])
-        self.onet = K.function([onet.layers['data']], [onet.layers['conv6-2'], onet.layers['conv6-3'], onet.layers['prob1']])
+        self.pnet = self.profiler.function([pnet.layers['data']], [pnet.layers['conv4-2'], pnet.layers['prob1']],
+                                           name="mtcnn_pnet")
+        self.rnet = self.profiler.function([rnet.layers['data']], [rnet.layers['conv5-2'], rnet.layers['prob1']],
+                                           name="mtcnn_rnet")
+        self.onet = self.profiler.function([onet.layers['data']], 
+                                           [onet.layers['conv6-2'], onet.layers['conv6-3'], onet.layers['prob1']],
+                                           name="mtcnn_onet")
+    
+    def profile_next_calls(self, num_calls=1, names=None, log_dir=None):
+        """
+        Run the next num_calls calls of pnet/rnet/onet (names: "mtcnn_pnet", "mtcnn_rnet", "mtcnn_onet")
+        with full trace RunOptions. Note that pnet is called once per image pyramid scale.
+        """
+        self.profiler.enable(num_calls, names, log_dir)
     
     def detect_face(self, image, minsize=20, threshold=0.7, factor=0.709, use_auto_downscaling=True, min_face_area=25*25):
         if use_auto_downscaling:
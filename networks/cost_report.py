@@ -0,0 +1,243 @@
+from keras.models import Model
+from collections import defaultdict
+import numpy as np
+from .faceswap_gan_model import FaceswapGANModel, SUBNETWORKS
+from .custom_layers.recompute_layer import RecomputeSegment
+
+BYTES_PER_FLOAT = 4
+NORM_LAYERS = ["BatchNormalization", "InstanceNormalization", "GroupNormalization"]
+UPSAMPLE_LAYERS = ["PixelShuffler", "UpSampling2D"]
+# Layers that only change the view of a tensor: no FLOPs and no extra activation memory
+VIEW_LAYERS = ["InputLayer", "Reshape", "Flatten"]
+
+def to_list(x):
+    return list(x) if isinstance(x, (list, tuple)) else [x]
+
+def num_elements(shape):
+    # Batch axis excluded
+    return int(np.prod([d for d in shape[1:]]))
+
+def spatial_channels(shape, data_format):
+    if data_format == "channels_first":
+        return shape[2], shape[3], shape[1]
+    return shape[1], shape[2], shape[3]
+
+def network_nodes(model, layer):
+    """
+    Inbound nodes of layer that belong to model (a layer can be called by several models).
+    """
+    # Keras >= 2.2 made these attributes private (container_nodes/inbound_nodes in Keras 2.1.5)
+    keys = getattr(model, "_network_nodes", getattr(model, "container_nodes", None))
+    inbound_nodes = getattr(layer, "_inbound_nodes", None)
+    if inbound_nodes is None:
+        inbound_nodes = layer.inbound_nodes
+    return [node for i, node in enumerate(inbound_nodes)
+            if keys is None or f"{layer.name}_ib-{i}" in keys]
+
+def conv_flops(kernel_size, c_in, c_out, out_shape, data_format, use_bias=False):
+    h, w, _ = spatial_channels(out_shape, data_format)
+    return h * w * c_out * (2 * kernel_size[0] * kernel_size[1] * c_in + int(use_bias))
+
+def octconv_flops(layer, in_shapes, out_shapes):
+    (high_in, low_in), (high_out, low_out) = in_shapes, out_shapes
+    df = layer.data_format
+    c_high_in, c_low_in = spatial_channels(high_in, df)[2], spatial_channels(low_in, df)[2]
+    k = layer.kernel_size
+    flops = conv_flops(k, c_high_in, layer.high_channels, high_out, df) # high -> high
+    flops += conv_flops(k, c_high_in, layer.low_channels, low_out, df)  # high -> low
+    flops += conv_flops(k, c_low_in, layer.high_channels, low_out, df)  # low -> high (before upsampling)
+    flops += conv_flops(k, c_low_in, layer.low_channels, low_out, df)   # low -> low
+    return flops
+
+def is_attention(in_shapes, out_shapes):
+    # Batched matmuls of self_attn_block take (B, N, C) tensors
+    return len(in_shapes) >= 2 and all(len(s) == 3 for s in in_shapes + out_shapes)
+
+def attention_flops(in_shapes, out_shapes):
+    if len(in_shapes) == 3:
+        # chunked_attention(q, k, v): scores, streaming softmax and weighted sum
+        (_, n, d), (_, m, _), (_, _, c) = in_shapes
+        return 2 * n * m * d + 2 * n * m * c + 5 * n * m
+    # K.batch_dot(a, b): (N, K) x (K, M) or (N, K) x (M, K)^T
+    return 2 * num_elements(out_shapes[0]) * in_shapes[0][-1]
+
+def node_flops(layer, in_shapes, out_shapes):
+    name = type(layer).__name__
+    out_elements = sum(num_elements(s) for s in out_shapes)
+    if name == "Conv2D":
+        c_in = spatial_channels(in_shapes[0], layer.data_format)[2]
+        return conv_flops(layer.kernel_size, c_in, layer.filters, out_shapes[0], layer.data_format, layer.use_bias)
+    if name == "Dense":
+        return (2 * in_shapes[0][-1] + int(layer.use_bias)) * layer.units
+    if name == "OctConv2D":
+        return octconv_flops(layer, in_shapes, out_shapes)
+    if name in NORM_LAYERS:
+        return 8 * out_elements
+    if name == "Softmax":
+        return 5 * out_elements
+    if name == "Lambda" and is_attention(in_shapes, out_shapes):
+        return attention_flops(in_shapes, out_shapes)
+    if name in VIEW_LAYERS + ["Permute", "Concatenate", "PixelShuffler"]:
+        return 0
+    return out_elements
+
+def block_of(layer, in_shapes, out_shapes, from_layout):
+    """
+    Coarse block label of a layer. SPADE layers are the ones fed by the layout input of a decoder.
+    """
+    name = type(layer).__name__
+    if name in ["Softmax", "Scale"] or (name == "Lambda" and is_attention(in_shapes, out_shapes)):
+        return "self_attn"
+    if any(from_layout):
+        return "spade"
+    if name == "Conv2D":
+        return "conv"
+    if name == "OctConv2D":
+        return "octconv"
+    if name == "Dense":
+        return "dense"
+    if name in NORM_LAYERS:
+        return "norm"
+    if name in UPSAMPLE_LAYERS:
+        return "upsample"
+    return "other"
+
+def layer_costs(model, prefix=""):
+    """
+    Per-layer cost of one forward pass of a single image through model. Nested models and
+    recompute segments are expanded; the second input of a two-input model is treated as the layout input.
+
+    Returns:
+        rows: list of dicts with keys layer, type, block, output_shape, params, flops, activation_elements, recomputed
+    """
+    rows = []
+    from_layout = {}
+    for i, x in enumerate(model.inputs):
+        from_layout[id(x)] = (i == 1)
+    for layer in model.layers:
+        for node in network_nodes(model, layer):
+            inputs, outputs = to_list(node.input_tensors), to_list(node.output_tensors)
+            layout_flags = [from_layout.get(id(x), False) for x in inputs]
+            for y in outputs:
+                from_layout[id(y)] = bool(layout_flags) and all(layout_flags)
+            if type(layer).__name__ == "InputLayer":
+                continue
+            name = f"{prefix}{layer.name}"
+            if isinstance(layer, RecomputeSegment):
+                sub_rows = layer_costs(layer.segment, prefix=f"{name}/")
+                for row in sub_rows:
+                    row["recomputed"] = True
+                rows += sub_rows
+                continue
+            if isinstance(layer, Model):
+                rows += layer_costs(layer, prefix=f"{name}/")
+                continue
+            in_shapes = [tuple(x.get_shape().as_list()) for x in inputs]
+            out_shapes = [tuple(y.get_shape().as_list()) for y in outputs]
+            rows.append({
+                "layer": name,
+                "type": type(layer).__name__,
+                "block": block_of(layer, in_shapes, out_shapes, layout_flags),
+                "output_shape": out_shapes[0][1:],
+                "params": layer.count_params() if layer.weights else 0,
+                "flops": node_flops(layer, in_shapes, out_shapes),
+                "activation_elements": 0 if type(layer).__name__ in VIEW_LAYERS else sum(num_elements(s) for s in out_shapes),
+                "recomputed": False,
+                "inference_working_set": sum(num_elements(s) for s in in_shapes + out_shapes)
+            })
+    return rows
+
+def summarize(rows, batch_size=8, inference_batch_size=1):
+    """
+    Totals of a sub-network.
+
+    Memory estimates (MB):
+        weights: float32 weights
+        train_activations: activations kept for backprop at batch_size. Layers of recompute segments
+                           are only kept while their segment is recomputed, so only the largest segment counts.
+        train_total: weights + gradients + Adam moments (4x weights) + train_activations
+        inference_activations: largest input + output working set of a single layer at inference_batch_size
+    """
+    params = sum(r["params"] for r in rows)
+    stored = sum(r["activation_elements"] for r in rows if not r["recomputed"])
+    segments = defaultdict(int)
+    for r in rows:
+        if r["recomputed"]:
+            segments[r["layer"].rsplit("/", 1)[0]] += r["activation_elements"]
+    stored += max(segments.values()) if segments else 0
+    train_activations = stored * batch_size * BYTES_PER_FLOAT
+    return {
+        "params": params,
+        "gflops": sum(r["flops"] for r in rows) / 1e9,
+        "weights_mb": params * BYTES_PER_FLOAT / 2**20,
+        "train_activations_mb": train_activations / 2**20,
+        "train_total_mb": (4 * params * BYTES_PER_FLOAT + train_activations) / 2**20,
+        "inference_activations_mb": max([r["inference_working_set"] for r in rows] or [0]) \
+                                    * inference_batch_size * BYTES_PER_FLOAT / 2**20
+    }
+
+class CostReport():
+    """
+    Parameters, forward FLOPs and activation memory estimates of a FaceswapGANModel, without training it.
+    FLOPs are per image and count a multiply-add as 2 operations.
+
+    Attributes:
+        arch_config: dict, the architecture to be reported
+        batch_size: int, training batch size used for activation memory estimates
+        rows: dict of per-layer cost rows keyed by sub-network name, see layer_costs()
+        summary: dict of per-sub-network totals, see summarize()
+
+    Example:
+        report = CostReport(IMAGE_SHAPE=(128, 128, 3), use_self_attn=True, norm="instancenorm", model_capacity="standard")
+        report.show_report()
+    """
+    def __init__(self, batch_size=8, top_k=10, **arch_config):
+        self.arch_config = arch_config
+        self.batch_size = batch_size
+        self.top_k = top_k
+        model = FaceswapGANModel(**arch_config)
+        self.rows = {name: layer_costs(getattr(model, name)) for name in SUBNETWORKS}
+        self.summary = {name: summarize(rows, batch_size) for name, rows in self.rows.items()}
+
+    def get_report(self):
+        """
+        Summary of every sub-network, cost by block type, and the top_k most expensive layers by FLOPs and by memory.
+        """
+        blocks = {}
+        for name, rows in self.rows.items():
+            block_costs = defaultdict(lambda: {"params": 0, "gflops": 0., "activations_mb": 0.})
+            for r in rows:
+                block_costs[r["block"]]["params"] += r["params"]
+                block_costs[r["block"]]["gflops"] += r["flops"] / 1e9
+                block_costs[r["block"]]["activations_mb"] += \
+                    r["activation_elements"] * self.batch_size * BYTES_PER_FLOAT / 2**20
+            blocks[name] = dict(block_costs)
+        all_rows = [dict(r, subnet=name) for name, rows in self.rows.items() for r in rows]
+        generator = ["encoder", "decoder_A"]
+        return {
+            "arch_config": self.arch_config,
+            "batch_size": self.batch_size,
+            "summary": self.summary,
+            "generator_inference_gflops": sum(self.summary[k]["gflops"] for k in generator),
+            "blocks": blocks,
+            "top_flops": sorted(all_rows, key=lambda r: -r["flops"])[:self.top_k],
+            "top_activations": sorted(all_rows, key=lambda r: -r["activation_elements"])[:self.top_k]
+        }
+
+    def show_report(self):
+        report = self.get_report()
+        print (f"Batch size {self.batch_size} (training), 1 (inference). Memory in MB, FLOPs per image.")
+        print (f"{'':12s}{'params(M)':>10s}{'GFLOPs':>9s}{'weights':>9s}{'train act':>11s}{'train total':>13s}{'infer act':>11s}")
+        for name, s in report["summary"].items():
+            print (f"{name:12s}{s['params']/1e6:10.2f}{s['gflops']:9.3f}{s['weights_mb']:9.1f}"
+                   f"{s['train_activations_mb']:11.1f}{s['train_total_mb']:13.1f}{s['inference_activations_mb']:11.2f}")
+        print (f"Generator inference (encoder + one decoder): {report['generator_inference_gflops']:.3f} GFLOPs per image.")
+        for name, block_costs in report["blocks"].items():
+            costs = ", ".join(f"{block} {c['gflops']:.3f} GFLOPs / {c['activations_mb']:.0f} MB"
+                              for block, c in sorted(block_costs.items(), key=lambda kv: -kv[1]["gflops"]))
+            print (f"[{name}] {costs}")
+        for title, key in [("FLOPs", "top_flops"), ("activation memory", "top_activations")]:
+            print (f"Most expensive layers by {title}:")
+            for r in report[key]:
+                print (f"  {r['subnet']:10s}{r['layer']:45s}{r['block']:>10s}{str(r['output_shape']):>18s}"
+                       f"{r['flops']/1e6:12.1f} MFLOPs{r['activation_elements']*self.batch_size*BYTES_PER_FLOAT/2**20:10.1f} MB")
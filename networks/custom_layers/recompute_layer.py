@@ -0,0 +1,62 @@
+from keras.engine import Layer
+import tensorflow as tf
+import uuid
+
+def to_list(x):
+    return list(x) if isinstance(x, (list, tuple)) else [x]
+
+def unpack(x):
+    return x[0] if len(x) == 1 else x
+
+class RecomputeSegment(Layer):
+    '''
+    Gradient checkpointing (https://arxiv.org/abs/1604.06174) of a sub-network.
+
+    Only the inputs of the segment are kept for backprop. The forward output is cut off from the
+    gradient graph and the segment is re-run from its inputs once the gradient of its output is available,
+    which trades one extra forward pass of the segment for its activation memory.
+
+    # Arguments
+        segment: Keras Model, single or multiple inputs/outputs. Its weights are owned by this layer.
+    '''
+    def __init__(self, segment, **kwargs):
+        self.segment = segment
+        super(RecomputeSegment, self).__init__(**kwargs)
+
+    @property
+    def trainable_weights(self):
+        return self.segment.trainable_weights if self.trainable else []
+
+    @property
+    def non_trainable_weights(self):
+        return self.segment.non_trainable_weights if self.trainable else self.segment.weights
+
+    @property
+    def losses(self):
+        return self.segment.losses
+
+    def call(self, inputs):
+        inputs = to_list(inputs)
+        weights = self.segment.trainable_weights
+        outputs = to_list(self.segment.call(unpack(inputs)))
+        num_outputs, num_inputs = len(outputs), len(inputs)
+
+        def recompute_grad(op, *dys):
+            # Recompute only after the output gradient has arrived, so that the recomputed
+            # activations are not scheduled (and kept alive) during the forward pass.
+            with tf.control_dependencies([dy for dy in dys[:num_outputs] if dy is not None]):
+                xs = [tf.identity(x) for x in op.inputs[num_outputs:num_outputs+num_inputs]]
+            ys = to_list(self.segment.call(unpack(xs)))
+            dys = [tf.zeros_like(y) if dy is None else dy for y, dy in zip(ys, dys[:num_outputs])]
+            grads = tf.gradients(ys, xs + weights, grad_ys=dys)
+            return [None] * num_outputs + grads
+
+        grad_name = f"RecomputeSegment_{uuid.uuid4().hex}"
+        tf.RegisterGradient(grad_name)(recompute_grad)
+        # Inputs and weights pass through IdentityN so that their gradients are routed to recompute_grad
+        with tf.get_default_graph().gradient_override_map({"IdentityN": grad_name}):
+            identity = tf.identity_n([tf.stop_gradient(y) for y in outputs] + inputs + weights)
+        return unpack(identity[:num_outputs])
+
+    def compute_output_shape(self, input_shape):
+        return self.segment.compute_output_shape(input_shape)
@@ -0,0 +1,119 @@
+from keras.layers import Input
+from keras.optimizers import Adam
+import keras.backend as K
+import numpy as np
+from .faceswap_gan_model import FaceswapGANModel
+from .pruning import time_path
+
+def build_student(teacher, model_capacity="lite", **arch_overrides):
+    """
+    A FaceswapGANModel with the teacher's arch_config except model_capacity (and arch_overrides).
+    """
+    arch_config = dict(teacher.arch_config, model_capacity=model_capacity, **arch_overrides)
+    return FaceswapGANModel(**arch_config)
+
+class Distiller():
+    """
+    Knowledge distillation of a trained (teacher) FaceswapGANModel into a faster student, e.g. a
+    model_capacity="lite" model (see build_student) or a pruned model (see networks/pruning.py).
+
+    The student generators are trained to match the teacher's path_abgr_A/B outputs (L1 on alpha and BGR)
+    on augmented faces of both identities, since conversion feeds faces of one identity to the decoder of the other.
+    The teacher is never updated. Its outputs are precomputed for a pool of batches that is reused for
+    refresh_interval iterations before new batches are drawn from the data loaders.
+    The student keeps the FaceswapGANModel interface, so it can be passed to FaceTransformer.set_model().
+
+    Attributes:
+        teacher, student: FaceswapGANModel instances
+        w_alpha, w_bgr: float, weights of the alpha and BGR L1 losses
+        pool_size: int, number of batches in the pool
+        refresh_interval: int, number of iterations between pool refreshes
+        pool: list of (faces, layouts, teacher_abgr_A, teacher_abgr_B)
+
+    Example:
+        student = build_student(teacher, model_capacity="lite")
+        distiller = Distiller(teacher, student)
+        distiller.train(train_batchA.get_next_batch, train_batchB.get_next_batch, num_iters=20000)
+        student.save_weights("./models_lite")
+    """
+    def __init__(self, teacher, student, w_alpha=1., w_bgr=1., lr=1e-4, pool_size=20, refresh_interval=500):
+        if tuple(teacher.IMAGE_SHAPE) != tuple(student.IMAGE_SHAPE):
+            raise ValueError(f"Teacher and student should have the same IMAGE_SHAPE, "
+                             f"received {teacher.IMAGE_SHAPE} and {student.IMAGE_SHAPE}.")
+        self.teacher = teacher
+        self.student = student
+        self.w_alpha = w_alpha
+        self.w_bgr = w_bgr
+        self.lr = lr
+        self.pool_size = pool_size
+        self.refresh_interval = refresh_interval
+        self.pool = []
+        self.num_iters = 0
+        self.distill_A = self.build_distill_function(student.netGA, student.distorted_A, student.layout_A)
+        self.distill_B = self.build_distill_function(student.netGB, student.distorted_B, student.layout_B)
+
+    def build_distill_function(self, netG, distorted, layout):
+        teacher_abgr = Input(shape=tuple(self.student.IMAGE_SHAPE[:2]) + (4,))
+        fake_abgr = netG.outputs[-1]
+        loss_alpha = K.mean(K.abs(fake_abgr[..., :1] - teacher_abgr[..., :1]))
+        loss_bgr = K.mean(K.abs(fake_abgr[..., 1:] - teacher_abgr[..., 1:]))
+        loss = self.w_alpha * loss_alpha + self.w_bgr * loss_bgr
+        # L2 weight decay
+        for loss_tensor in netG.losses:
+            loss += loss_tensor
+        opt = Adam(lr=self.lr, beta_1=0.5)
+        training_updates = opt.get_updates(netG.trainable_weights, [], loss)
+        return K.function([distorted, layout, teacher_abgr], [loss, loss_alpha, loss_bgr], training_updates)
+
+    def refresh_pool(self, get_batch_A, get_batch_B):
+        """
+        Draw pool_size batches of both identities and precompute the teacher outputs of both decoders.
+        Warped and target (unwarped) faces are both used as inputs.
+        """
+        self.pool = []
+        for _ in range(self.pool_size):
+            faces, layouts = [], []
+            for data in [get_batch_A(), get_batch_B()]:
+                warped, target, _, layout, *_ = self.teacher.unpack_batch(data)
+                faces += [warped, target]
+                layouts += [layout, layout]
+            faces, layouts = np.concatenate(faces), np.concatenate(layouts)
+            teacher_abgr_A = self.teacher.path_abgr_A([faces, layouts])[0]
+            teacher_abgr_B = self.teacher.path_abgr_B([faces, layouts])[0]
+            self.pool.append((faces, layouts, teacher_abgr_A, teacher_abgr_B))
+
+    def train_one_batch(self, get_batch_A, get_batch_B):
+        if not self.pool or (self.num_iters > 0 and self.num_iters % self.refresh_interval == 0):
+            self.refresh_pool(get_batch_A, get_batch_B)
+        faces, layouts, teacher_abgr_A, teacher_abgr_B = self.pool[self.num_iters % len(self.pool)]
+        errA = self.distill_A([faces, layouts, teacher_abgr_A])
+        errB = self.distill_B([faces, layouts, teacher_abgr_B])
+        self.num_iters += 1
+        return errA, errB
+
+    def train(self, get_batch_A, get_batch_B, num_iters=10000, display_iters=500):
+        """
+        get_batch_A, get_batch_B: callables returning a new batch, e.g. DataLoader.get_next_batch
+        """
+        for i in range(num_iters):
+            errA, errB = self.train_one_batch(get_batch_A, get_batch_B)
+            if (i + 1) % display_iters == 0:
+                print (f"[iter {self.num_iters}] distillation loss A: {errA[0]:.4f} (alpha {errA[1]:.4f}, bgr {errA[2]:.4f}), "
+                       f"B: {errB[0]:.4f} (alpha {errB[1]:.4f}, bgr {errB[2]:.4f})")
+        return errA, errB
+
+    def evaluate(self, faces, layouts, num_runs=20):
+        """
+        L1 distance between student and teacher outputs of both decoders, and single-image inference speedup.
+        faces, layouts: (N, H, W, 3) arrays of model inputs
+        """
+        report = {}
+        for side in ["A", "B"]:
+            teacher_abgr = getattr(self.teacher, f"path_abgr_{side}")([faces, layouts])[0]
+            student_abgr = getattr(self.student, f"path_abgr_{side}")([faces, layouts])[0]
+            report[f"alpha_l1_{side}"] = float(np.mean(np.abs(student_abgr[..., :1] - teacher_abgr[..., :1])))
+            report[f"bgr_l1_{side}"] = float(np.mean(np.abs(student_abgr[..., 1:] - teacher_abgr[..., 1:])))
+        report["teacher_ms_per_image"] = time_path(self.teacher.path_abgr_B, faces, layouts, num_runs)
+        report["student_ms_per_image"] = time_path(self.student.path_abgr_B, faces, layouts, num_runs)
+        report["speedup"] = report["teacher_ms_per_image"] / report["student_ms_per_image"]
+        return report
@@ -0,0 +1,151 @@
+from keras.layers import Input
+import tensorflow as tf
+import keras.backend as K
+import numpy as np
+import json
+from pathlib import Path
+from .pruning import apply_plan, weights_snapshot, time_path
+
+try:
+    from tensorflow.tools.graph_transforms import TransformGraph
+except ImportError:
+    TransformGraph = None
+
+INPUT_NAMES = ["face", "layout"]
+OUTPUT_NAME = "abgr"
+DIRECTIONS = {"AtoB": "decoder_B", "BtoA": "decoder_A"}
+# Graph transforms applied to the frozen graph:
+# constant folding makes BatchNormalization a per-channel Mul/Add on the conv output, which fold_batch_norms
+# then folds into the conv kernel.
+GRAPH_TRANSFORMS = [
+    "strip_unused_nodes",
+    "remove_nodes(op=Identity, op=CheckNumerics)",
+    "fold_constants(ignore_errors=true)",
+    "fold_batch_norms",
+    "fold_old_batch_norms",
+    "remove_device",
+    "sort_by_execution_order"
+]
+
+def get_decoder_name(direction):
+    if direction not in DIRECTIONS:
+        raise ValueError(f"direction should be either AtoB or BtoA, recieved {direction}.")
+    return DIRECTIONS[direction]
+
+def build_inference_graph(model, direction="AtoB"):
+    """
+    Rebuild the encoder and the decoder used by direction in a new graph with learning phase 0,
+    with the current weights of model.
+
+    Returns:
+        graph, session: tf.Graph and a tf.Session holding the initialized variables
+        input_names: list of the face and layout placeholder names
+    """
+    if model.fade_in is not None:
+        raise ValueError("Models built with use_fade_in=True cannot be exported. fade_in_block has no weights: "
+                         "rebuild the model with use_fade_in=False and load its weights first.")
+    decoder = getattr(model, get_decoder_name(direction))
+    snapshot = weights_snapshot(model.encoder)
+    snapshot.update(weights_snapshot(decoder))
+
+    prev_session = K.get_session()
+    graph = tf.Graph()
+    with graph.as_default():
+        session = tf.Session(graph=graph)
+        K.set_session(session)
+        K.set_learning_phase(0)
+        encoder = apply_plan(model.encoder, snapshot=snapshot)
+        decoder = apply_plan(decoder, snapshot=snapshot)
+        face = Input(batch_shape=(None,) + tuple(model.IMAGE_SHAPE), name=INPUT_NAMES[0])
+        layout = Input(batch_shape=(None,) + tuple(model.IMAGE_SHAPE), name=INPUT_NAMES[1])
+        tf.identity(decoder([encoder(face), layout])[-1], name=OUTPUT_NAME)
+    K.set_session(prev_session)
+    return graph, session, [face.op.name, layout.op.name]
+
+def freeze_graph(graph, session, input_names):
+    """
+    Constant graph_def of the abgr output: variables become constants, nodes not needed by the output are removed,
+    and BatchNormalization is folded into convolutions if graph transforms are available.
+    """
+    with graph.as_default():
+        graph_def = tf.graph_util.convert_variables_to_constants(session, graph.as_graph_def(), [OUTPUT_NAME])
+    graph_def = tf.graph_util.remove_training_nodes(graph_def, protected_nodes=[OUTPUT_NAME])
+    if TransformGraph is not None:
+        graph_def = TransformGraph(graph_def, input_names, [OUTPUT_NAME], GRAPH_TRANSFORMS)
+    else:
+        print ("tensorflow.tools.graph_transforms is not available, BatchNormalization is not folded.")
+    return graph_def
+
+def export_frozen_generator(model, direction="AtoB", path="./models/frozen"):
+    """
+    Export the generator of one conversion direction (encoder + decoder_B for AtoB) as an inference-only graph.
+    Writes generator_{direction}.pb and generator_{direction}.json (input/output names and IMAGE_SHAPE) to path.
+    """
+    graph, session, input_names = build_inference_graph(model, direction)
+    graph_def = freeze_graph(graph, session, input_names)
+    session.close()
+    Path(path).mkdir(parents=True, exist_ok=True)
+    with open(f"{path}/generator_{direction}.pb", "wb") as f:
+        f.write(graph_def.SerializeToString())
+    with open(f"{path}/generator_{direction}.json", "w") as f:
+        json.dump({"direction": direction, "IMAGE_SHAPE": list(model.IMAGE_SHAPE),
+                   "inputs": [f"{name}:0" for name in input_names], "output": f"{OUTPUT_NAME}:0"}, f)
+    print (f"Frozen {direction} generator ({len(graph_def.node)} nodes) has been saved to {path}.")
+
+class FrozenGenerator():
+    """
+    Runs a generator exported by export_frozen_generator() without building any Keras model.
+    Drop-in replacement of FaceswapGANModel in FaceTransformer.set_model() for the exported direction.
+
+    Attributes:
+        direction: string, "AtoB" or "BtoA"
+        IMAGE_SHAPE: tuple, input shape of the generator
+        path_abgr_A, path_abgr_B: callables of [faces, layouts] -> [abgr]; only the exported direction is available
+    """
+    def __init__(self, path="./models/frozen", direction="AtoB", session_config=None):
+        get_decoder_name(direction)
+        pb_fn, meta_fn = f"{path}/generator_{direction}.pb", f"{path}/generator_{direction}.json"
+        for fn in [pb_fn, meta_fn]:
+            if not Path(fn).exists():
+                raise IOError(f"{fn} not found. Export the generator with export_frozen_generator() first.")
+        with open(meta_fn, "r") as f:
+            meta = json.load(f)
+        graph_def = tf.GraphDef()
+        with open(pb_fn, "rb") as f:
+            graph_def.ParseFromString(f.read())
+
+        self.direction = direction
+        self.IMAGE_SHAPE = tuple(meta["IMAGE_SHAPE"])
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            tf.import_graph_def(graph_def, name="")
+        self.inputs = [self.graph.get_tensor_by_name(name) for name in meta["inputs"]]
+        self.output = self.graph.get_tensor_by_name(meta["output"])
+        self.sess = tf.Session(graph=self.graph, config=session_config)
+        # FaceTransformer uses path_abgr_B for AtoB and path_abgr_A for BtoA
+        if direction == "AtoB":
+            self.path_abgr_B, self.path_abgr_A = self.run, self._unavailable
+        else:
+            self.path_abgr_A, self.path_abgr_B = self.run, self._unavailable
+
+    def run(self, inputs):
+        faces, layouts = inputs
+        return [self.sess.run(self.output, feed_dict={self.inputs[0]: np.asarray(faces),
+                                                      self.inputs[1]: np.asarray(layouts)})]
+
+    def _unavailable(self, inputs):
+        raise ValueError(f"Only the {self.direction} direction has been exported.")
+
+def latency_report(model, frozen_generator, faces, layouts, num_runs=20):
+    """
+    Single-image latency and output difference of the Keras model against the frozen generator.
+    """
+    path_name = "path_abgr_B" if frozen_generator.direction == "AtoB" else "path_abgr_A"
+    keras_fn, frozen_fn = getattr(model, path_name), getattr(frozen_generator, path_name)
+    report = {
+        "keras_ms_per_image": time_path(keras_fn, faces, layouts, num_runs),
+        "frozen_ms_per_image": time_path(frozen_fn, faces, layouts, num_runs),
+        "max_abs_diff": float(np.max(np.abs(keras_fn([faces, layouts])[0] - frozen_fn([faces, layouts])[0])))
+    }
+    report["speedup"] = report["keras_ms_per_image"] / report["frozen_ms_per_image"]
+    return report
@@ -1,8 +1,76 @@
 from keras.models import Model
 from keras.layers import *
 from keras.optimizers import Adam
+try:
+    from keras.engine.saving import save_weights_to_hdf5_group, load_weights_from_hdf5_group
+except ImportError:
+    from keras.engine.topology import save_weights_to_hdf5_group, load_weights_from_hdf5_group
 from .nn_blocks import *
 from .losses import *
+from profiling.timeline_profiler import TimelineProfiler
+from pathlib import Path
+import tensorflow as tf
+import contextlib
+import json
+import h5py
+import os
+
+# arch_config entries that determine the shapes and the layer layout of encoder and decoder weights
+# (use_recompute nests the layers of each stage into a RecomputeSegment)
+ARCH_KEYS = ['IMAGE_SHAPE', 'use_self_attn', 'norm', 'model_capacity', 'encoder_type', 'octconv_alpha', 'use_recompute']
+# Values of keys that are missing from arch_config (and from arch_config.json of older weights files)
+ARCH_DEFAULTS = {'encoder_type': 'standard', 'octconv_alpha': 0.5, 'use_recompute': False}
+ENCODER_TYPES = ['standard', 'octconv']
+SUBNETWORKS = ['encoder', 'decoder_A', 'decoder_B', 'netDA', 'netDB']
+# Consolidated checkpoint: one HDF5 group of Keras weights per sub-network, plus an index in the file attributes
+CHECKPOINT_FILENAME = "checkpoint.h5"
+CHECKPOINT_VERSION = 1
+MODES = ['train', 'inference']
+# Decoder used by each conversion direction in inference mode (as in FaceTransformer)
+INFERENCE_DECODERS = {'AtoB': 'decoder_B', 'BtoA': 'decoder_A'}
+
+def get_arch_config(arch_config):
+    """
+    The subset of arch_config that determines weights shapes, with defaults filled in.
+    """
+    return {k: arch_config.get(k, ARCH_DEFAULTS.get(k)) for k in ARCH_KEYS}
+
+def read_checkpoint_index(f, fn):
+    """
+    Index of an opened consolidated checkpoint: {'format_version', 'arch_config', 'subnetworks'}.
+    """
+    for k in ["format_version", "arch_config", "subnetworks"]:
+        if k not in f.attrs:
+            raise ValueError(f"{fn} is not a consolidated checkpoint ({k} is missing from its index).")
+    format_version = int(f.attrs["format_version"])
+    if format_version > CHECKPOINT_VERSION:
+        raise ValueError(f"{fn} has checkpoint format version {format_version}, "
+                         f"only versions up to {CHECKPOINT_VERSION} are supported.")
+    return {
+        "format_version": format_version,
+        "arch_config": json.loads(f.attrs["arch_config"]),
+        "subnetworks": json.loads(f.attrs["subnetworks"])
+    }
+
+def gate_gradients(optimizer, weights, gate):
+    """
+    Multiply the gradients of weights by gate (a scalar K.variable) in the updates built by optimizer.
+    With gate = 0 and fresh optimizer states, Adam leaves these weights unchanged.
+    """
+    gated = set(id(w) for w in weights)
+    get_gradients = optimizer.get_gradients
+    def get_gated_gradients(loss, params):
+        grads = get_gradients(loss, params)
+        return [g * gate if id(p) in gated else g for g, p in zip(grads, params)]
+    optimizer.get_gradients = get_gated_gradients
+
+def jit_scope(use_xla_jit=False):
+    """
+    Ops created inside the returned context are compiled by XLA JIT if use_xla_jit is True.
+    """
+    if use_xla_jit:
+        return tf.contrib.compiler.jit.experimental_jit_scope()
+    return contextlib.ExitStack() # null context
 
 class FaceswapGANModel():
     """
@@ -14,8 +82,47 @@ class FaceswapGANModel():
         nc_D_inp: int, number of discriminator input channels
         lrG: float, learning rate of the generator
         lrD: float, learning rate of the discriminator
+        profiler: TimelineProfiler instance, traces K.functions on demand (see profile_next_calls)
+        fade_in: K.variable or None, blending factor of the newest stage in progressive training
+        freeze_encoder_iters: int, number of generator updates during which the encoder is frozen
+        data_format: string, "channels_last" (default) or "channels_first" (NCHW, faster on MKL/oneDNN CPU builds)
+        optimizers: list of (optimizer, base learning rate) of the built training functions, see set_lr_factor
+        self_attn_chunk_size: int or None, query/key chunk size of self-attention blocks (weights are unaffected)
+        mode: string, "train" (default) or "inference". In inference mode only the encoder and the decoder of
+              direction are built, along with its path_abgr function. Other networks and path functions are None.
+        direction: string, "AtoB" or "BtoA", conversion direction of inference mode
+        subnetworks: list of the names of the built sub-networks
     """
-    def __init__(self, **arch_config):
+    def __init__(self, mode="train", direction=None, **arch_config):
+        if mode not in MODES:
+            raise ValueError(f"mode should be one of {MODES}, received {mode}.")
+        if mode == "inference" and direction not in INFERENCE_DECODERS:
+            raise ValueError(f"direction should be either AtoB or BtoA in inference mode, received {direction}.")
+        self.mode = mode
+        self.direction = direction
+        self.subnetworks = SUBNETWORKS if mode == "train" else ["encoder", INFERENCE_DECODERS[direction]]
+        self.init_arch_config(arch_config)
+        self.encoder, decoders, netDs = self.build_networks(
+            decoder_names=[name[-1] for name in self.subnetworks if name.startswith("decoder_")],
+            netD_names=[name[-1] for name in self.subnetworks if name.startswith("netD")])
+        self.decoder_A, self.decoder_B = decoders.get("A"), decoders.get("B")
+        self.netDA, self.netDB = netDs.get("A"), netDs.get("B")
+        
+        self.build_generators()
+        if self.mode == "train":
+            self.real_A = Input(shape=self.IMAGE_SHAPE)
+            self.real_B = Input(shape=self.IMAGE_SHAPE)
+            self.mask_eyes_A = Input(shape=self.IMAGE_SHAPE)
+            self.mask_eyes_B = Input(shape=self.IMAGE_SHAPE)
+        self.target_pyramid_A = []
+        self.target_pyramid_B = []
+        self.init_warm_start()
+    
+    def init_arch_config(self, arch_config):
+        """
+        Set the attributes derived from arch_config (shared with MultiIdentityFaceswapGANModel).
+        """
+        self.arch_config = arch_config
         self.nc_G_inp = 3
         self.nc_D_inp = 6 
         self.IMAGE_SHAPE = arch_config['IMAGE_SHAPE']
@@ -25,143 +132,179 @@ class FaceswapGANModel():
         self.norm = arch_config['norm']
         self.model_capacity = arch_config['model_capacity']
         self.enc_nc_out = 256 if self.model_capacity == "lite" else 512
+        # "octconv" replaces the convolutional stages of the encoder with octave convolutions (cheaper, see encoder_benchmark.py)
+        self.encoder_type = arch_config.get('encoder_type', ARCH_DEFAULTS['encoder_type'])
+        if self.encoder_type not in ENCODER_TYPES:
+            raise ValueError(f"encoder_type should be one of {ENCODER_TYPES}, received {self.encoder_type}.")
+        self.octconv_alpha = arch_config.get('octconv_alpha', ARCH_DEFAULTS['octconv_alpha'])
+        # Internal layout of the networks. Inputs and outputs of every sub-network stay NHWC.
+        self.data_format = arch_config.get('data_format', 'channels_last')
+        if self.data_format not in ['channels_last', 'channels_first']:
+            raise ValueError(f"data_format should be either channels_last or channels_first, received {self.data_format}.")
+        # Gradient checkpointing of encoder/decoder stages, see RecomputeSegment.
+        # Note that weights files are laid out per segment: use progressive.set_layer_weights() to transfer weights.
+        self.use_recompute = arch_config.get('use_recompute', ARCH_DEFAULTS['use_recompute'])
+        # Chunked (memory-efficient) self-attention, see nn_blocks.chunked_attention. None computes full attention maps.
+        self.self_attn_chunk_size = arch_config.get('self_attn_chunk_size', None)
+        self.profiler = TimelineProfiler.from_env()
+        # progressive training (see networks/progressive.py): the newest stage is faded in
+        self.fade_in = K.variable(1., name="fade_in") if arch_config.get('use_fade_in', False) else None
+        # XLA JIT (optional) applies to generator/discriminator graphs and the path_* functions
+        self.use_xla_jit = arch_config.get('use_xla_jit', False)
+    
+    def build_networks(self, decoder_names, netD_names):
+        """
+        Build the shared encoder, and one decoder and one discriminator per name.
         
-        # define networks
-        self.encoder = self.build_encoder(nc_in=self.nc_G_inp, 
-                                          input_size=self.IMAGE_SHAPE[0], 
-                                          use_self_attn=self.use_self_attn,
-                                          norm=self.norm,
-                                          model_capacity=self.model_capacity
-                                         )
-        self.decoder_A = self.build_decoder(nc_in=self.enc_nc_out, 
-                                            input_size=8, 
-                                            output_size=self.IMAGE_SHAPE[0],
-                                            use_self_attn=self.use_self_attn,
-                                            norm=self.norm,
-                                            model_capacity=self.model_capacity
-                                           )
-        self.decoder_B = self.build_decoder(nc_in=self.enc_nc_out, 
-                                            input_size=8, 
-                                            output_size=self.IMAGE_SHAPE[0],
-                                            use_self_attn=self.use_self_attn,
-                                            norm=self.norm,
-                                            model_capacity=self.model_capacity
-                                           )
-        self.netDA = self.build_discriminator(nc_in=self.nc_D_inp, 
-                                              input_size=self.IMAGE_SHAPE[0],
-                                              use_self_attn=self.use_self_attn,
-                                              norm=self.norm                                         
-                                             )
-        self.netDB = self.build_discriminator(nc_in=self.nc_D_inp, 
-                                              input_size=self.IMAGE_SHAPE[0],
-                                              use_self_attn=self.use_self_attn,
-                                              norm=self.norm                                         
-                                             )
-        x = Input(shape=self.IMAGE_SHAPE) # dummy input tensor
-        y = Input(shape=self.IMAGE_SHAPE) # dummy input tensor
-        self.netGA = Model([x, y], self.decoder_A([self.encoder(x), y]))
-        self.netGB = Model([x, y], self.decoder_B([self.encoder(x), y]))
+        Returns:
+            encoder: Keras model
+            decoders, netDs: dicts of Keras models keyed by name
+        """
+        with jit_scope(self.use_xla_jit):
+            encoder = self.build_encoder(nc_in=self.nc_G_inp, 
+                                         input_size=self.IMAGE_SHAPE[0], 
+                                         use_self_attn=self.use_self_attn,
+                                         norm=self.norm,
+                                         model_capacity=self.model_capacity,
+                                         fade_in=self.fade_in,
+                                         data_format=self.data_format,
+                                         use_recompute=self.use_recompute,
+                                         self_attn_chunk_size=self.self_attn_chunk_size,
+                                         encoder_type=self.encoder_type,
+                                         octconv_alpha=self.octconv_alpha
+                                        )
+            decoders = {}
+            for name in decoder_names:
+                decoders[name] = self.build_decoder(nc_in=self.enc_nc_out, 
+                                                    input_size=8, 
+                                                    output_size=self.IMAGE_SHAPE[0],
+                                                    use_self_attn=self.use_self_attn,
+                                                    norm=self.norm,
+                                                    model_capacity=self.model_capacity,
+                                                    fade_in=self.fade_in,
+                                                    data_format=self.data_format,
+                                                    use_recompute=self.use_recompute,
+                                                    self_attn_chunk_size=self.self_attn_chunk_size
+                                                   )
+            netDs = {}
+            for name in netD_names:
+                netDs[name] = self.build_discriminator(nc_in=self.nc_D_inp, 
+                                                       input_size=self.IMAGE_SHAPE[0],
+                                                       use_self_attn=self.use_self_attn,
+                                                       norm=self.norm,
+                                                       fade_in=self.fade_in,
+                                                       data_format=self.data_format,
+                                                       self_attn_chunk_size=self.self_attn_chunk_size
+                                                      )
+        return encoder, decoders, netDs
+    
+    def init_warm_start(self):
+        # warm start (see load_pretrained_encoder)
+        self.freeze_encoder_iters = 0
+        self.num_G_updates = 0
+        self.encoder_frozen = False
+        self.encoder_gate = K.variable(1., name="encoder_gate")
+    
+    def build_generators(self):
+        """
+        (Re)build netGA/netGB and the path_* functions from the current encoder and decoders,
+        e.g. after they are replaced by thinner networks (see networks/pruning.py).
+        """
+        if self.mode == "inference":
+            self.build_inference_function()
+            return
+        with jit_scope(self.use_xla_jit):
+            x = Input(shape=self.IMAGE_SHAPE) # dummy input tensor
+            y = Input(shape=self.IMAGE_SHAPE) # dummy input tensor
+            self.netGA = Model([x, y], self.decoder_A([self.encoder(x), y]))
+            self.netGB = Model([x, y], self.decoder_B([self.encoder(x), y]))
         
-        # define variables
-        self.distorted_A, self.layout_A, self.fake_A, self.mask_A, \
-        self.path_A, self.path_mask_A, self.path_abgr_A, self.path_bgr_A = self.define_variables(netG=self.netGA)
-        self.distorted_B, self.layout_B, self.fake_B, self.mask_B, \
-        self.path_B, self.path_mask_B, self.path_abgr_B, self.path_bgr_B = self.define_variables(netG=self.netGB)
-        self.real_A = Input(shape=self.IMAGE_SHAPE)
-        self.real_B = Input(shape=self.IMAGE_SHAPE)
-        self.mask_eyes_A = Input(shape=self.IMAGE_SHAPE)
-        self.mask_eyes_B = Input(shape=self.IMAGE_SHAPE)
+            # define variables
+            self.distorted_A, self.layout_A, self.fake_A, self.mask_A, \
+            self.path_A, self.path_mask_A, self.path_abgr_A, self.path_bgr_A = self.define_variables(
+                netG=self.netGA, function=self.profiler.function, suffix="_A")
+            self.distorted_B, self.layout_B, self.fake_B, self.mask_B, \
+            self.path_B, self.path_mask_B, self.path_abgr_B, self.path_bgr_B = self.define_variables(
+                netG=self.netGB, function=self.profiler.function, suffix="_B")
+    
+    def build_inference_function(self):
+        """
+        The path_abgr function of self.direction only, e.g. path_abgr_B (encoder + decoder_B) for AtoB.
+        """
+        side = INFERENCE_DECODERS[self.direction][-1]
+        with jit_scope(self.use_xla_jit):
+            x = Input(shape=self.IMAGE_SHAPE)
+            y = Input(shape=self.IMAGE_SHAPE)
+            # The last decoder output is already [alpha, bgr]
+            abgr = getattr(self, f"decoder_{side}")([self.encoder(x), y])[-1]
+            path_abgr = self.profiler.function([x, y], [abgr], name=f"path_abgr_{side}")
+        self.netGA = self.netGB = None
+        for name in ["path_A", "path_mask_A", "path_abgr_A", "path_bgr_A", 
+                     "path_B", "path_mask_B", "path_abgr_B", "path_bgr_B"]:
+            setattr(self, name, None)
+        setattr(self, f"path_abgr_{side}", path_abgr)
     
     @staticmethod
     def build_encoder(nc_in=3, 
                       input_size=64, 
                       use_self_attn=True, 
                       norm='none', 
-                      model_capacity='standard'):
+                      model_capacity='standard',
+                      fade_in=None,
+                      data_format='channels_last',
+                      use_recompute=False,
+                      self_attn_chunk_size=None,
+                      encoder_type='standard',
+                      octconv_alpha=0.5):
         coef = 2 if model_capacity == "lite" else 1
         latent_dim = 2048 if (model_capacity == "lite" and input_size > 64) else 1024
         upscale_block = upscale_nn if model_capacity == "lite" else upscale_ps
         activ_map_size = input_size
         use_norm = False if (norm == 'none') else True
+        df = data_format
         
         inp = Input(shape=(input_size, input_size, nc_in))
-        x = Conv2D(64//coef, kernel_size=5, use_bias=False, padding="same")(inp) # use_bias should be True
-        x = conv_block(x, 128//coef)
-        x = conv_block(x, 256//coef, use_norm, norm=norm)
-        x = self_attn_block(x, 256//coef) if use_self_attn else x
-        x = conv_block(x, 512//coef, use_norm, norm=norm) 
-        x = self_attn_block(x, 512//coef) if use_self_attn else x
-        x = conv_block(x, 1024//(coef**2), use_norm, norm=norm)
-        
-        activ_map_size = activ_map_size//16
-        while (activ_map_size > 4):
-            x = conv_block(x, 1024//(coef**2), use_norm, norm=norm)
-            activ_map_size = activ_map_size//2
-        
-        x = Dense(latent_dim)(Flatten()(x))
-        x = Dense(4*4*1024//(coef**2))(x)
-        x = Reshape((4, 4, 1024//(coef**2)))(x)
-        out = upscale_block(x, 512//coef, use_norm, norm=norm)
-        return Model(inputs=inp, outputs=out)        
-    '''
-    @staticmethod
-    def build_decoder(nc_in=512, 
-                      input_size=8, 
-                      output_size=64, 
-                      use_self_attn=True, 
-                      norm='none', 
-                      model_capacity='standard'):  
-        coef = 2 if model_capacity == "lite" else 1
-        upscale_block = upscale_nn if model_capacity == "lite" else upscale_ps
-        activ_map_size = input_size
-        use_norm = False if (norm == 'none') else True
-
-        inp = Input(shape=(input_size, input_size, nc_in))
-        x = inp
-        x = upscale_block(x, 256//coef, use_norm, norm=norm)
-        x = upscale_block(x, 128//coef, use_norm, norm=norm)
-        x = self_attn_block(x, 128//coef) if use_self_attn else x
-        x = upscale_block(x, 64//coef, use_norm, norm=norm)
-        x = res_block(x, 64//coef, norm=norm)
-        x = self_attn_block(x, 64//coef) if use_self_attn else conv_block(x, 64//coef, strides=1)
+        def stage_1(x):
+            x = Conv2D(64//coef, kernel_size=5, use_bias=False, padding="same", data_format=df)(x) # use_bias should be True
+            x = conv_block(x, 128//coef, data_format=df)
+            x = conv_block(x, 256//coef, use_norm, norm=norm, data_format=df)
+            x = self_attn_block(x, 256//coef, data_format=df, chunk_size=self_attn_chunk_size) if use_self_attn else x
+            return x
+        def stage_2(x):
+            x = conv_block(x, 512//coef, use_norm, norm=norm, data_format=df) 
+            x = self_attn_block(x, 512//coef, data_format=df, chunk_size=self_attn_chunk_size) if use_self_attn else x
+            x = conv_block(x, 1024//(coef**2), use_norm, norm=norm, data_format=df)
+            return x
         
-        outputs = []
-        activ_map_size = activ_map_size * 8
-        while (activ_map_size < output_size):
-            outputs.append(Conv2D(3, kernel_size=5, padding='same', activation="tanh")(x))
-            x = upscale_block(x, 64//coef, use_norm, norm=norm)
-            x = conv_block(x, 64//coef, strides=1)
-            activ_map_size *= 2
+        def stage_oct(x):
+            # Octave convolutions down to 8x8 (high) / 4x4 (low), merged into a single 4x4 feature map
+            return octconv_block(x, 64//coef, input_size, 4, octconv_alpha, use_norm, norm, data_format=df)
         
-        alpha = Conv2D(1, kernel_size=5, padding='same', activation="sigmoid")(x)
-        bgr = Conv2D(3, kernel_size=5, padding='same', activation="tanh")(x)
-        out = concatenate([alpha, bgr])
-        outputs.append(out)
-        return Model(inp, outputs)
-
-    @staticmethod
-    def build_encoder(nc_in=3, 
-                      input_size=64, 
-                      use_self_attn=True, 
-                      norm='none', 
-                      model_capacity='standard'):
-        coef = 2 if model_capacity == "lite" else 1
-        latent_dim = 2048 if (model_capacity == "lite" and input_size > 64) else 1024
-        upscale_block = upscale_nn if model_capacity == "lite" else upscale_ps
-        activ_map_size = input_size
-        use_norm = False if (norm == 'none') else True
-        
-        inp = Input(shape=(input_size, input_size, nc_in))
-
-        alpha = 0.5
-        x = octconv_block(inp, 64//coef, input_size, 4, alpha, use_norm, norm)
+        x = to_data_format(inp, df)
+        skip = None
+        if encoder_type == 'octconv':
+            x = recompute_block(stage_oct, [x], use_recompute)
+        else:
+            x = recompute_block(stage_1, [x], use_recompute)
+            x = recompute_block(stage_2, [x], use_recompute)
+            
+            activ_map_size = activ_map_size//16
+            while (activ_map_size > 4):
+                skip = x
+                x = conv_block(x, 1024//(coef**2), use_norm, norm=norm, data_format=df)
+                activ_map_size = activ_map_size//2
+        if fade_in is not None and skip is not None:
+            x = fade_in_block(x, AveragePooling2D(data_format=df)(skip), fade_in)
         
+        # Dense layers see NHWC order, so weights do not depend on data_format
+        x = from_data_format(x, df)
         x = Dense(latent_dim)(Flatten()(x))
         x = Dense(4*4*1024//(coef**2))(x)
         x = Reshape((4, 4, 1024//(coef**2)))(x)
-        out = upscale_block(x, 512//coef, use_norm, norm=norm)
-        return Model(inputs=inp, outputs=out)  
-    '''
+        x = to_data_format(x, df)
+        x = upscale_block(x, 512//coef, use_norm, norm=norm, data_format=df)
+        out = from_data_format(x, df)
+        return Model(inputs=inp, outputs=out)
 
     @staticmethod
     def build_decoder(nc_in=512, 
@@ -169,66 +312,103 @@ class FaceswapGANModel():
                       output_size=64, 
                       use_self_attn=True, 
                       norm='none', 
-                      model_capacity='standard'):  
+                      model_capacity='standard',
+                      fade_in=None,
+                      data_format='channels_last',
+                      use_recompute=False,
+                      self_attn_chunk_size=None):  
         coef = 2 if model_capacity == "lite" else 1
         upscale_block = upscale_nn
         activ_map_size = input_size
         use_norm = False if (norm == 'none') else True
+        df = data_format
 
         inp = Input(shape=(input_size, input_size, nc_in))
         lay = Input(shape=(output_size, output_size, 3))
-        x = inp
-        y = lay
-        x = upscale_block(x, 256//coef)
-        x = SPADE_res_block(x, y, 256//coef, True, 'batchnorm')
-        x = upscale_block(x, 128//coef)
-        x = SPADE_res_block(x, y, 128//coef, True, 'batchnorm')
-        x = self_attn_block(x, 128//coef) if use_self_attn else x
-        x = upscale_block(x, 64//coef)
-        x = SPADE_res_block(x, y, 64//coef, True, 'batchnorm')
-        #x = res_block(x, 64//coef, norm=norm)
-        x = self_attn_block(x, 64//coef) if use_self_attn else conv_block(x, 64//coef, strides=1)
+        # Each upscaling stage is a recompute segment if use_recompute is True
+        def stage_1(x, y):
+            x = upscale_block(x, 256//coef, data_format=df)
+            x = SPADE_res_block(x, y, 256//coef, True, 'batchnorm', data_format=df)
+            return x
+        def stage_2(x, y):
+            x = upscale_block(x, 128//coef, data_format=df)
+            x = SPADE_res_block(x, y, 128//coef, True, 'batchnorm', data_format=df)
+            x = self_attn_block(x, 128//coef, data_format=df, chunk_size=self_attn_chunk_size) if use_self_attn else x
+            return x
+        def stage_3(x, y):
+            x = upscale_block(x, 64//coef, data_format=df)
+            x = SPADE_res_block(x, y, 64//coef, True, 'batchnorm', data_format=df)
+            #x = res_block(x, 64//coef, norm=norm)
+            x = self_attn_block(x, 64//coef, data_format=df, chunk_size=self_attn_chunk_size) if use_self_attn else conv_block(x, 64//coef, strides=1, data_format=df)
+            return x
+        def stage_hr(x, y):
+            x = upscale_block(x, 64//coef, data_format=df)
+            x = SPADE_res_block(x, y, 64//coef, True, 'batchnorm', data_format=df)
+            x = conv_block(x, 64//coef, strides=1, data_format=df)
+            return x
+        
+        x = to_data_format(inp, df)
+        y = to_data_format(lay, df)
+        x = recompute_block(stage_1, [x, y], use_recompute)
+        x = recompute_block(stage_2, [x, y], use_recompute)
+        x = recompute_block(stage_3, [x, y], use_recompute)
         
         outputs = []
         activ_map_size = activ_map_size * 8
+        skip = None
         while (activ_map_size < output_size):
-            outputs.append(Conv2D(3, kernel_size=5, padding='same', activation="tanh")(x))
-            x = upscale_block(x, 64//coef)
-            x = SPADE_res_block(x, y, 64//coef, True, 'batchnorm')
-            x = conv_block(x, 64//coef, strides=1)
+            outputs.append(Conv2D(3, kernel_size=5, padding='same', activation="tanh", data_format=df)(x))
+            skip = x
+            x = recompute_block(stage_hr, [x, y], use_recompute)
             activ_map_size *= 2
+        if fade_in is not None and skip is not None:
+            x = fade_in_block(x, UpSampling2D(data_format=df)(skip), fade_in)
         
-        alpha = Conv2D(1, kernel_size=5, padding='same', activation="sigmoid")(x)
-        bgr = Conv2D(3, kernel_size=5, padding='same', activation="tanh")(x)
-        out = concatenate([alpha, bgr])
+        alpha = Conv2D(1, kernel_size=5, padding='same', activation="sigmoid", data_format=df)(x)
+        bgr = Conv2D(3, kernel_size=5, padding='same', activation="tanh", data_format=df)(x)
+        out = concatenate([alpha, bgr], axis=channel_axis(df))
         outputs.append(out)
+        outputs = [from_data_format(out, df) for out in outputs]
         return Model([inp, lay], outputs)
     
     @staticmethod
     def build_discriminator(nc_in, 
                             input_size=64, 
                             use_self_attn=True, 
-                            norm='none'):  
+                            norm='none',
+                            fade_in=None,
+                            data_format='channels_last',
+                            self_attn_chunk_size=None):  
         activ_map_size = input_size
         use_norm = False if (norm == 'none') else True
+        df = data_format
         
         inp = Input(shape=(input_size, input_size, nc_in))
-        x = conv_block_d(inp, 64, False)
-        x = conv_block_d(x, 128, use_norm, norm=norm)
-        x = conv_block_d(x, 256, use_norm, norm=norm)
-        x = self_attn_block(x, 256) if use_self_attn else x
+        x = to_data_format(inp, df)
+        x = conv_block_d(x, 64, False, data_format=df)
+        x = conv_block_d(x, 128, use_norm, norm=norm, data_format=df)
+        x = conv_block_d(x, 256, use_norm, norm=norm, data_format=df)
+        x = self_attn_block(x, 256, data_format=df, chunk_size=self_attn_chunk_size) if use_self_attn else x
         
         activ_map_size = activ_map_size//8
+        skip = None
         while (activ_map_size > 8):
-            x = conv_block_d(x, 256, use_norm, norm=norm)
-            x = self_attn_block(x, 256) if use_self_attn else x
+            skip = x
+            x = conv_block_d(x, 256, use_norm, norm=norm, data_format=df)
+            x = self_attn_block(x, 256, data_format=df, chunk_size=self_attn_chunk_size) if use_self_attn else x
             activ_map_size = activ_map_size//2
+        if fade_in is not None and skip is not None:
+            x = fade_in_block(x, AveragePooling2D(data_format=df)(skip), fade_in)
             
-        out = Conv2D(1, kernel_size=4, use_bias=False, padding="same")(x) # use_bias should be True  
+        out = Conv2D(1, kernel_size=4, use_bias=False, padding="same", data_format=df)(x) # use_bias should be True  
+        out = from_data_format(out, df)
         return Model(inputs=[inp], outputs=out)
     
     @staticmethod
-    def define_variables(netG):
+    def define_variables(netG, function=K.function, suffix=""):
+        """
+        function: K.function or TimelineProfiler.function, path functions are named e.g. f"path_abgr{suffix}"
+        """
         distorted_input = netG.inputs[0]
         layout = netG.inputs[1]
         fake_output = netG.outputs[-1]
@@ -237,98 +417,173 @@ class FaceswapGANModel():
 
         masked_fake_output = alpha * bgr + (1-alpha) * distorted_input 
 
-        fn_generate = K.function([distorted_input, layout], [masked_fake_output])
-        fn_mask = K.function([distorted_input, layout], [concatenate([alpha, alpha, alpha])])
-        fn_abgr = K.function([distorted_input, layout], [concatenate([alpha, bgr])])
-        fn_bgr = K.function([distorted_input, layout], [bgr])
+        fn_generate = function([distorted_input, layout], [masked_fake_output], name=f"path{suffix}")
+        fn_mask = function([distorted_input, layout], [concatenate([alpha, alpha, alpha])], name=f"path_mask{suffix}")
+        fn_abgr = function([distorted_input, layout], [concatenate([alpha, bgr])], name=f"path_abgr{suffix}")
+        fn_bgr = function([distorted_input, layout], [bgr], name=f"path_bgr{suffix}")
         return distorted_input, layout, fake_output, alpha, fn_generate, fn_mask, fn_abgr, fn_bgr 
     
+    def define_target_pyramid(self, netG):
+        """
+        Placeholders for the loader-supplied target pyramid (see DataLoader(use_target_pyramid=True)):
+        one target image per intermediate decoder output, followed by the eye mask for edge loss.
+        """
+        pyramid = [Input(shape=out.get_shape().as_list()[1:]) for out in netG.outputs[:-1]]
+        pyramid.append(Input(shape=(self.IMAGE_SHAPE[0]-1, self.IMAGE_SHAPE[1]-1, self.IMAGE_SHAPE[2])))
+        return pyramid
+    
     def build_train_functions(self, loss_weights=None, **loss_config):
+        """
+        Build netDA_train, netGA_train, netDB_train and netGB_train.
+        
+        If loss_config['fine_tune_side'] is "A" or "B", the encoder and the other side are frozen:
+        only the decoder and discriminator of the chosen side are trained, and the training functions 
+        (and loss graphs) of the other side are not built (set to None).
+        """
         assert loss_weights is not None, "loss weights are not provided."
+        if self.mode == "inference":
+            raise ValueError("Training functions cannot be built in inference mode.")
+        self.loss_weights = loss_weights
+        self.loss_config = loss_config
+        self.encoder_frozen = self.num_G_updates < self.freeze_encoder_iters
+        fine_tune_side = loss_config.get('fine_tune_side', None)
+        if fine_tune_side not in [None, "A", "B"]:
+            raise ValueError(f"fine_tune_side should be either None, A or B, recieved {fine_tune_side}.")
+        # A frozen (warm-started) encoder is gated instead of excluded, so that it is unfrozen without rebuilding
+        K.set_value(self.encoder_gate, 0. if self.encoder_frozen else 1.)
+        frozen_weights = self.encoder.trainable_weights if fine_tune_side else []
+        gated_weights = [] if fine_tune_side else self.encoder.trainable_weights
+        
+        self.optimizers = []
+        self.netDA_train = self.netGA_train = self.netDB_train = self.netGB_train = None
+        self.target_pyramid_A = self.target_pyramid_B = []
+        with jit_scope(self.use_xla_jit):
+            if fine_tune_side in [None, "A"]:
+                self.netDA_train, self.netGA_train, self.target_pyramid_A = self.build_side_train_functions(
+                    self.netGA, self.netDA, self.real_A, self.distorted_A, self.layout_A, self.mask_eyes_A, 
+                    self.fake_A, self.mask_A, loss_weights, loss_config, 
+                    netG_cyclic=self.netGB, frozen_weights=frozen_weights, gated_weights=gated_weights, side="A")
+            if fine_tune_side in [None, "B"]:
+                self.netDB_train, self.netGB_train, self.target_pyramid_B = self.build_side_train_functions(
+                    self.netGB, self.netDB, self.real_B, self.distorted_B, self.layout_B, self.mask_eyes_B, 
+                    self.fake_B, self.mask_B, loss_weights, loss_config, 
+                    netG_cyclic=self.netGA, frozen_weights=frozen_weights, gated_weights=gated_weights, side="B")
+    
+    def build_side_train_functions(self, netG, netD, real, distorted, layout, mask_eyes, fake, mask, 
+                                   loss_weights, loss_config, netG_cyclic=None, frozen_weights=[], gated_weights=[],
+                                   side=""):
+        """
+        Build the discriminator and generator training functions of one side (identity).
+        
+        Arguments:
+            netG, netD: generator and discriminator of this side
+            real, distorted, layout, mask_eyes: input placeholders of this side
+            fake, mask: generator output (ABGR) and its alpha mask, see define_variables()
+            netG_cyclic: generator of the other side, required by cycle consistency loss
+            frozen_weights: weights excluded from the generator update, e.g. encoder weights
+            gated_weights: weights whose generator gradients are multiplied by self.encoder_gate
+            side: string, training functions are named f"netD{side}_train" and f"netG{side}_train" (see profile_next_calls)
+        
+        Returns:
+            netD_train, netG_train: K.functions
+            target_pyramid: list of placeholders of the loader-supplied target pyramid (empty if not used)
+        """
+        if loss_config.get('use_target_pyramid', False):
+            target_pyramid = self.define_target_pyramid(netG)
+            real_pyramid, mask_eyes_edge = target_pyramid[:-1], target_pyramid[-1]
+        else:
+            target_pyramid = []
+            real_pyramid = mask_eyes_edge = None
+            
+        # Tensors derived from the generator outputs are built once and shared by all loss terms
+        ctx = GeneratorOutputContext(real, fake, distorted, mask_eyes, netG.outputs, real_pyramid, mask_eyes_edge)
+        
         # Adversarial loss
-        loss_DA, loss_adv_GA = adversarial_loss(self.netDA, self.real_A, self.fake_A, 
-                                                self.distorted_A, 
-                                                loss_config["gan_training"], 
-                                                **loss_weights)
-        loss_DB, loss_adv_GB = adversarial_loss(self.netDB, self.real_B, self.fake_B, 
-                                                self.distorted_B, 
-                                                loss_config["gan_training"], 
-                                                **loss_weights)
+        loss_D, loss_adv_G = adversarial_loss(netD, ctx, loss_config["gan_training"], **loss_weights)
 
         # Reconstruction loss
-        loss_recon_GA = reconstruction_loss(self.real_A, self.fake_A, 
-                                            self.mask_eyes_A, self.netGA.outputs,
-                                            **loss_weights)
-        loss_recon_GB = reconstruction_loss(self.real_B, self.fake_B, 
-                                            self.mask_eyes_B, self.netGB.outputs,
-                                            **loss_weights)
+        loss_recon_G = reconstruction_loss(ctx, **loss_weights)
 
         # Edge loss
-        loss_edge_GA = edge_loss(self.real_A, self.fake_A, self.mask_eyes_A, **loss_weights)
-        loss_edge_GB = edge_loss(self.real_B, self.fake_B, self.mask_eyes_B, **loss_weights)
+        loss_edge_G = edge_loss(ctx, **loss_weights)
 
         if loss_config['use_PL']:
-            loss_pl_GA = perceptual_loss(self.real_A, self.fake_A, self.distorted_A, 
-                                         self.mask_eyes_A, self.vggface_feats, **loss_weights)
-            loss_pl_GB = perceptual_loss(self.real_B, self.fake_B, self.distorted_B, 
-                                         self.mask_eyes_B, self.vggface_feats, **loss_weights)
+            loss_pl_G = perceptual_loss(ctx, self.vggface_feats, **loss_weights)
         else:
-            loss_pl_GA = loss_pl_GB = K.zeros(1)
+            loss_pl_G = K.zeros(1)
 
-        loss_GA = loss_adv_GA + loss_recon_GA + loss_edge_GA + loss_pl_GA
-        loss_GB = loss_adv_GB + loss_recon_GB + loss_edge_GB + loss_pl_GB
+        loss_G = loss_adv_G + loss_recon_G + loss_edge_G + loss_pl_G
 
         # The following losses are rather trivial, thus their wegihts are fixed.
         # Cycle consistency loss
         if loss_config['use_cyclic_loss']:
-            loss_GA += 10 * cyclic_loss(self.netGA, self.netGB, self.real_A, self.layout_A)
-            loss_GB += 10 * cyclic_loss(self.netGB, self.netGA, self.real_B, self.layout_B)
+            if netG_cyclic is None:
+                raise ValueError("Cycle consistency loss requires the generator of the other side.")
+            loss_G += 10 * cyclic_loss(netG, netG_cyclic, real, layout)
 
         # Alpha mask loss
         if not loss_config['use_mask_hinge_loss']:
-            loss_GA += 1e-2 * K.mean(K.abs(self.mask_A))
-            loss_GB += 1e-2 * K.mean(K.abs(self.mask_B))
+            loss_G += 1e-2 * K.mean(K.abs(mask))
         else:
-            loss_GA += 0.1 * K.mean(K.maximum(0., loss_config['m_mask'] - self.mask_A))
-            loss_GB += 0.1 * K.mean(K.maximum(0., loss_config['m_mask'] - self.mask_B))
+            loss_G += 0.1 * K.mean(K.maximum(0., loss_config['m_mask'] - mask))
 
         # Alpha mask total variation loss
-        loss_GA += 0.1 * K.mean(first_order(self.mask_A, axis=1))
-        loss_GA += 0.1 * K.mean(first_order(self.mask_A, axis=2))
-        loss_GB += 0.1 * K.mean(first_order(self.mask_B, axis=1))
-        loss_GB += 0.1 * K.mean(first_order(self.mask_B, axis=2))
+        loss_G += 0.1 * K.mean(first_order(mask, axis=1))
+        loss_G += 0.1 * K.mean(first_order(mask, axis=2))
 
         # L2 weight decay
         # https://github.com/keras-team/keras/issues/2662
-        for loss_tensor in self.netGA.losses:
-            loss_GA += loss_tensor
-        for loss_tensor in self.netGB.losses:
-            loss_GB += loss_tensor
-        for loss_tensor in self.netDA.losses:
-            loss_DA += loss_tensor
-        for loss_tensor in self.netDB.losses:
-            loss_DB += loss_tensor
+        for loss_tensor in netG.losses:
+            loss_G += loss_tensor
+        for loss_tensor in netD.losses:
+            loss_D += loss_tensor
 
-        weightsDA = self.netDA.trainable_weights
-        weightsGA = self.netGA.trainable_weights
-        weightsDB = self.netDB.trainable_weights
-        weightsGB = self.netGB.trainable_weights
+        weightsD = netD.trainable_weights
+        weightsG = netG.trainable_weights
+        if frozen_weights:
+            frozen = set(id(w) for w in frozen_weights)
+            weightsG = [w for w in weightsG if id(w) not in frozen]
 
         # Define training functions
         # Adam(...).get_updates(...)
-        training_updates = Adam(lr=self.lrD*loss_config['lr_factor'], beta_1=0.5).get_updates(weightsDA,[],loss_DA)
-        self.netDA_train = K.function([self.distorted_A, self.real_A, self.layout_A],[loss_DA], training_updates)
-        training_updates = Adam(lr=self.lrG*loss_config['lr_factor'], beta_1=0.5).get_updates(weightsGA,[], loss_GA)
-        self.netGA_train = K.function([self.distorted_A, self.real_A, self.mask_eyes_A, self.layout_A], 
-                                      [loss_GA, loss_adv_GA, loss_recon_GA, loss_edge_GA, loss_pl_GA], 
-                                      training_updates)
-
-        training_updates = Adam(lr=self.lrD*loss_config['lr_factor'], beta_1=0.5).get_updates(weightsDB,[],loss_DB)
-        self.netDB_train = K.function([self.distorted_B, self.real_B, self.layout_B],[loss_DB], training_updates)
-        training_updates = Adam(lr=self.lrG*loss_config['lr_factor'], beta_1=0.5).get_updates(weightsGB,[], loss_GB)
-        self.netGB_train = K.function([self.distorted_B, self.real_B, self.mask_eyes_B, self.layout_B], 
-                                      [loss_GB, loss_adv_GB, loss_recon_GB, loss_edge_GB, loss_pl_GB], 
-                                      training_updates)
+        optD = Adam(lr=self.lrD*loss_config['lr_factor'], beta_1=0.5)
+        optG = Adam(lr=self.lrG*loss_config['lr_factor'], beta_1=0.5)
+        if gated_weights:
+            gate_gradients(optG, gated_weights, self.encoder_gate)
+        self.optimizers += [(optD, self.lrD), (optG, self.lrG)]
+        training_updates = optD.get_updates(weightsD,[],loss_D)
+        netD_train = self.profiler.function([distorted, real, layout],[loss_D], training_updates, 
+                                            name=f"netD{side}_train")
+        training_updates = optG.get_updates(weightsG,[], loss_G)
+        netG_train = self.profiler.function([distorted, real, mask_eyes, layout] + target_pyramid, 
+                                            [loss_G, loss_adv_G, loss_recon_G, loss_edge_G, loss_pl_G], 
+                                            training_updates, name=f"netG{side}_train")
+        return netD_train, netG_train, target_pyramid
+    
+    def set_lr_factor(self, lr_factor):
+        """
+        Scale learning rates of the built training functions in place, i.e. without rebuilding them 
+        and resetting optimizer states. The new factor is kept for later rebuilds.
+        """
+        for opt, base_lr in self.optimizers:
+            K.set_value(opt.lr, base_lr*lr_factor)
+        self.loss_config['lr_factor'] = lr_factor
+    
+    def set_fade_in(self, value):
+        """
+        Set the blending factor of the newest stage (0: previous stage only, 1: new stage only).
+        """
+        if self.fade_in is None:
+            raise ValueError("Model is not built with arch_config['use_fade_in'] = True.")
+        K.set_value(self.fade_in, float(min(max(value, 0.), 1.)))
+    
+    def profile_next_calls(self, num_calls=1, names=None, log_dir=None):
+        """
+        Run the next num_calls calls of the given K.functions (e.g. ["netGA_train", "path_abgr_B"]) 
+        with full trace RunOptions. All functions are traced if names is None.
+        Timelines and op-type summaries are written to log_dir.
+        """
+        self.profiler.enable(num_calls, names, log_dir)
     
     def build_pl_model(self, vggface_model, before_activ=False):
         # Define Perceptual Loss Model
@@ -343,57 +598,192 @@ class FaceswapGANModel():
             out_size55 = vggface_model.layers[35].output
             out_size28 = vggface_model.layers[77].output
             out_size7 = vggface_model.layers[-3].output
-        self.vggface_feats = Model(vggface_model.input, [out_size112, out_size55, out_size28, out_size7])
+        # BatchNormalization layers of the frozen VGGFace use their moving statistics, also in the training phase.
+        # Otherwise real and fake features of the batched pass in perceptual_loss would be normalized with the
+        # statistics of the mixed batch. vggface_model itself is not modified.
+        self.vggface_feats = inference_mode_model(vggface_model, [out_size112, out_size55, out_size28, out_size7])
         self.vggface_feats.trainable = False
     
-    def load_weights(self, path="./models"):
-        try:
-            self.encoder.load_weights(f"{path}/encoder.h5")
-            self.decoder_A.load_weights(f"{path}/decoder_A.h5")
-            self.decoder_B.load_weights(f"{path}/decoder_B.h5")
-            self.netDA.load_weights(f"{path}/netDA.h5") 
-            self.netDB.load_weights(f"{path}/netDB.h5") 
-            print ("Model weights files are successfully loaded.")
-        except:
-            print ("Error occurs during loading weights files.")
-            pass
+    def load_weights(self, path="./models", subnetworks=None):
+        """
+        Load the weights of subnetworks (default: all built sub-networks) from path, e.g. ["encoder", "decoder_B"]
+        for AtoB conversion. The consolidated checkpoint is used if path has one, otherwise the per-network .h5 files.
+        If path has no weights at all, networks keep their random initialization (new model).
+        
+        Raises:
+            IOError: weights of some requested sub-networks are missing
+            ValueError: the weights do not match arch_config or the networks
+        """
+        subnetworks = self.requested_subnetworks(subnetworks)
+        if Path(f"{path}/{CHECKPOINT_FILENAME}").exists():
+            self.load_checkpoint(f"{path}/{CHECKPOINT_FILENAME}", subnetworks)
+            return
+        fns = {name: f"{path}/{name}.h5" for name in subnetworks}
+        missing = [fn for fn in fns.values() if not Path(fn).exists()]
+        if len(missing) == len(fns):
+            print (f"No weights files found in {path}. Networks are randomly initialized.")
+            return
+        if missing:
+            raise IOError(f"Weights files {', '.join(missing)} not found.")
+        self.check_arch_compatibility(path)
+        for name, fn in fns.items():
+            self.get_subnetwork(name).load_weights(fn)
+        print (f"Weights of {', '.join(subnetworks)} are loaded from {path}.")
+    
+    def get_subnetwork(self, name):
+        return getattr(self, name)
+    
+    def requested_subnetworks(self, subnetworks=None):
+        subnetworks = list(self.subnetworks if subnetworks is None else subnetworks)
+        unknown = [name for name in subnetworks if name not in self.subnetworks]
+        if unknown:
+            raise ValueError(f"Sub-networks {unknown} are not built, should be in {self.subnetworks}.")
+        return subnetworks
+    
+    def save_weights(self, path="./models", legacy_files=True):
+        """
+        Save the consolidated checkpoint to path, and the per-network .h5 files and arch_config.json
+        if legacy_files is True (read by older code and by e.g. decoder_A.load_weights("models/decoder_B.h5")).
+        """
+        Path(path).mkdir(parents=True, exist_ok=True)
+        self.save_checkpoint(f"{path}/{CHECKPOINT_FILENAME}")
+        if legacy_files:
+            for name in self.subnetworks:
+                self.get_subnetwork(name).save_weights(f"{path}/{name}.h5")
+            with open(f"{path}/arch_config.json", "w") as f:
+                json.dump(get_arch_config(self.arch_config), f)
+        print (f"Model weights files have been saved to {path}.")
+    
+    def save_checkpoint(self, fn):
+        """
+        Write every built sub-network to a single HDF5 file. The file is written next to fn and then renamed,
+        so conversion workers never read a partially written checkpoint.
+        """
+        tmp_fn = f"{fn}.tmp"
+        with h5py.File(tmp_fn, "w") as f:
+            f.attrs["format_version"] = CHECKPOINT_VERSION
+            f.attrs["arch_config"] = json.dumps(get_arch_config(self.arch_config))
+            f.attrs["subnetworks"] = json.dumps(self.subnetworks)
+            for name in self.subnetworks:
+                save_weights_to_hdf5_group(f.create_group(name), self.get_subnetwork(name).layers)
+        os.replace(tmp_fn, fn)
     
-    def save_weights(self, path="./models"):
-        try:
-            self.encoder.save_weights(f"{path}/encoder.h5")
-            self.decoder_A.save_weights(f"{path}/decoder_A.h5")
-            self.decoder_B.save_weights(f"{path}/decoder_B.h5")
-            self.netDA.save_weights(f"{path}/netDA.h5") 
-            self.netDB.save_weights(f"{path}/netDB.h5") 
-            print (f"Model weights files have been saved to {path}.")
-        except:
-            print ("Error occurs during saving weights.")
-            pass
+    def load_checkpoint(self, fn, subnetworks=None):
+        """
+        Load subnetworks (default: all built sub-networks) from a consolidated checkpoint. Only the index and the groups of the
+        requested sub-networks are read from disk, e.g. discriminator weights are skipped by conversion jobs.
+        """
+        subnetworks = self.requested_subnetworks(subnetworks)
+        if not Path(fn).exists():
+            raise IOError(f"Checkpoint {fn} not found.")
+        with h5py.File(fn, "r") as f:
+            index = read_checkpoint_index(f, fn)
+            mismatches = self.arch_mismatches(index["arch_config"])
+            if mismatches:
+                raise ValueError(f"Checkpoint {fn} is incompatible with arch_config. " + "; ".join(mismatches))
+            missing = [name for name in subnetworks if name not in index["subnetworks"]]
+            if missing:
+                raise ValueError(f"Sub-networks {missing} are not in checkpoint {fn} (has {index['subnetworks']}).")
+            for name in subnetworks:
+                try:
+                    load_weights_from_hdf5_group(f[name], self.get_subnetwork(name).layers)
+                except ValueError as e:
+                    raise ValueError(f"Weights of {name} in {fn} do not match the network: {e}")
+        print (f"Weights of {', '.join(subnetworks)} are loaded from {fn}.")
         
-    def train_one_batch_G(self, data_A, data_B):
-        if len(data_A) == 5 and len(data_B) == 5:
-            _, warped_A, target_A, bm_eyes_A, layout_A = data_A
-            _, warped_B, target_B, bm_eyes_B, layout_B = data_B
-        elif len(data_A) == 4 and len(data_B) == 4:
-            warped_A, target_A, bm_eyes_A, layout_A = data_A
-            warped_B, target_B, bm_eyes_B, layout_B = data_B
+    def arch_mismatches(self, saved_config):
+        mismatches = []
+        current_config = get_arch_config(self.arch_config)
+        for k in ARCH_KEYS:
+            saved, current = saved_config.get(k, ARCH_DEFAULTS.get(k)), current_config[k]
+            if k == 'IMAGE_SHAPE':
+                saved, current = list(saved), list(current)
+            if saved != current:
+                mismatches.append(f"{k}: saved {saved}, current {current}")
+        return mismatches
+        
+    def check_arch_compatibility(self, path):
+        """
+        Compare arch_config.json saved along with the weights files in path against self.arch_config.
+        """
+        fn = f"{path}/arch_config.json"
+        if not Path(fn).exists():
+            print (f"{fn} not found. Skip architecture compatibility check.")
+            return
+        with open(fn, "r") as f:
+            saved_config = json.load(f)
+        mismatches = self.arch_mismatches(saved_config)
+        if mismatches:
+            raise ValueError(f"Pretrained weights in {path} are incompatible with arch_config. " + "; ".join(mismatches))
+    
+    def load_pretrained_encoder(self, path, load_decoders=False, freeze_encoder_iters=0):
+        """
+        Warm start a new model from a previously trained encoder (and optionally generic decoder_A/B).
+        Discriminators are trained from scratch.
+        
+        Arguments:
+            path: directory of the pretrained weights files or consolidated checkpoint
+            load_decoders: bool, also initialize decoder_A and decoder_B from path
+            freeze_encoder_iters: int, zero the encoder gradients of generator updates for this many 
+                                  train_one_batch_G() calls (see encoder_gate). Training functions and 
+                                  optimizer states are kept when the encoder is unfrozen.
+        """
+        names = ["encoder", "decoder_A", "decoder_B"] if load_decoders else ["encoder"]
+        if not (Path(f"{path}/{CHECKPOINT_FILENAME}").exists() or Path(f"{path}/encoder.h5").exists()):
+            raise IOError(f"Pretrained weights not found in {path}.")
+        self.load_weights(path, subnetworks=names)
+        self.freeze_encoder(freeze_encoder_iters)
+        print (f"Pretrained weights of {', '.join(names)} are loaded from {path}.")
+    
+    def freeze_encoder(self, num_iters):
+        """
+        Zero the encoder gradients of the next num_iters train_one_batch_G() calls. Takes effect immediately,
+        whether or not the training functions are already built.
+        """
+        self.freeze_encoder_iters = num_iters
+        self.num_G_updates = 0
+        self.encoder_frozen = num_iters > 0
+        K.set_value(self.encoder_gate, 0. if self.encoder_frozen else 1.)
+    
+    def unpack_batch(self, data):
+        """
+        Return [warped, target, bm_eyes, layout] followed by the target pyramid (if used) of a loader batch.
+        """
+        num_pyramid = max(len(self.target_pyramid_A), len(self.target_pyramid_B))
+        if len(data) == 5 + num_pyramid:
+            return list(data[1:])
+        elif len(data) == 4 + num_pyramid:
+            return list(data)
         else:
             raise ValueError("Something's wrong with the input data generator.")
-        errGA = self.netGA_train([warped_A, target_A, bm_eyes_A, layout_A])
-        errGB = self.netGB_train([warped_B, target_B, bm_eyes_B, layout_B])        
+        
+    def train_one_batch_G(self, data_A, data_B):
+        """
+        Sides whose training functions are not built (fine-tune mode) are skipped and return None.
+        data_A/data_B of a skipped side can be None.
+        """
+        errGA = errGB = None
+        if self.netGA_train is not None:
+            warped_A, target_A, bm_eyes_A, layout_A, *pyramid_A = self.unpack_batch(data_A)
+            errGA = self.netGA_train([warped_A, target_A, bm_eyes_A, layout_A] + pyramid_A)
+        if self.netGB_train is not None:
+            warped_B, target_B, bm_eyes_B, layout_B, *pyramid_B = self.unpack_batch(data_B)
+            errGB = self.netGB_train([warped_B, target_B, bm_eyes_B, layout_B] + pyramid_B)        
+        self.num_G_updates += 1
+        if self.encoder_frozen and self.num_G_updates >= self.freeze_encoder_iters:
+            print ("Unfreezing encoder.")
+            self.encoder_frozen = False
+            K.set_value(self.encoder_gate, 1.)
         return errGA, errGB
     
     def train_one_batch_D(self, data_A, data_B):
-        if len(data_A) == 5 and len(data_B) == 5:
-            _, warped_A, target_A, _, layout_A = data_A
-            _, warped_B, target_B, _, layout_B  = data_B
-        elif len(data_A) == 4 and len(data_B) == 4:
-            warped_A, target_A, _, layout_A  = data_A
-            warped_B, target_B, _, layout_B  = data_B
-        else:
-            raise ValueError("Something's wrong with the input data generator.")
-        errDA = self.netDA_train([warped_A, target_A, layout_A])
-        errDB = self.netDB_train([warped_B, target_B, layout_B])
+        errDA = errDB = None
+        if self.netDA_train is not None:
+            warped_A, target_A, _, layout_A, *_ = self.unpack_batch(data_A)
+            errDA = self.netDA_train([warped_A, target_A, layout_A])
+        if self.netDB_train is not None:
+            warped_B, target_B, _, layout_B, *_ = self.unpack_batch(data_B)
+            errDB = self.netDB_train([warped_B, target_B, layout_B])
         return errDA, errDB
     
     def transform_A2B(self, img):
@@ -1,4 +1,5 @@
-from keras.layers import Lambda, concatenate
+from keras.layers import Input, InputLayer, Lambda, BatchNormalization, concatenate
+from keras.models import Model
 from tensorflow.contrib.distributions import Beta
 from .instance_normalization import InstanceNormalization
 import keras.backend as K
@@ -35,32 +36,113 @@ def cyclic_loss(netG1, netG2, real1, layout1):
     loss += 0.1 * calc_loss(cyclic1_alpha, fake2_alpha, loss='l1')
     return loss
 
-def adversarial_loss(netD, real, fake_abgr, distorted, gan_training="mixup_LSGAN", **weights):   
-    alpha = Lambda(lambda x: x[:,:,:, :1])(fake_abgr)
-    fake_bgr = Lambda(lambda x: x[:,:,:, 1:])(fake_abgr)
-    fake = alpha * fake_bgr + (1-alpha) * distorted
+class GeneratorOutputContext():
+    """
+    Tensors derived from one generator output that are shared by every loss term,
+    so that each of them is built only once in the graph.
+    
+    Attributes:
+        real, distorted, mask_eyes: target image, generator input and binary mask of eyes
+        fake_abgr: generator output (alpha + BGR)
+        model_outputs: all decoder outputs, i.e. intermediate outputs followed by fake_abgr
+        real_pyramid, mask_eyes_edge: optional loader-supplied targets (see DataLoader(use_target_pyramid=True))
+        alpha, fake_bgr: alpha mask and BGR image sliced from fake_abgr
+        fake: alpha composite of fake_bgr over distorted
+        edges_fake, edges_real: first order gradients (axis=1, axis=2) of fake_bgr and real
+    """
+    def __init__(self, real, fake_abgr, distorted, mask_eyes, model_outputs, 
+                 real_pyramid=None, mask_eyes_edge=None):
+        self.real = real
+        self.fake_abgr = fake_abgr
+        self.distorted = distorted
+        self.mask_eyes = mask_eyes
+        self.model_outputs = model_outputs
+        self.real_pyramid = real_pyramid
+        self.mask_eyes_edge = mask_eyes_edge
+        
+        self.alpha = Lambda(lambda x: x[:,:,:, :1])(fake_abgr)
+        self.fake_bgr = Lambda(lambda x: x[:,:,:, 1:])(fake_abgr)
+        self.fake = self.alpha * self.fake_bgr + (1-self.alpha) * distorted
+        self.edges_fake = [first_order(self.fake_bgr, axis=1), first_order(self.fake_bgr, axis=2)]
+        self.edges_real = [first_order(real, axis=1), first_order(real, axis=2)]
+
+def has_batchnorm(model):
+    return any(isinstance(layer, BatchNormalization) or (isinstance(layer, Model) and has_batchnorm(layer))
+               for layer in model.layers)
+
+def inference_mode_model(model, outputs=None):
+    """
+    A new Model that shares the layers (and weights) of model, from new inputs to outputs (default: model.outputs),
+    in which BatchNormalization layers always use their moving statistics, whatever the learning phase.
+    model and its layers are left unchanged. outputs can be any tensors of the graph of model.
+    """
+    # Keras >= 2.2 made this attribute private (nodes_by_depth in Keras 2.1.5)
+    nodes_by_depth = getattr(model, "_nodes_by_depth", None)
+    if nodes_by_depth is None:
+        nodes_by_depth = model.nodes_by_depth
+    inputs = [Input(batch_shape=K.int_shape(x)) for x in model.inputs]
+    tensor_map = {id(x): y for x, y in zip(model.inputs, inputs)}
+    for depth in sorted(nodes_by_depth, reverse=True):
+        for node in nodes_by_depth[depth]:
+            layer = node.outbound_layer
+            if isinstance(layer, InputLayer):
+                continue
+            kwargs = dict(node.arguments or {})
+            if isinstance(layer, BatchNormalization):
+                kwargs['training'] = False
+            elif isinstance(layer, Model) and has_batchnorm(layer):
+                layer = inference_mode_model(layer)
+            xs = [tensor_map[id(x)] for x in node.input_tensors]
+            ys = layer(xs[0] if len(xs) == 1 else xs, **kwargs)
+            ys = ys if isinstance(ys, list) else [ys]
+            tensor_map.update({id(x): y for x, y in zip(node.output_tensors, ys)})
+    outputs = model.outputs if outputs is None else outputs
+    return Model(inputs, [tensor_map[id(x)] for x in outputs])
+
+def batched_netD(netD, inputs):
+    """
+    Run netD once on inputs stacked along the batch axis and split the predictions back.
+    All inputs should have the same batch size.
+    
+    Stacking is only exact for per-sample normalization (norm = instancenorm, groupnorm or none).
+    BatchNormalization would compute its statistics over the stacked batch, so netD with
+    BatchNormalization (norm = batchnorm) runs separately on every input.
+    """
+    if has_batchnorm(netD):
+        return [netD(x) for x in inputs]
+    batch_size = K.shape(inputs[0])[0]
+    preds = netD(concatenate(inputs, axis=0))
+    return [preds[i*batch_size:(i+1)*batch_size] for i in range(len(inputs))]
+
+def adversarial_loss(netD, ctx, gan_training="mixup_LSGAN", **weights):   
+    real, distorted, fake, fake_bgr = ctx.real, ctx.distorted, ctx.fake, ctx.fake_bgr
+    real_distorted = concatenate([real, distorted])
+    fake_distorted = concatenate([fake, distorted])
+    fake_bgr_distorted = concatenate([fake_bgr, distorted])
     
     if gan_training == "mixup_LSGAN":
         dist = Beta(0.2, 0.2)
         lam = dist.sample()
-        mixup = lam * concatenate([real, distorted]) + (1 - lam) * concatenate([fake, distorted])     
-        pred_fake = netD(concatenate([fake, distorted]))
-        pred_mixup = netD(mixup)
+        mixup = lam * real_distorted + (1 - lam) * fake_distorted
+        mixup2 = lam * real_distorted + (1 - lam) * fake_bgr_distorted
+        pred_fake, pred_mixup, pred_fake_bgr, pred_mixup2 = batched_netD(netD, [
+            fake_distorted, 
+            mixup, 
+            fake_bgr_distorted, 
+            mixup2])
         loss_D = calc_loss(pred_mixup, lam * K.ones_like(pred_mixup), "l2")
         loss_G = weights['w_D'] * calc_loss(pred_fake, K.ones_like(pred_fake), "l2")
-        mixup2 = lam * concatenate([real, distorted]) + (1 - lam) * concatenate([fake_bgr, distorted])
-        pred_fake_bgr = netD(concatenate([fake_bgr, distorted]))
-        pred_mixup2 = netD(mixup2)
         loss_D += calc_loss(pred_mixup2, lam * K.ones_like(pred_mixup2), "l2")
         loss_G += weights['w_D'] * calc_loss(pred_fake_bgr, K.ones_like(pred_fake_bgr), "l2")
     elif gan_training == "relativistic_avg_LSGAN":
-        real_pred = netD(concatenate([real, distorted]))
-        fake_pred = netD(concatenate([fake, distorted]))
+        real_pred, fake_pred, fake_pred2 = batched_netD(netD, [
+            real_distorted, 
+            fake_distorted, 
+            fake_bgr_distorted])
         loss_D = K.mean(K.square(real_pred - K.ones_like(fake_pred)))/2
         loss_D += K.mean(K.square(fake_pred - K.zeros_like(fake_pred)))/2 
         loss_G = weights['w_D'] * K.mean(K.square(fake_pred - K.ones_like(fake_pred)))
         
-        fake_pred2 = netD(concatenate([fake_bgr, distorted]))
         loss_D += K.mean(K.square(real_pred - K.mean(fake_pred2,axis=0) - K.ones_like(fake_pred2)))/2
         loss_D += K.mean(K.square(fake_pred2 - K.mean(real_pred,axis=0) - K.zeros_like(fake_pred2)))/2
         loss_G += weights['w_D'] * K.mean(K.square(real_pred - K.mean(fake_pred2,axis=0) - K.zeros_like(fake_pred2)))/2 
@@ -69,54 +151,60 @@ def adversarial_loss(netD, real, fake_abgr, distorted, gan_training="mixup_LSGAN
         raise ValueError("Receive an unknown GAN training method: {gan_training}")
     return loss_D, loss_G
 
-def reconstruction_loss(real, fake_abgr, mask_eyes, model_outputs, **weights):
-    alpha = Lambda(lambda x: x[:,:,:, :1])(fake_abgr)
-    fake_bgr = Lambda(lambda x: x[:,:,:, 1:])(fake_abgr)
+def reconstruction_loss(ctx, **weights):
+    real, fake_bgr, mask_eyes = ctx.real, ctx.fake_bgr, ctx.mask_eyes
     
     loss_G = 0
     loss_G += weights['w_recon'] * calc_loss(fake_bgr, real, "l1")
     loss_G += weights['w_eyes'] * K.mean(K.abs(mask_eyes*(fake_bgr - real)))    
     
-    for out in model_outputs[:-1]:
-        out_size = out.get_shape().as_list()
-        resized_real = tf.image.resize_images(real, out_size[1:3])
+    for i, out in enumerate(ctx.model_outputs[:-1]):
+        if ctx.real_pyramid is None:
+            out_size = out.get_shape().as_list()
+            resized_real = tf.image.resize_images(real, out_size[1:3])
+        else:
+            resized_real = ctx.real_pyramid[i]
         loss_G += weights['w_recon'] * calc_loss(out, resized_real, "l1")    
     return loss_G
 
-def edge_loss(real, fake_abgr, mask_eyes, **weights):
-    alpha = Lambda(lambda x: x[:,:,:, :1])(fake_abgr)
-    fake_bgr = Lambda(lambda x: x[:,:,:, 1:])(fake_abgr)
+def edge_loss(ctx, **weights):
+    edge_fake_x, edge_fake_y = ctx.edges_fake
+    edge_real_x, edge_real_y = ctx.edges_real
     
     loss_G = 0
-    loss_G += weights['w_edge'] * calc_loss(first_order(fake_bgr, axis=1), first_order(real, axis=1), "l1")  
-    loss_G += weights['w_edge'] * calc_loss(first_order(fake_bgr, axis=2), first_order(real, axis=2), "l1") 
-    shape_mask_eyes = mask_eyes.get_shape().as_list()
-    resized_mask_eyes = tf.image.resize_images(mask_eyes, [shape_mask_eyes[1]-1, shape_mask_eyes[2]-1]) 
-    loss_G += weights['w_eyes'] * K.mean(K.abs(resized_mask_eyes * \
-                                               (first_order(fake_bgr, axis=1) - first_order(real, axis=1))))
-    loss_G += weights['w_eyes'] * K.mean(K.abs(resized_mask_eyes * \
-                                               (first_order(fake_bgr, axis=2) - first_order(real, axis=2)))) 
+    loss_G += weights['w_edge'] * calc_loss(edge_fake_x, edge_real_x, "l1")  
+    loss_G += weights['w_edge'] * calc_loss(edge_fake_y, edge_real_y, "l1") 
+    if ctx.mask_eyes_edge is None:
+        shape_mask_eyes = ctx.mask_eyes.get_shape().as_list()
+        resized_mask_eyes = tf.image.resize_images(ctx.mask_eyes, [shape_mask_eyes[1]-1, shape_mask_eyes[2]-1]) 
+    else:
+        resized_mask_eyes = ctx.mask_eyes_edge
+    loss_G += weights['w_eyes'] * K.mean(K.abs(resized_mask_eyes * (edge_fake_x - edge_real_x)))
+    loss_G += weights['w_eyes'] * K.mean(K.abs(resized_mask_eyes * (edge_fake_y - edge_real_y))) 
     return loss_G
     
-def perceptual_loss(real, fake_abgr, distorted, mask_eyes, vggface_feats, **weights): 
-    alpha = Lambda(lambda x: x[:,:,:, :1])(fake_abgr)
-    fake_bgr = Lambda(lambda x: x[:,:,:, 1:])(fake_abgr)
-    fake = alpha * fake_bgr + (1-alpha) * distorted
+def perceptual_loss(ctx, vggface_feats, **weights): 
+    real, fake_bgr, fake = ctx.real, ctx.fake_bgr, ctx.fake
     
     def preprocess_vggface(x):
         x = (x + 1)/2 * 255 # channel order: BGR
         x -= [91.4953, 103.8827, 131.0912]
         return x    
     
-    real_sz224 = tf.image.resize_images(real, [224, 224])
-    real_sz224 = Lambda(preprocess_vggface)(real_sz224)
     dist = Beta(0.2, 0.2)
     lam = dist.sample() # use mixup trick here to reduce foward pass from 2 times to 1.
     mixup = lam*fake_bgr + (1-lam)*fake
-    fake_sz224 = tf.image.resize_images(mixup, [224, 224])
-    fake_sz224 = Lambda(preprocess_vggface)(fake_sz224)
-    real_feat112, real_feat55, real_feat28, real_feat7 = vggface_feats(real_sz224)
-    fake_feat112, fake_feat55, fake_feat28, fake_feat7  = vggface_feats(fake_sz224)
+    
+    # Concatenate real and fake along the batch axis so that VGGFace runs a single forward pass.
+    # This relies on vggface_feats using the moving statistics of BatchNormalization (see inference_mode_model),
+    # so that features of real and fake do not depend on each other.
+    batch_size = K.shape(real)[0]
+    real_fake = concatenate([real, mixup], axis=0)
+    real_fake_sz224 = tf.image.resize_images(real_fake, [224, 224])
+    real_fake_sz224 = Lambda(preprocess_vggface)(real_fake_sz224)
+    feats = vggface_feats(real_fake_sz224)
+    real_feat112, real_feat55, real_feat28, real_feat7 = [feat[:batch_size] for feat in feats]
+    fake_feat112, fake_feat55, fake_feat28, fake_feat7 = [feat[batch_size:] for feat in feats]
     
     # Apply instance norm on VGG(ResNet) features
     # From MUNIT https://github.com/NVlabs/MUNIT
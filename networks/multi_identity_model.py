@@ -0,0 +1,189 @@
+from keras.models import Model
+from keras.layers import *
+import keras.backend as K
+from pathlib import Path
+from .faceswap_gan_model import FaceswapGANModel, CHECKPOINT_FILENAME, read_checkpoint_index, jit_scope
+import h5py
+
+class IdentityPair():
+    """
+    FaceTransformer-compatible view on two identities of a MultiIdentityFaceswapGANModel.
+    direction="AtoB" uses path_abgr_B, i.e. the decoder of identity_B.
+    """
+    def __init__(self, model, identity_A, identity_B):
+        self.path_abgr_A = model.path_abgr[identity_A]
+        self.path_abgr_B = model.path_abgr[identity_B]
+
+class MultiIdentityFaceswapGANModel(FaceswapGANModel):
+    """
+    faceswap-GAN v2.2 model with one shared encoder and N identity decoders (and discriminators).
+
+    Attributes:
+        identities: list of strings, identity names, e.g. ["A", "B", "C"]
+        arch_config: A dictionary that contains architecture configurations (details are described in train notebook).
+        decoders, netDs, netGs: dicts of Keras models keyed by identity
+        subnetworks: list of the names of the sub-networks (encoder, decoder_{identity}, netD_{identity}),
+                     also the names of their weights files and checkpoint groups
+        path, path_mask, path_abgr, path_bgr: dicts of K.functions keyed by identity, see define_variables()
+        netD_train, netG_train: dicts of training functions keyed by identity, see build_train_functions()
+    """
+    def __init__(self, identities, **arch_config):
+        if len(set(identities)) != len(identities) or len(identities) < 2:
+            raise ValueError(f"At least two distinct identities are required, received {identities}.")
+        if arch_config.get('use_fade_in', False):
+            raise ValueError("use_fade_in is not supported by MultiIdentityFaceswapGANModel.")
+        self.identities = list(identities)
+        self.mode = "train"
+        self.direction = None
+        self.subnetworks = ["encoder"] + [f"decoder_{name}" for name in self.identities] \
+                           + [f"netD_{name}" for name in self.identities]
+        self.init_arch_config(arch_config)
+        self.encoder, self.decoders, self.netDs = self.build_networks(
+            decoder_names=self.identities, netD_names=self.identities)
+
+        with jit_scope(self.use_xla_jit):
+            self.netGs = {}
+            for name in self.identities:
+                x = Input(shape=self.IMAGE_SHAPE) # dummy input tensor
+                y = Input(shape=self.IMAGE_SHAPE) # dummy input tensor
+                self.netGs[name] = Model([x, y], self.decoders[name]([self.encoder(x), y]))
+
+            # define variables
+            self.distorted, self.layout, self.fake, self.mask = {}, {}, {}, {}
+            self.path, self.path_mask, self.path_abgr, self.path_bgr = {}, {}, {}, {}
+            self.real, self.mask_eyes, self.target_pyramid = {}, {}, {}
+            for name in self.identities:
+                self.distorted[name], self.layout[name], self.fake[name], self.mask[name], \
+                self.path[name], self.path_mask[name], self.path_abgr[name], self.path_bgr[name] = self.define_variables(
+                    netG=self.netGs[name], function=self.profiler.function, suffix=f"_{name}")
+                self.real[name] = Input(shape=self.IMAGE_SHAPE)
+                self.mask_eyes[name] = Input(shape=self.IMAGE_SHAPE)
+                self.target_pyramid[name] = []
+        self.netD_train = {}
+        self.netG_train = {}
+        self.init_warm_start()
+
+    def build_train_functions(self, loss_weights=None, **loss_config):
+        """
+        Build training functions of every identity.
+        Cycle consistency loss (if used) pairs each identity with the next one in self.identities.
+        """
+        assert loss_weights is not None, "loss weights are not provided."
+        self.loss_weights = loss_weights
+        self.loss_config = loss_config
+        self.encoder_frozen = self.num_G_updates < self.freeze_encoder_iters
+        K.set_value(self.encoder_gate, 0. if self.encoder_frozen else 1.)
+        self.optimizers = []
+
+        for i, name in enumerate(self.identities):
+            partner = self.identities[(i+1) % len(self.identities)]
+            with jit_scope(self.use_xla_jit):
+                netD_train, netG_train, self.target_pyramid[name] = self.build_side_train_functions(
+                    self.netGs[name], self.netDs[name], self.real[name], self.distorted[name], self.layout[name],
+                    self.mask_eyes[name], self.fake[name], self.mask[name], loss_weights, loss_config,
+                    netG_cyclic=self.netGs[partner], gated_weights=self.encoder.trainable_weights, side=name)
+            self.netD_train[name], self.netG_train[name] = netD_train, netG_train
+
+    def schedule(self, iteration, mode="round_robin"):
+        """
+        Identities to be trained at the given iteration.
+
+        Arguments:
+            mode: "round_robin" trains one identity per iteration, "joint" trains all of them.
+        """
+        if mode == "round_robin":
+            return [self.identities[iteration % len(self.identities)]]
+        elif mode == "joint":
+            return list(self.identities)
+        else:
+            raise ValueError(f"mode should be either round_robin or joint, received {mode}.")
+
+    def unpack_batch(self, data):
+        num_pyramid = len(self.target_pyramid[self.identities[0]])
+        if len(data) == 5 + num_pyramid:
+            return list(data[1:])
+        elif len(data) == 4 + num_pyramid:
+            return list(data)
+        else:
+            raise ValueError("Something's wrong with the input data generator.")
+
+    def train_one_batch_G(self, data):
+        """
+        Arguments:
+            data: dict of loader batches keyed by identity, only these identities are updated.
+        """
+        errG = {}
+        for name, batch in data.items():
+            warped, target, bm_eyes, layout, *pyramid = self.unpack_batch(batch)
+            errG[name] = self.netG_train[name]([warped, target, bm_eyes, layout] + pyramid)
+        self.num_G_updates += 1
+        if self.encoder_frozen and self.num_G_updates >= self.freeze_encoder_iters:
+            print ("Unfreezing encoder.")
+            self.encoder_frozen = False
+            K.set_value(self.encoder_gate, 1.)
+        return errG
+
+    def train_one_batch_D(self, data):
+        """
+        Arguments:
+            data: dict of loader batches keyed by identity, only these identities are updated.
+        """
+        errD = {}
+        for name, batch in data.items():
+            warped, target, _, layout, *_ = self.unpack_batch(batch)
+            errD[name] = self.netD_train[name]([warped, target, layout])
+        return errD
+
+    def get_subnetwork(self, name):
+        # Sub-networks are named encoder, decoder_{identity} and netD_{identity}
+        if name.startswith("decoder_"):
+            return self.decoders[name[len("decoder_"):]]
+        if name.startswith("netD_"):
+            return self.netDs[name[len("netD_"):]]
+        return getattr(self, name)
+
+    def load_weights(self, path="./models", identities=None, subnetworks=None):
+        """
+        Load the shared encoder and the decoders/discriminators of the given identities (default: all),
+        or only the given subnetworks, e.g. ["encoder"]. The consolidated checkpoint is used if path has one,
+        otherwise the per-network .h5 files.
+        Identities whose weights are missing are left untouched, e.g. newly added identities.
+        """
+        if subnetworks is None:
+            subnetworks = ["encoder"] + [f"{prefix}_{name}" for name in identities or self.identities
+                                         for prefix in ["decoder", "netD"]]
+        subnetworks = self.requested_subnetworks(subnetworks)
+        checkpoint_fn = f"{path}/{CHECKPOINT_FILENAME}"
+        if Path(checkpoint_fn).exists():
+            with h5py.File(checkpoint_fn, "r") as f:
+                saved = read_checkpoint_index(f, checkpoint_fn)["subnetworks"]
+        else:
+            saved = [name for name in subnetworks if Path(f"{path}/{name}.h5").exists()]
+        if "encoder" in subnetworks and "encoder" not in saved:
+            raise IOError(f"Encoder weights not found in {path}.")
+        for name in subnetworks:
+            if name.startswith("decoder_") and name not in saved:
+                print (f"No weights found for identity {name[len('decoder_'):]}, it will be trained from scratch.")
+        subnetworks = [name for name in subnetworks if name in saved]
+        if Path(checkpoint_fn).exists():
+            self.load_checkpoint(checkpoint_fn, subnetworks)
+            return
+        self.check_arch_compatibility(path)
+        for name in subnetworks:
+            self.get_subnetwork(name).load_weights(f"{path}/{name}.h5")
+        print (f"Weights of {', '.join(subnetworks)} are loaded from {path}.")
+
+    def load_pretrained_encoder(self, path, load_decoders=False, freeze_encoder_iters=0):
+        """
+        Warm start from a previously trained encoder, see FaceswapGANModel.load_pretrained_encoder().
+        load_decoders: bool, also initialize the decoders of the identities that have weights in path
+        """
+        names = ["encoder"] + ([f"decoder_{name}" for name in self.identities] if load_decoders else [])
+        self.load_weights(path, subnetworks=names)
+        self.freeze_encoder(freeze_encoder_iters)
+
+    def pair(self, identity_A, identity_B):
+        return IdentityPair(self, identity_A, identity_B)
+
+    def transform(self, img, layout, identity):
+        return self.path_abgr[identity]([[img], [layout]])
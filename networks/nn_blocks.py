@@ -1,42 +1,136 @@
 from keras.layers import *
+from keras.models import Model
 from keras.layers.advanced_activations import LeakyReLU
 from .instance_normalization import InstanceNormalization
 from .GroupNormalization import GroupNormalization
 from .pixel_shuffler import PixelShuffler
 from .custom_layers.scale_layer import Scale
+from .custom_layers.recompute_layer import RecomputeSegment
 from .custom_inits.icnr_initializer import icnr_keras
 from .oct_conv2d import OctConv2D
 import tensorflow as tf
 import keras.backend as K
+import uuid
 
 # initializers and weight decay regularization are fixed
 conv_init = 'he_normal'
 w_l2 = 1e-4
 
-def self_attn_block(inp, nc, squeeze_factor=8):
+def channel_axis(data_format='channels_last'):
+    return 1 if data_format == 'channels_first' else -1
+
+def to_data_format(x, data_format='channels_last'):
+    # NHWC -> data_format, models keep NHWC inputs and outputs regardless of their internal data format
+    return Permute((3, 1, 2))(x) if data_format == 'channels_first' else x
+
+def from_data_format(x, data_format='channels_last'):
+    # data_format -> NHWC
+    return Permute((2, 3, 1))(x) if data_format == 'channels_first' else x
+
+def flatten_spatial(x, data_format='channels_last'):
+    # (B, H, W, C) or (B, C, H, W) -> (B, H*W, C)
+    nc = x.get_shape().as_list()[channel_axis(data_format)]
+    if data_format == 'channels_first':
+        return Permute((2, 1))(Reshape((nc, -1))(x))
+    return Reshape((-1, nc))(x)
+
+def unflatten_spatial(x, shape, data_format='channels_last'):
+    # (B, H*W, C) -> shape
+    if data_format == 'channels_first':
+        return Reshape(shape[1:])(Permute((2, 1))(x))
+    return Reshape(shape[1:])(x)
+
+def streaming_attention(q_i, k, v, splits):
+    # One query chunk against every key chunk, with a running max / running sum softmax
+    m, l, acc = None, None, None
+    for k_j, v_j in zip(tf.split(k, splits, axis=1), tf.split(v, splits, axis=1)):
+        deps = [acc] if acc is not None else []
+        with tf.control_dependencies(deps):
+            s = tf.matmul(q_i, k_j, transpose_b=True)
+        s_max = tf.reduce_max(s, axis=-1, keepdims=True)
+        if m is None:
+            m = s_max
+            p = tf.exp(s - m)
+            l = tf.reduce_sum(p, axis=-1, keepdims=True)
+            acc = tf.matmul(p, v_j)
+        else:
+            m_new = tf.maximum(m, s_max)
+            correction = tf.exp(m - m_new)
+            p = tf.exp(s - m_new)
+            l = l * correction + tf.reduce_sum(p, axis=-1, keepdims=True)
+            acc = acc * correction + tf.matmul(p, v_j)
+            m = m_new
+    return acc / l
+
+def chunked_attention(q, k, v, chunk_size):
+    '''
+    softmax(q k^T) v computed over blocks of chunk_size queries x chunk_size keys, with a streaming
+    (running max / running sum) softmax, so that only (chunk_size x chunk_size) scores are alive at a time
+    instead of the full (N x N) attention matrix. Exact up to float rounding.
+
+    The score blocks are not kept for backprop: query chunks are recomputed one at a time from q, k, v
+    once the gradient of the output is available (as in RecomputeSegment), so the memory saving also
+    holds during training.
+
+    q, k: (B, N, d), v: (B, N, c)
+    '''
+    n = K.int_shape(q)[1]
+    splits = [min(chunk_size, n - i) for i in range(0, n, chunk_size)]
+    outputs = []
+    for q_i in tf.split(q, splits, axis=1):
+        # Query chunks are serialized so that their score blocks are not scheduled concurrently
+        with tf.control_dependencies(outputs[-1:]):
+            q_i = tf.identity(q_i)
+        outputs.append(streaming_attention(q_i, k, v, splits))
+    num_chunks = len(outputs)
+
+    def recompute_grad(op, *dys):
+        q, k, v = op.inputs[num_chunks:]
+        dqs, dk, dv = [], 0, 0
+        for q_i, dy in zip(tf.split(q, splits, axis=1), dys[:num_chunks]):
+            # Recompute after the output gradient has arrived and the previous chunk is done
+            with tf.control_dependencies([dy] + dqs[-1:]):
+                xs = [tf.identity(x) for x in [q_i, k, v]]
+            dq_i, dk_i, dv_i = tf.gradients(streaming_attention(xs[0], xs[1], xs[2], splits), xs, grad_ys=dy)
+            dqs.append(dq_i)
+            dk += dk_i
+            dv += dv_i
+        return [None] * num_chunks + [tf.concat(dqs, axis=1), dk, dv]
+
+    grad_name = f"ChunkedAttention_{uuid.uuid4().hex}"
+    tf.RegisterGradient(grad_name)(recompute_grad)
+    # q, k and v pass through IdentityN so that their gradients are routed to recompute_grad
+    with tf.get_default_graph().gradient_override_map({"IdentityN": grad_name}):
+        identity = tf.identity_n([tf.stop_gradient(out) for out in outputs] + [q, k, v])
+    return tf.concat(identity[:num_chunks], axis=1)
+
+def self_attn_block(inp, nc, squeeze_factor=8, data_format='channels_last', chunk_size=None):
     '''
     Code borrows from https://github.com/taki0112/Self-Attention-GAN-Tensorflow
+
+    chunk_size: int or None. If set (and smaller than H*W), attention is computed by chunked_attention().
+                Layers and weights are the same either way.
     '''
     assert nc//squeeze_factor > 0, f"Input channels must be >= {squeeze_factor}, recieved nc={nc}"
     x = inp
     shape_x = x.get_shape().as_list()
     
-    f = Conv2D(nc//squeeze_factor, 1, kernel_regularizer=regularizers.l2(w_l2))(x)
-    g = Conv2D(nc//squeeze_factor, 1, kernel_regularizer=regularizers.l2(w_l2))(x)
-    h = Conv2D(nc, 1, kernel_regularizer=regularizers.l2(w_l2))(x)
+    f = Conv2D(nc//squeeze_factor, 1, kernel_regularizer=regularizers.l2(w_l2), data_format=data_format)(x)
+    g = Conv2D(nc//squeeze_factor, 1, kernel_regularizer=regularizers.l2(w_l2), data_format=data_format)(x)
+    h = Conv2D(nc, 1, kernel_regularizer=regularizers.l2(w_l2), data_format=data_format)(x)
     
-    shape_f = f.get_shape().as_list()
-    shape_g = g.get_shape().as_list()
-    shape_h = h.get_shape().as_list()
-    flat_f = Reshape((-1, shape_f[-1]))(f)
-    flat_g = Reshape((-1, shape_g[-1]))(g)
-    flat_h = Reshape((-1, shape_h[-1]))(h)   
+    flat_f = flatten_spatial(f, data_format)
+    flat_g = flatten_spatial(g, data_format)
+    flat_h = flatten_spatial(h, data_format)
     
-    s = Lambda(lambda x: K.batch_dot(x[0], Permute((2,1))(x[1])))([flat_g, flat_f])
-
-    beta = Softmax(axis=-1)(s)
-    o = Lambda(lambda x: K.batch_dot(x[0], x[1]))([beta, flat_h])
-    o = Reshape(shape_x[1:])(o)
+    num_positions = K.int_shape(flat_f)[1]
+    if chunk_size and chunk_size < num_positions:
+        o = Lambda(lambda x: chunked_attention(x[0], x[1], x[2], chunk_size))([flat_g, flat_f, flat_h])
+    else:
+        s = Lambda(lambda x: K.batch_dot(x[0], Permute((2,1))(x[1])))([flat_g, flat_f])
+        beta = Softmax(axis=-1)(s)
+        o = Lambda(lambda x: K.batch_dot(x[0], x[1]))([beta, flat_h])
+    o = unflatten_spatial(o, shape_x, data_format)
     o = Scale()(o)
     
     out = add([o, inp])
@@ -100,69 +194,74 @@ def dual_attn_block(inp, nc, squeeze_factor=8):
     out = add([out_pam, out_chn])
     return out
 
-def normalization(inp, norm='none', group='16'):    
+def normalization(inp, norm='none', group='16', data_format='channels_last'):    
     x = inp
     if norm == 'layernorm':
-        x = GroupNormalization(group=group)(x)
+        x = GroupNormalization(group=group, data_format=data_format)(x)
     elif norm == 'batchnorm':
-        x = BatchNormalization()(x)
+        x = BatchNormalization(axis=channel_axis(data_format))(x)
     elif norm == 'groupnorm':
-        x = GroupNormalization(group=16)(x)
+        x = GroupNormalization(group=16, data_format=data_format)(x)
     elif norm == 'instancenorm':
         x = InstanceNormalization()(x)
     elif norm == 'hybrid':
         if group % 2 == 1:
             raise ValueError(f"Output channels must be an even number for hybrid norm, received {group}.")
         f = group
-        x0 = Lambda(lambda x: x[...,:f//2])(x)
-        x1 = Lambda(lambda x: x[...,f//2:])(x)        
+        if data_format == 'channels_first':
+            x0 = Lambda(lambda x: x[:,:f//2])(x)
+            x1 = Lambda(lambda x: x[:,f//2:])(x)
+        else:
+            x0 = Lambda(lambda x: x[...,:f//2])(x)
+            x1 = Lambda(lambda x: x[...,f//2:])(x)        
         x0 = Conv2D(f//2, kernel_size=1, kernel_regularizer=regularizers.l2(w_l2),
-                    kernel_initializer=conv_init)(x0)
+                    kernel_initializer=conv_init, data_format=data_format)(x0)
         x1 = InstanceNormalization()(x1)        
-        x = concatenate([x0, x1], axis=-1)
+        x = concatenate([x0, x1], axis=channel_axis(data_format))
     else:
         x = x
     return x
 
-def conv_block(input_tensor, f, use_norm=False, strides=2, w_l2=w_l2, norm='none'):
+def conv_block(input_tensor, f, use_norm=False, strides=2, w_l2=w_l2, norm='none', data_format='channels_last'):
     x = input_tensor
     x = Conv2D(f, kernel_size=3, strides=strides, kernel_regularizer=regularizers.l2(w_l2),  
-               kernel_initializer=conv_init, use_bias=False, padding="same")(x)
+               kernel_initializer=conv_init, use_bias=False, padding="same", data_format=data_format)(x)
     x = Activation("relu")(x)
-    x = normalization(x, norm, f) if use_norm else x
+    x = normalization(x, norm, f, data_format) if use_norm else x
     return x
 
-def conv_block_d(input_tensor, f, use_norm=False, w_l2=w_l2, norm='none'):
+def conv_block_d(input_tensor, f, use_norm=False, w_l2=w_l2, norm='none', data_format='channels_last'):
     x = input_tensor
     x = Conv2D(f, kernel_size=4, strides=2, kernel_regularizer=regularizers.l2(w_l2), 
-               kernel_initializer=conv_init, use_bias=False, padding="same")(x)
+               kernel_initializer=conv_init, use_bias=False, padding="same", data_format=data_format)(x)
     x = LeakyReLU(alpha=0.2)(x)   
-    x = normalization(x, norm, f) if use_norm else x
+    x = normalization(x, norm, f, data_format) if use_norm else x
     return x
 
-def octconv_block(input_tensor, f, input_size, target_size, alpha, use_norm=False, norm='none'):
+def octconv_block(input_tensor, f, input_size, target_size, alpha, use_norm=False, norm='none', 
+                  data_format='channels_last'):
 
     x = input_tensor
-    low = AveragePooling2D(2)(x)
+    low = AveragePooling2D(2, data_format=data_format)(x)
 
     active_size = input_size
     filter_size = f
 
     # 16 channels block
-    high, low = OctConv2D(filters=filter_size, alpha=alpha)([x, low])
-    high = normalization(high, norm, filter_size) if use_norm else high
+    high, low = OctConv2D(filters=filter_size, alpha=alpha, data_format=data_format)([x, low])
+    high = normalization(high, norm, filter_size, data_format) if use_norm else high
     #high = BatchNormalization()(high)
     high = Activation("relu")(high)
-    low = normalization(low, norm, filter_size) if use_norm else low
+    low = normalization(low, norm, filter_size, data_format) if use_norm else low
     #low = BatchNormalization()(low)
     low = Activation("relu")(low)
 
     while active_size > target_size*2:
-        high, low = OctConv2D(filters=filter_size, alpha=alpha, strides=(2, 2))([high, low])
-        high = normalization(high, norm, filter_size) if use_norm else high
+        high, low = OctConv2D(filters=filter_size, alpha=alpha, strides=(2, 2), data_format=data_format)([high, low])
+        high = normalization(high, norm, filter_size, data_format) if use_norm else high
         #high = BatchNormalization()(high)
         high = Activation("relu")(high)
-        low = normalization(low, norm, filter_size) if use_norm else low
+        low = normalization(low, norm, filter_size, data_format) if use_norm else low
         #low = BatchNormalization()(low)
         low = Activation("relu")(low)
 
@@ -171,30 +270,30 @@ def octconv_block(input_tensor, f, input_size, target_size, alpha, use_norm=Fals
 
     #high, _ = OctConv2D(filters=filter_size, alpha=alpha, strides=(2, 2))([high, low])
     #high = normalization(high, norm, filter_size) if use_norm else high
-    high = AveragePooling2D(2)(high)
+    high = AveragePooling2D(2, data_format=data_format)(high)
 
-    x = Concatenate()([high, low])
-    x = Conv2D(filter_size, 1)(x)
-    x = normalization(x, norm, filter_size) if use_norm else x
+    x = Concatenate(axis=channel_axis(data_format))([high, low])
+    x = Conv2D(filter_size, 1, data_format=data_format)(x)
+    x = normalization(x, norm, filter_size, data_format) if use_norm else x
     #x = BatchNormalization()(x)
     x = Activation("relu")(x)
     
     return x
 
-def res_block(input_tensor, f, use_norm=False, w_l2=w_l2, norm='none'):
+def res_block(input_tensor, f, use_norm=False, w_l2=w_l2, norm='none', data_format='channels_last'):
     x = input_tensor
     x = Conv2D(f, kernel_size=3, kernel_regularizer=regularizers.l2(w_l2), 
-               kernel_initializer=conv_init, use_bias=False, padding="same")(x)
+               kernel_initializer=conv_init, use_bias=False, padding="same", data_format=data_format)(x)
     x = LeakyReLU(alpha=0.2)(x)
-    x = normalization(x, norm, f) if use_norm else x
+    x = normalization(x, norm, f, data_format) if use_norm else x
     x = Conv2D(f, kernel_size=3, kernel_regularizer=regularizers.l2(w_l2), 
-               kernel_initializer=conv_init, use_bias=False, padding="same")(x)
+               kernel_initializer=conv_init, use_bias=False, padding="same", data_format=data_format)(x)
     x = add([x, input_tensor])
     x = LeakyReLU(alpha=0.2)(x)
-    x = normalization(x, norm, f) if use_norm else x
+    x = normalization(x, norm, f, data_format) if use_norm else x
     return x
 
-def SPADE_res_block(input_tensor, cond_input_tensor, f, use_norm=True, norm='none'):
+def SPADE_res_block(input_tensor, cond_input_tensor, f, use_norm=True, norm='none', data_format='channels_last'):
     """
     Semantic Image Synthesis with Spatially-Adaptive Normalization
     Taesung Park, Ming-Yu Liu, Ting-Chun Wang, Jun-Yan Zhu
@@ -208,15 +307,15 @@ def SPADE_res_block(input_tensor, cond_input_tensor, f, use_norm=True, norm='non
     """
     def SPADE(input_tensor, cond_input_tensor, f, use_norm=True, norm='none'):
         x = input_tensor
-        x = normalization(x, norm, f) if use_norm else x
+        x = normalization(x, norm, f, data_format) if use_norm else x
         y = cond_input_tensor
         y = Conv2D(128, kernel_size=3, kernel_regularizer=regularizers.l2(w_l2), 
-                   kernel_initializer=conv_init, padding='same')(y)
+                   kernel_initializer=conv_init, padding='same', data_format=data_format)(y)
         y = Activation('relu')(y)           
         gamma = Conv2D(f, kernel_size=3, kernel_regularizer=regularizers.l2(w_l2), 
-                   kernel_initializer=conv_init, padding='same')(y)
+                   kernel_initializer=conv_init, padding='same', data_format=data_format)(y)
         beta = Conv2D(f, kernel_size=3, kernel_regularizer=regularizers.l2(w_l2), 
-                   kernel_initializer=conv_init, padding='same')(y)
+                   kernel_initializer=conv_init, padding='same', data_format=data_format)(y)
         x = add([x, multiply([x, gamma])])
         x = add([x, beta])
         return x
@@ -224,39 +323,70 @@ def SPADE_res_block(input_tensor, cond_input_tensor, f, use_norm=True, norm='non
     x = input_tensor
     shape_x = x.get_shape().as_list()
     y = cond_input_tensor
-    y = Lambda(lambda x: K.tf.image.resize_images(x, shape_x[1:3]))(y)
+    y = Lambda(lambda x: resize_images(x, shape_x, data_format))(y)
     x = SPADE(x, y, f, use_norm, norm)
     x = Activation('relu')(x)
-    x = ReflectPadding2D(x)
+    x = ReflectPadding2D(x, data_format=data_format)
     x = Conv2D(f, kernel_size=3, kernel_regularizer=regularizers.l2(w_l2), 
-               kernel_initializer=conv_init, use_bias=not use_norm)(x)
+               kernel_initializer=conv_init, use_bias=not use_norm, data_format=data_format)(x)
     x = SPADE(x, y, f, use_norm, norm)
     x = Activation('relu')(x)
-    x = ReflectPadding2D(x)
+    x = ReflectPadding2D(x, data_format=data_format)
     x = Conv2D(f, kernel_size=3, kernel_regularizer=regularizers.l2(w_l2), 
-               kernel_initializer=conv_init)(x)
+               kernel_initializer=conv_init, data_format=data_format)(x)
     x = add([x, input_tensor])
     x = Activation('relu')(x)
     return x
 
-def upscale_ps(input_tensor, f, use_norm=False, w_l2=w_l2, norm='none'):
+def upscale_ps(input_tensor, f, use_norm=False, w_l2=w_l2, norm='none', data_format='channels_last'):
     x = input_tensor
     x = Conv2D(f*4, kernel_size=3, kernel_regularizer=regularizers.l2(w_l2), 
-               kernel_initializer=icnr_keras, padding='same')(x)
+               kernel_initializer=icnr_keras, padding='same', data_format=data_format)(x)
     x = LeakyReLU(0.2)(x)
-    x = normalization(x, norm, f) if use_norm else x
-    x = PixelShuffler()(x)
+    x = normalization(x, norm, f, data_format) if use_norm else x
+    x = PixelShuffler(data_format=data_format)(x)
+    return x
+
+def resize_images(x, shape, data_format='channels_last'):
+    # Resize x to the spatial size of shape. tf.image only supports NHWC.
+    if data_format == 'channels_first':
+        x = tf.transpose(x, [0, 2, 3, 1])
+        x = tf.image.resize_images(x, shape[2:4])
+        return tf.transpose(x, [0, 3, 1, 2])
+    return tf.image.resize_images(x, shape[1:3])
+
+def ReflectPadding2D(x, pad=1, data_format='channels_last'):
+    if data_format == 'channels_first':
+        paddings = [[0, 0], [0, 0], [pad, pad], [pad, pad]]
+    else:
+        paddings = [[0, 0], [pad, pad], [pad, pad], [0, 0]]
+    x = Lambda(lambda x: tf.pad(x, paddings, mode='REFLECT'))(x)
     return x
 
-def ReflectPadding2D(x, pad=1):
-    x = Lambda(lambda x: tf.pad(x, [[0, 0], [pad, pad], [pad, pad], [0, 0]], mode='REFLECT'))(x)
+def recompute_block(block_fn, inputs, use_recompute=False):
+    """
+    Apply block_fn(*inputs). If use_recompute is True, the block is wrapped as a sub-model 
+    whose activations are recomputed during backprop instead of being stored (see RecomputeSegment).
+    """
+    if not use_recompute:
+        return block_fn(*inputs)
+    segment_inputs = [Input(shape=K.int_shape(x)[1:]) for x in inputs]
+    segment = Model(segment_inputs, block_fn(*segment_inputs))
+    return RecomputeSegment(segment)(inputs if len(inputs) > 1 else inputs[0])
+
+def fade_in_block(new_tensor, old_tensor, fade_in):
+    """
+    Progressive growing (https://arxiv.org/abs/1710.10196): blend a newly added stage with 
+    the resized output of the stage before it. fade_in is a K.variable ramped from 0 to 1.
+    """
+    x = Lambda(lambda x: fade_in * x[0] + (1 - fade_in) * x[1])([new_tensor, old_tensor])
     return x
 
-def upscale_nn(input_tensor, f, use_norm=False, w_l2=w_l2, norm='none'):
+def upscale_nn(input_tensor, f, use_norm=False, w_l2=w_l2, norm='none', data_format='channels_last'):
     x = input_tensor
-    x = UpSampling2D()(x)
-    x = ReflectPadding2D(x, 1)
+    x = UpSampling2D(data_format=data_format)(x)
+    x = ReflectPadding2D(x, 1, data_format)
     x = Conv2D(f, kernel_size=3, kernel_regularizer=regularizers.l2(w_l2), 
-               kernel_initializer=conv_init)(x)
-    x = normalization(x, norm, f) if use_norm else x
+               kernel_initializer=conv_init, data_format=data_format)(x)
+    x = normalization(x, norm, f, data_format) if use_norm else x
     return x
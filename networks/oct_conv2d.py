@@ -6,17 +6,31 @@ https://arxiv.org/abs/1904.05049
 
 from keras.engine import Layer
 from keras import backend as K
+import tensorflow as tf
+
+def upsample_nearest_2x(x, data_format="channels_last"):
+    """
+    2x nearest neighbor upsampling in a single resize (NHWC) or tile + reshape (NCHW), 
+    instead of K.repeat_elements, which slices and concatenates every row and column.
+    """
+    if data_format == "channels_last":
+        h, w = K.int_shape(x)[1:3]
+        return tf.image.resize_nearest_neighbor(x, (h*2, w*2))
+    c, h, w = K.int_shape(x)[1:]
+    x = tf.tile(x[:, :, :, None, :, None], [1, 1, 1, 2, 1, 2]) # (B, C, H, 2, W, 2)
+    return tf.reshape(x, (-1, c, h*2, w*2))
 
 class OctConv2D(Layer):
     def __init__(self, filters, alpha, kernel_size=(3,3), strides=(1,1), 
                     padding="same", kernel_initializer='glorot_uniform',
                     kernel_regularizer=None, kernel_constraint=None,
-                    **kwargs):
+                    data_format="channels_last", **kwargs):
         """
         OctConv2D : Octave Convolution for image( rank 4 tensors)
         filters: # output channels for low + high
         alpha: Low channel ratio (alpha=0 -> High only, alpha=1 -> Low only)
         kernel_size : 3x3 by default, padding : same by default
+        data_format : channels_last (NHWC) or channels_first (NCHW)
         """
         assert alpha >= 0 and alpha <= 1
         assert filters > 0 and isinstance(filters, int)
@@ -31,6 +45,9 @@ class OctConv2D(Layer):
         self.kernel_initializer = kernel_initializer
         self.kernel_regularizer = kernel_regularizer
         self.kernel_constraint = kernel_constraint
+        self.data_format = data_format
+        # spatial axes (h, w) and channel axis of the inputs
+        self.h_axis, self.w_axis, self.c_axis = (2, 3, 1) if data_format == "channels_first" else (1, 2, 3)
         # -> Low Channels 
         self.low_channels = int(self.filters * self.alpha)
         # -> High Channles
@@ -39,17 +56,16 @@ class OctConv2D(Layer):
     def build(self, input_shape):
         assert len(input_shape) == 2
         assert len(input_shape[0]) == 4 and len(input_shape[1]) == 4
+        h, w, c = self.h_axis, self.w_axis, self.c_axis
         # Assertion for high inputs
-        assert input_shape[0][1] // 2 >= self.kernel_size[0]
-        assert input_shape[0][2] // 2 >= self.kernel_size[1]
+        assert input_shape[0][h] // 2 >= self.kernel_size[0]
+        assert input_shape[0][w] // 2 >= self.kernel_size[1]
         # Assertion for low inputs
-        assert input_shape[0][1] // input_shape[1][1] == 2
-        assert input_shape[0][2] // input_shape[1][2] == 2
-        # channels last for TensorFlow
-        assert K.image_data_format() == "channels_last"
+        assert input_shape[0][h] // input_shape[1][h] == 2
+        assert input_shape[0][w] // input_shape[1][w] == 2
         # input channels
-        high_in = int(input_shape[0][3])
-        low_in = int(input_shape[1][3])
+        high_in = int(input_shape[0][c])
+        low_in = int(input_shape[1][c])
 
         # High -> High
         self.high_to_high_kernel = self.add_weight(name="high_to_high_kernel", 
@@ -84,22 +100,22 @@ class OctConv2D(Layer):
         # High -> High conv
         high_to_high = K.conv2d(high_input, self.high_to_high_kernel,
                                 strides=self.strides, padding=self.padding,
-                                data_format="channels_last")
+                                data_format=self.data_format)
         # High -> Low conv
-        high_to_low  = K.pool2d(high_input, (2,2), strides=(2,2), pool_mode="avg")
+        high_to_low  = K.pool2d(high_input, (2,2), strides=(2,2), pool_mode="avg",
+                                data_format=self.data_format)
         high_to_low  = K.conv2d(high_to_low, self.high_to_low_kernel,
                                 strides=self.strides, padding=self.padding,
-                                data_format="channels_last")
+                                data_format=self.data_format)
         # Low -> High conv
         low_to_high  = K.conv2d(low_input, self.low_to_high_kernel,
                                 strides=self.strides, padding=self.padding,
-                                data_format="channels_last")
-        low_to_high = K.repeat_elements(low_to_high, 2, axis=1) # Nearest Neighbor Upsampling
-        low_to_high = K.repeat_elements(low_to_high, 2, axis=2)
+                                data_format=self.data_format)
+        low_to_high = upsample_nearest_2x(low_to_high, self.data_format) # Nearest Neighbor Upsampling
         # Low -> Low conv
         low_to_low   = K.conv2d(low_input, self.low_to_low_kernel,
                                 strides=self.strides, padding=self.padding,
-                                data_format="channels_last")
+                                data_format=self.data_format)
         # Cross Add
         high_add = high_to_high + low_to_high
         low_add = high_to_low + low_to_low
@@ -107,9 +123,12 @@ class OctConv2D(Layer):
 
     def compute_output_shape(self, input_shapes):
         high_in_shape, low_in_shape = input_shapes
-        high_out_shape = (high_in_shape[0], high_in_shape[1] // self.strides[0], high_in_shape[2] // self.strides[1], self.high_channels)
-        low_out_shape = (low_in_shape[0] ,low_in_shape[1] // self.strides[0], low_in_shape[2] // self.strides[1], self.low_channels)
-        return [high_out_shape, low_out_shape]
+        def output_shape(in_shape, channels):
+            h, w = in_shape[self.h_axis] // self.strides[0], in_shape[self.w_axis] // self.strides[1]
+            if self.data_format == "channels_first":
+                return (in_shape[0], channels, h, w)
+            return (in_shape[0], h, w, channels)
+        return [output_shape(high_in_shape, self.high_channels), output_shape(low_in_shape, self.low_channels)]
 
     def get_config(self):
         base_config = super().get_config()
@@ -123,6 +142,7 @@ class OctConv2D(Layer):
             "padding": self.padding,
             "kernel_initializer": self.kernel_initializer,
             "kernel_regularizer": self.kernel_regularizer,
-            "kernel_constraint": self.kernel_constraint,            
+            "kernel_constraint": self.kernel_constraint,
+            "data_format": self.data_format,
         }
         return out_config
\ No newline at end of file
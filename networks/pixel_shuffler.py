@@ -6,10 +6,15 @@ from keras.utils import conv_utils
 from keras.engine.topology import Layer
 import keras.backend as K
 
+try:
+    from keras.utils.conv_utils import normalize_data_format
+except:
+    from keras.backend.common import normalize_data_format
+
 class PixelShuffler(Layer):
     def __init__(self, size=(2, 2), data_format=None, **kwargs):
         super(PixelShuffler, self).__init__(**kwargs)
-        self.data_format = K.image_data_format()
+        self.data_format = normalize_data_format(data_format)
         self.size = conv_utils.normalize_tuple(size, 2, 'size')
 
     def call(self, inputs):
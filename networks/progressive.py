@@ -0,0 +1,147 @@
+from keras.models import Model
+import keras.backend as K
+from .faceswap_gan_model import FaceswapGANModel, SUBNETWORKS
+from .custom_layers.recompute_layer import RecomputeSegment
+
+RESOLUTIONS = [64, 128, 256]
+
+def weighted_layers(model):
+    """
+    Layers that own weights, in topological order. Nested models and recompute segments are flattened.
+    """
+    layers = []
+    for layer in model.layers:
+        if isinstance(layer, Model):
+            layers += weighted_layers(layer)
+        elif isinstance(layer, RecomputeSegment):
+            layers += weighted_layers(layer.segment)
+        elif layer.weights:
+            layers.append(layer)
+    return layers
+
+def get_layer_weights(model):
+    return [layer.get_weights() for layer in weighted_layers(model)]
+
+def _signature(layer_weights):
+    return tuple(w.shape for w in layer_weights)
+
+def set_layer_weights(model, src_layer_weights):
+    """
+    Copy weights of a (smaller) source model into model, layer by layer.
+
+    Source and target layers are aligned by the longest common subsequence of their weight shapes,
+    so stages inserted or replaced in the target model keep their fresh initialization
+    while every other layer receives the source weights.
+
+    Returns:
+        num_transferred: int, number of layers that received weights
+    """
+    dst_layers = weighted_layers(model)
+    src = [_signature(w) for w in src_layer_weights]
+    dst = [_signature(layer.get_weights()) for layer in dst_layers]
+
+    # lcs[i][j]: length of the LCS of src[i:] and dst[j:]
+    lcs = [[0] * (len(dst)+1) for _ in range(len(src)+1)]
+    for i in range(len(src)-1, -1, -1):
+        for j in range(len(dst)-1, -1, -1):
+            if src[i] == dst[j]:
+                lcs[i][j] = lcs[i+1][j+1] + 1
+            else:
+                lcs[i][j] = max(lcs[i+1][j], lcs[i][j+1])
+
+    # Walk forward so that matches are taken as early as possible, i.e. new layers are the later ones
+    i = j = num_transferred = 0
+    while i < len(src) and j < len(dst):
+        if src[i] == dst[j] and lcs[i][j] == lcs[i+1][j+1] + 1:
+            dst_layers[j].set_weights(src_layer_weights[i])
+            num_transferred += 1
+            i += 1
+            j += 1
+        elif lcs[i+1][j] >= lcs[i][j+1]:
+            i += 1
+        else:
+            j += 1
+    return num_transferred
+
+def snapshot_weights(gan_model):
+    """
+    Numpy copy of all sub-network weights, which survives K.clear_session().
+    """
+    return {name: get_layer_weights(getattr(gan_model, name)) for name in SUBNETWORKS}
+
+def restore_weights(gan_model, snapshot):
+    for name in SUBNETWORKS:
+        num_layers = len(weighted_layers(getattr(gan_model, name)))
+        num_transferred = set_layer_weights(getattr(gan_model, name), snapshot[name])
+        print(f"{name}: transferred weights of {num_transferred}/{num_layers} layers.")
+
+def grow_model(gan_model, resolution, **arch_config):
+    """
+    Build a FaceswapGANModel at a higher resolution and carry over compatible weights from gan_model.
+    The new stages start fully faded out (fade_in = 0).
+
+    Note:
+        The current Keras session is cleared. Perceptual loss model, training functions
+        and data loaders have to be rebuilt by the caller, just like reset_session() in the train notebook.
+    """
+    snapshot = snapshot_weights(gan_model)
+    del gan_model
+    K.clear_session()
+
+    arch_config = dict(arch_config)
+    arch_config['IMAGE_SHAPE'] = (resolution, resolution, 3)
+    arch_config['use_fade_in'] = True
+    new_model = FaceswapGANModel(**arch_config)
+    restore_weights(new_model, snapshot)
+    new_model.set_fade_in(0.)
+    return new_model
+
+class ProgressiveSchedule():
+    """
+    Schedule of progressive-resolution training.
+
+    Attributes:
+        stages: list of (resolution, num_iters) tuples, resolutions should be 64, 128 or 256
+        fade_iters: int, number of iterations over which a new stage is faded in
+
+    Example:
+        schedule = ProgressiveSchedule([(64, 10000), (128, 10000), (256, 20000)], fade_iters=2000)
+        for gen_iterations in range(schedule.total_iters):
+            if schedule.is_new_stage(gen_iterations):
+                model = grow_model(model, schedule.resolution_at(gen_iterations), **arch_config)
+                ... # rebuild PL model, train functions and data loaders
+            if model.fade_in is not None:
+                model.set_fade_in(schedule.fade_in_at(gen_iterations))
+            ... # train one batch
+    """
+    def __init__(self, stages, fade_iters=2000):
+        for res, _ in stages:
+            if res not in RESOLUTIONS:
+                raise ValueError(f"Stage resolutions should be one of {RESOLUTIONS}. Received {res}.")
+        self.stages = stages
+        self.fade_iters = fade_iters
+        self.stage_starts = []
+        start = 0
+        for _, num_iters in stages:
+            self.stage_starts.append(start)
+            start += num_iters
+        self.total_iters = start
+
+    def stage_at(self, iteration):
+        idx = 0
+        for i, start in enumerate(self.stage_starts):
+            if iteration >= start:
+                idx = i
+        return idx
+
+    def resolution_at(self, iteration):
+        return self.stages[self.stage_at(iteration)][0]
+
+    def is_new_stage(self, iteration):
+        return iteration in self.stage_starts[1:]
+
+    def fade_in_at(self, iteration):
+        idx = self.stage_at(iteration)
+        if idx == 0 or self.fade_iters <= 0:
+            return 1.
+        return min(1., (iteration - self.stage_starts[idx]) / self.fade_iters)
@@ -0,0 +1,376 @@
+from keras.models import Model
+from keras.layers import Input, Conv2D, BatchNormalization
+from keras.utils.generic_utils import CustomObjectScope
+from collections import defaultdict
+from pathlib import Path
+import keras.backend as K
+import numpy as np
+import json
+import time
+from .faceswap_gan_model import FaceswapGANModel
+from .custom_layers.recompute_layer import RecomputeSegment
+from .custom_inits.icnr_initializer import icnr_keras
+from .cost_report import to_list, network_nodes
+
+GENERATOR_SUBNETWORKS = ["encoder", "decoder_A", "decoder_B"]
+# Layers that act on each channel independently, or combine same-shaped inputs element by element.
+# Channels pruned from their inputs are pruned from their outputs as well.
+CHANNELWISE_LAYERS = ["Activation", "LeakyReLU", "ReLU", "BatchNormalization", "UpSampling2D", "Dropout", "SpatialDropout2D"]
+ELEMENTWISE_LAYERS = ["Add", "Multiply", "Subtract", "Average", "Maximum", "Minimum"]
+PLAN_FILENAME = "pruning_plan.json"
+
+def unpack(x):
+    return x[0] if len(x) == 1 else x
+
+def get_data_format(model):
+    for layer in model.layers:
+        if isinstance(layer, Conv2D):
+            return layer.data_format
+    return "channels_last"
+
+def channel_role(layer, in_shapes, out_shapes, data_format):
+    """
+    "conv": Conv2D, its input channels can be sliced and its output channels start a new group
+    "shared": channels of inputs and outputs are pruned together
+    "opaque": channels of inputs and outputs are kept, e.g. Reshape, PixelShuffler, nested models
+    """
+    name = type(layer).__name__
+    if name == "InputLayer":
+        return "input"
+    if name == "Conv2D":
+        return "conv"
+    if isinstance(layer, (Model, RecomputeSegment)) or not all(len(s) == 4 for s in in_shapes + out_shapes):
+        return "opaque"
+    c = 1 if data_format == "channels_first" else 3
+    same_channels = len({s[c] for s in in_shapes + out_shapes}) == 1
+    if name in CHANNELWISE_LAYERS and len(in_shapes) == 1:
+        return "shared"
+    if name in ELEMENTWISE_LAYERS and same_channels:
+        return "shared"
+    # Lambdas of nn_blocks that keep the number of channels of rank-4 tensors
+    # (reflect padding, layout resizing, fade-in blending) act on each channel independently.
+    if name == "Lambda" and same_channels:
+        return "shared"
+    return "opaque"
+
+def find_channel_groups(model):
+    """
+    Groups of tensors of one model level whose channels can only be pruned together, e.g. a residual stream
+    and the convolutions adding to it. Groups touching model inputs/outputs or opaque layers are left out.
+    Nested models and recompute segments are pruned separately (see prune_plan).
+
+    Returns:
+        groups: list of dicts with keys tensors, producers (Conv2D layers) and channels, in a deterministic order
+    """
+    df = get_data_format(model)
+    parent, tensors = {}, {}
+    def add(t):
+        tensors.setdefault(id(t), t)
+        parent.setdefault(id(t), id(t))
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+    def union(a, b):
+        parent[find(a)] = find(b)
+
+    frozen, producers = set(), defaultdict(list)
+    for x in model.inputs + model.outputs:
+        add(x)
+        frozen.add(id(x))
+    for layer in model.layers:
+        for node in network_nodes(model, layer):
+            inputs, outputs = to_list(node.input_tensors), to_list(node.output_tensors)
+            for t in inputs + outputs:
+                add(t)
+            role = channel_role(layer, [K.int_shape(t) for t in inputs], [K.int_shape(t) for t in outputs], df)
+            if role == "conv":
+                producers[id(outputs[0])].append(layer)
+            elif role == "shared":
+                for t in inputs[1:] + outputs:
+                    union(id(inputs[0]), id(t))
+            elif role == "opaque":
+                frozen.update(id(t) for t in inputs + outputs)
+
+    frozen_roots = {find(i) for i in frozen}
+    members = defaultdict(list)
+    for i in tensors:
+        members[find(i)].append(i)
+    groups = []
+    for root, ids in members.items():
+        convs = [layer for i in ids for layer in producers[i]]
+        if root in frozen_roots or not convs:
+            continue
+        groups.append({"tensors": [tensors[i] for i in ids], "producers": convs, "channels": convs[0].filters})
+    return groups
+
+def nested_nodes(model):
+    # (index in model.layers, layer, sub-model, node) of nested models and recompute segments
+    nodes = []
+    for idx, layer in enumerate(model.layers):
+        if isinstance(layer, (Model, RecomputeSegment)):
+            sub_model = layer.segment if isinstance(layer, RecomputeSegment) else layer
+            for node in network_nodes(model, layer):
+                nodes.append((idx, layer, sub_model, node))
+    return nodes
+
+def l1_scores(group):
+    # Sum over producers of the (normalized) L1 norm of each output channel kernel
+    score = 0
+    for conv in group["producers"]:
+        w = np.abs(conv.get_weights()[0]).sum(axis=(0, 1, 2))
+        score = score + w / (w.mean() + 1e-8)
+    return score
+
+def activation_scores(group, values, data_format):
+    # Sum over the group tensors of the (normalized) mean absolute activation of each channel
+    axes = (0, 2, 3) if data_format == "channels_first" else (0, 1, 2)
+    score = 0
+    for v in values:
+        a = np.abs(v).mean(axis=axes)
+        score = score + a / (a.mean() + 1e-8)
+    return score
+
+def prune_plan(model, ratio=0.3, criterion="l1", sample_inputs=None, min_channels=8):
+    """
+    Channels to keep in every prunable group of model and of its nested models.
+
+    Arguments:
+        ratio: float, fraction of channels removed from each group
+        criterion: "l1" (kernel norms) or "activation" (mean absolute activations on sample_inputs)
+        sample_inputs: list of arrays fed to model.inputs, required by the "activation" criterion
+
+    Returns:
+        plan: dict, {"groups": [kept channel indices of each group], "nested": {layer index: plan}}
+    """
+    if criterion not in ["l1", "activation"]:
+        raise ValueError(f"criterion should be either l1 or activation, received {criterion}.")
+    if criterion == "activation" and sample_inputs is None:
+        raise ValueError("sample_inputs are required by the activation criterion.")
+    df = get_data_format(model)
+    groups = find_channel_groups(model)
+    nested = nested_nodes(model)
+
+    values = {}
+    if criterion == "activation":
+        fetches = [t for g in groups for t in g["tensors"]]
+        fetches += [t for _, _, _, node in nested for t in to_list(node.input_tensors)]
+        if fetches:
+            values = dict(zip([id(t) for t in fetches], K.function(model.inputs, fetches)(sample_inputs)))
+
+    plan = {"groups": [], "nested": {}}
+    for g in groups:
+        if criterion == "l1":
+            scores = l1_scores(g)
+        else:
+            scores = activation_scores(g, [values[id(t)] for t in g["tensors"]], df)
+        num_keep = max(min(min_channels, g["channels"]), int(round(g["channels"] * (1 - ratio))))
+        plan["groups"].append(sorted(np.argsort(-scores)[:num_keep].tolist()))
+    for idx, _, sub_model, node in nested:
+        sub_inputs = [values[id(t)] for t in to_list(node.input_tensors)] if criterion == "activation" else None
+        plan["nested"][str(idx)] = prune_plan(sub_model, ratio, criterion, sub_inputs, min_channels)
+    return plan
+
+def sliced_weights(layer, in_keep, out_keep, weights=None):
+    weights = layer.get_weights() if weights is None else weights
+    if isinstance(layer, Conv2D):
+        kernel = weights[0] # (kh, kw, c_in, c_out) regardless of data_format
+        kernel = kernel[:, :, in_keep, :] if in_keep is not None else kernel
+        kernel = kernel[..., out_keep] if out_keep is not None else kernel
+        if layer.use_bias:
+            return [kernel, weights[1][out_keep] if out_keep is not None else weights[1]]
+        return [kernel]
+    if isinstance(layer, BatchNormalization) and out_keep is not None:
+        return [w[out_keep] for w in weights]
+    return weights
+
+def weights_snapshot(model):
+    """
+    Numpy weights of every weighted layer of model (nested models and recompute segments included), keyed by id(layer).
+    """
+    snapshot = {}
+    for layer in model.layers:
+        if isinstance(layer, RecomputeSegment):
+            snapshot.update(weights_snapshot(layer.segment))
+        elif isinstance(layer, Model):
+            snapshot.update(weights_snapshot(layer))
+        elif layer.weights:
+            snapshot[id(layer)] = layer.get_weights()
+    return snapshot
+
+def apply_plan(model, plan=None, snapshot=None):
+    """
+    Build a thinner copy of model that keeps the channels in plan, with the corresponding weights of model.
+    Layers without weights are shared with model. plan=None makes a full copy.
+    Weights are read from snapshot (see weights_snapshot) if given, e.g. when the copy is built in another graph.
+    """
+    plan = plan or {"groups": [], "nested": {}}
+    snapshot = snapshot or {}
+    keep = {}
+    for g, kept in zip(find_channel_groups(model), plan["groups"]):
+        for t in g["tensors"]:
+            keep[id(t)] = kept
+
+    inputs = [Input(batch_shape=K.int_shape(x)) for x in model.inputs]
+    new_tensors = {id(x): new_x for x, new_x in zip(model.inputs, inputs)}
+    for idx, layer in enumerate(model.layers):
+        new_layer = None
+        for node in network_nodes(model, layer):
+            if type(layer).__name__ == "InputLayer":
+                continue
+            in_tensors, out_tensors = to_list(node.input_tensors), to_list(node.output_tensors)
+            in_keep, out_keep = keep.get(id(in_tensors[0])), keep.get(id(out_tensors[0]))
+            set_weights = False
+            if new_layer is None:
+                if isinstance(layer, RecomputeSegment):
+                    new_layer = RecomputeSegment(apply_plan(layer.segment, plan["nested"].get(str(idx)), snapshot))
+                elif isinstance(layer, Model):
+                    new_layer = apply_plan(layer, plan["nested"].get(str(idx)), snapshot)
+                elif not layer.weights:
+                    new_layer = layer
+                else:
+                    config = layer.get_config()
+                    if isinstance(layer, Conv2D) and out_keep is not None:
+                        config["filters"] = len(out_keep)
+                    with CustomObjectScope({"icnr_keras": icnr_keras}):
+                        new_layer = type(layer).from_config(config)
+                    set_weights = True
+            arguments = getattr(node, "arguments", None) or {}
+            outputs = new_layer(unpack([new_tensors[id(x)] for x in in_tensors]), **arguments)
+            if set_weights:
+                new_layer.set_weights(sliced_weights(layer, in_keep, out_keep, snapshot.get(id(layer))))
+            for t, new_t in zip(out_tensors, to_list(outputs)):
+                new_tensors[id(t)] = new_t
+    return Model(inputs, [new_tensors[id(y)] for y in model.outputs])
+
+def build_pruned_model(model, plans):
+    """
+    A FaceswapGANModel whose encoder and decoders are thinned by plans (keyed by sub-network name).
+    Discriminators are copied from model so that training can resume (see recovery_fine_tune).
+    """
+    pruned_model = FaceswapGANModel(**model.arch_config)
+    for name in GENERATOR_SUBNETWORKS:
+        setattr(pruned_model, name, apply_plan(getattr(model, name), plans[name]))
+    pruned_model.netDA.set_weights(model.netDA.get_weights())
+    pruned_model.netDB.set_weights(model.netDB.get_weights())
+    pruned_model.build_generators()
+    pruned_model.pruning_plans = plans
+    return pruned_model
+
+def save_pruned_model(pruned_model, path="./models"):
+    pruned_model.save_weights(path)
+    with open(f"{path}/{PLAN_FILENAME}", "w") as f:
+        json.dump(pruned_model.pruning_plans, f)
+
+def load_pruned_model(path="./models", **arch_config):
+    """
+    Rebuild a pruned model saved by save_pruned_model(). The plan is applied to a fresh model of arch_config
+    before its weights files are loaded.
+    """
+    fn = f"{path}/{PLAN_FILENAME}"
+    if not Path(fn).exists():
+        raise IOError(f"{fn} not found. Was the model saved by save_pruned_model()?")
+    with open(fn, "r") as f:
+        plans = json.load(f)
+    pruned_model = build_pruned_model(FaceswapGANModel(**arch_config), plans)
+    pruned_model.load_weights(path)
+    return pruned_model
+
+class ChannelPruner():
+    """
+    Structured channel pruning of the generators (encoder, decoder_A, decoder_B) of a trained FaceswapGANModel.
+    Channels are removed from conv_block, upscale_nn and SPADE_res_block convolutions (and every layer
+    that shares their channels), so the pruned model has the same interface (path_abgr_A/B, ...) and fewer FLOPs.
+
+    Attributes:
+        model: trained FaceswapGANModel, left untouched
+        criterion: "l1" (kernel norms) or "activation" (mean absolute activations on sample faces)
+        plans: dict of pruning plans keyed by sub-network, see prune_plan()
+
+    Example:
+        pruner = ChannelPruner(model, criterion="activation")
+        pruned_model = pruner.prune(ratio=0.3, sample_faces=faces, sample_layouts=layouts)
+        recovery_fine_tune(pruned_model, train_batchA.get_next_batch, train_batchB.get_next_batch, 500, loss_weights, **loss_config)
+        show_pruning_report(pruning_report(model, pruned_model, faces, layouts))
+    """
+    def __init__(self, model, criterion="l1"):
+        self.model = model
+        self.criterion = criterion
+        self.plans = None
+
+    def compute_plans(self, ratio=0.3, sample_faces=None, sample_layouts=None, min_channels=8):
+        self.plans = {}
+        encoder_inputs = latent = None
+        if self.criterion == "activation":
+            if sample_faces is None or sample_layouts is None:
+                raise ValueError("sample_faces and sample_layouts are required by the activation criterion.")
+            encoder_inputs = [sample_faces]
+            latent = self.model.encoder.predict(sample_faces)
+        self.plans["encoder"] = prune_plan(self.model.encoder, ratio, self.criterion, encoder_inputs, min_channels)
+        for name in ["decoder_A", "decoder_B"]:
+            decoder_inputs = [latent, sample_layouts] if latent is not None else None
+            self.plans[name] = prune_plan(getattr(self.model, name), ratio, self.criterion, decoder_inputs, min_channels)
+        return self.plans
+
+    def prune(self, ratio=0.3, sample_faces=None, sample_layouts=None, min_channels=8):
+        """
+        Arguments:
+            ratio: float, fraction of channels removed from every prunable group
+            sample_faces, sample_layouts: (N, H, W, 3) arrays of model inputs, used by the activation criterion
+            min_channels: int, minimum number of channels kept in a group
+        """
+        self.compute_plans(ratio, sample_faces, sample_layouts, min_channels)
+        return build_pruned_model(self.model, self.plans)
+
+def recovery_fine_tune(pruned_model, get_batch_A, get_batch_B, num_iters=500, loss_weights=None, **loss_config):
+    """
+    Short GAN fine-tune of a pruned model to recover from the removed channels.
+    get_batch_A, get_batch_B: callables returning a new batch, e.g. DataLoader.get_next_batch
+    """
+    pruned_model.build_train_functions(loss_weights=loss_weights, **loss_config)
+    errGA = errGB = None
+    for i in range(num_iters):
+        pruned_model.train_one_batch_D(data_A=get_batch_A(), data_B=get_batch_B())
+        errGA, errGB = pruned_model.train_one_batch_G(data_A=get_batch_A(), data_B=get_batch_B())
+    print (f"Recovery fine-tune of {num_iters} iterations done, last G losses: {errGA[0]:.4f} (A), {errGB[0]:.4f} (B).")
+    return errGA, errGB
+
+def time_path(path_fn, faces, layouts, num_runs=20):
+    # ms per single-image call, as in FaceTransformer
+    path_fn([faces[:1], layouts[:1]])
+    t0 = time.time()
+    for i in range(num_runs):
+        path_fn([faces[i % len(faces)][None], layouts[i % len(layouts)][None]])
+    return (time.time() - t0) / num_runs * 1000
+
+def generator_params(model):
+    return model.encoder.count_params() + model.decoder_A.count_params()
+
+def pruning_report(model, pruned_model, faces, layouts, num_runs=20):
+    """
+    Inference speed and reconstruction error (L1 of path_bgr_A outputs against faces) of the original
+    and pruned generators, plus the L1 distance between their path_abgr_A outputs.
+    faces, layouts: (N, H, W, 3) arrays of side A model inputs
+    """
+    report = {}
+    outputs = {}
+    for key, m in [("original", model), ("pruned", pruned_model)]:
+        bgr = m.path_bgr_A([faces, layouts])[0]
+        outputs[key] = m.path_abgr_A([faces, layouts])[0]
+        report[key] = {
+            "params": generator_params(m),
+            "ms_per_image": time_path(m.path_abgr_A, faces, layouts, num_runs),
+            "recon_l1": float(np.mean(np.abs(bgr - faces)))
+        }
+    report["speedup"] = report["original"]["ms_per_image"] / report["pruned"]["ms_per_image"]
+    report["param_ratio"] = report["pruned"]["params"] / report["original"]["params"]
+    report["output_l1"] = float(np.mean(np.abs(outputs["original"] - outputs["pruned"])))
+    return report
+
+def show_pruning_report(report):
+    for key in ["original", "pruned"]:
+        r = report[key]
+        print (f"[{key:8s}] params: {r['params']/1e6:.2f}M, {r['ms_per_image']:.1f} ms/image, recon L1: {r['recon_l1']:.4f}")
+    print (f"Speedup: {report['speedup']:.2f}x with {report['param_ratio']*100:.0f}% of the parameters, "
+           f"L1 distance to original outputs: {report['output_l1']:.4f}")
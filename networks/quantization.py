@@ -0,0 +1,159 @@
+import tensorflow as tf
+import numpy as np
+import json
+from pathlib import Path
+
+# TFLiteConverter.from_session, Optimize.DEFAULT and RepresentativeDataset (post-training quantization)
+MIN_TF_VERSION = "1.14"
+
+if not hasattr(tf, "lite") or not hasattr(tf.lite, "RepresentativeDataset"):
+    raise ImportError(f"TFLite quantization requires TensorFlow >= {MIN_TF_VERSION}, found {tf.__version__}.")
+
+from .export import build_inference_graph, get_decoder_name, INPUT_NAMES, OUTPUT_NAME
+from .pruning import time_path
+
+QUANTIZATIONS = ["int8", "float16"]
+
+def calibration_set(model, get_batch, num_batches=10):
+    """
+    Target faces and layouts of num_batches loader batches, e.g. get_batch=train_batchA.get_next_batch.
+    Faces of the identity being converted (side A for AtoB) should be used.
+
+    Returns:
+        faces, layouts: (N, H, W, 3) arrays of model inputs
+    """
+    faces, layouts = [], []
+    for _ in range(num_batches):
+        _, target, _, layout, *_ = model.unpack_batch(get_batch())
+        faces.append(target)
+        layouts.append(layout)
+    return np.concatenate(faces), np.concatenate(layouts)
+
+def convert_generator(model, direction="AtoB", quantization="int8", faces=None, layouts=None):
+    """
+    TFLite flatbuffer of the generator of one conversion direction with batch size 1.
+
+    int8: weights and activations are quantized to int8, activation ranges are calibrated on faces and layouts.
+          Ops without an int8 kernel fall back to float. Inputs and outputs stay float32.
+    float16: weights are stored as float16, no calibration data is needed.
+    """
+    if quantization not in QUANTIZATIONS:
+        raise ValueError(f"quantization should be one of {QUANTIZATIONS}, recieved {quantization}.")
+    if quantization == "int8" and (faces is None or layouts is None):
+        raise ValueError("int8 quantization needs calibration faces and layouts, see calibration_set().")
+
+    graph, session, input_names = build_inference_graph(model, direction)
+    with graph.as_default():
+        inputs = [graph.get_tensor_by_name(f"{name}:0") for name in input_names]
+        output = graph.get_tensor_by_name(f"{OUTPUT_NAME}:0")
+        converter = tf.lite.TFLiteConverter.from_session(session, inputs, [output])
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        if quantization == "int8":
+            def representative_dataset():
+                for face, layout in zip(faces, layouts):
+                    yield [face[None].astype(np.float32), layout[None].astype(np.float32)]
+            converter.representative_dataset = tf.lite.RepresentativeDataset(representative_dataset)
+        else:
+            converter.target_spec.supported_types = [tf.float16]
+        tflite_model = converter.convert()
+    session.close()
+    return tflite_model
+
+def export_quantized_generator(model, direction="AtoB", quantization="int8", faces=None, layouts=None,
+                               path="./models/tflite"):
+    """
+    Writes generator_{direction}_{quantization}.tflite and its .json metadata to path.
+    """
+    tflite_model = convert_generator(model, direction, quantization, faces, layouts)
+    Path(path).mkdir(parents=True, exist_ok=True)
+    fn = f"{path}/generator_{direction}_{quantization}"
+    with open(f"{fn}.tflite", "wb") as f:
+        f.write(tflite_model)
+    with open(f"{fn}.json", "w") as f:
+        json.dump({"direction": direction, "quantization": quantization,
+                   "IMAGE_SHAPE": list(model.IMAGE_SHAPE), "num_calibration_samples": 0 if faces is None else len(faces)}, f)
+    print (f"{quantization} {direction} generator ({len(tflite_model)/2**20:.1f} MB) has been saved to {fn}.tflite.")
+
+class TFLiteGenerator():
+    """
+    Runs a generator exported by export_quantized_generator() with the TFLite interpreter.
+    Drop-in replacement of FaceswapGANModel in FaceTransformer.set_model() for the exported direction.
+
+    Attributes:
+        direction: string, "AtoB" or "BtoA"
+        quantization: string, "int8" or "float16"
+        IMAGE_SHAPE: tuple, input shape of the generator
+        path_abgr_A, path_abgr_B: callables of [faces, layouts] -> [abgr]; only the exported direction is available
+    """
+    def __init__(self, path="./models/tflite", direction="AtoB", quantization="int8"):
+        get_decoder_name(direction)
+        fn = f"{path}/generator_{direction}_{quantization}"
+        for ext in [".tflite", ".json"]:
+            if not Path(fn + ext).exists():
+                raise IOError(f"{fn + ext} not found. Export the generator with export_quantized_generator() first.")
+        with open(f"{fn}.json", "r") as f:
+            meta = json.load(f)
+
+        self.direction = direction
+        self.quantization = quantization
+        self.IMAGE_SHAPE = tuple(meta["IMAGE_SHAPE"])
+        self.interpreter = tf.lite.Interpreter(model_path=f"{fn}.tflite")
+        self.interpreter.allocate_tensors()
+        input_details = {d["name"].split(":")[0]: d["index"] for d in self.interpreter.get_input_details()}
+        self.input_indices = [input_details[name] for name in INPUT_NAMES]
+        self.output_index = self.interpreter.get_output_details()[0]["index"]
+        # FaceTransformer uses path_abgr_B for AtoB and path_abgr_A for BtoA
+        if direction == "AtoB":
+            self.path_abgr_B, self.path_abgr_A = self.run, self._unavailable
+        else:
+            self.path_abgr_A, self.path_abgr_B = self.run, self._unavailable
+
+    def run(self, inputs):
+        # The converted graph has batch size 1
+        faces, layouts = inputs
+        outputs = []
+        for face, layout in zip(faces, layouts):
+            self.interpreter.set_tensor(self.input_indices[0], np.asarray(face[None], dtype=np.float32))
+            self.interpreter.set_tensor(self.input_indices[1], np.asarray(layout[None], dtype=np.float32))
+            self.interpreter.invoke()
+            outputs.append(self.interpreter.get_tensor(self.output_index))
+        return [np.concatenate(outputs)]
+
+    def _unavailable(self, inputs):
+        raise ValueError(f"Only the {self.direction} direction has been exported.")
+
+def quantization_report(model, generators, faces, layouts, num_runs=20):
+    """
+    Accuracy and single-image latency of quantized generators against the float Keras model.
+    faces, layouts: (N, H, W, 3) arrays of held-out model inputs (not the calibration set)
+
+    Returns:
+        report: dict keyed by "float" and the quantization of each of generators
+    """
+    direction = generators[0].direction
+    path_name = "path_abgr_B" if direction == "AtoB" else "path_abgr_A"
+    float_fn = getattr(model, path_name)
+    float_abgr = float_fn([faces, layouts])[0]
+    report = {"float": {"ms_per_image": time_path(float_fn, faces, layouts, num_runs)}}
+    for generator in generators:
+        if generator.direction != direction:
+            raise ValueError("All generators should be exported for the same direction.")
+        abgr = getattr(generator, path_name)([faces, layouts])[0]
+        r = {
+            "ms_per_image": time_path(getattr(generator, path_name), faces, layouts, num_runs),
+            "alpha_l1": float(np.mean(np.abs(abgr[..., :1] - float_abgr[..., :1]))),
+            "bgr_l1": float(np.mean(np.abs(abgr[..., 1:] - float_abgr[..., 1:]))),
+            "max_abs_diff": float(np.max(np.abs(abgr - float_abgr)))
+        }
+        r["speedup"] = report["float"]["ms_per_image"] / r["ms_per_image"]
+        report[generator.quantization] = r
+    return report
+
+def show_quantization_report(report):
+    print (f"{'model':>10s}{'ms/image':>10s}{'speedup':>9s}{'alpha L1':>10s}{'bgr L1':>10s}{'max diff':>10s}")
+    for name, r in report.items():
+        if name == "float":
+            print (f"{name:>10s}{r['ms_per_image']:10.1f}{1.:9.2f}")
+        else:
+            print (f"{name:>10s}{r['ms_per_image']:10.1f}{r['speedup']:9.2f}"
+                   f"{r['alpha_l1']:10.4f}{r['bgr_l1']:10.4f}{r['max_abs_diff']:10.4f}")
@@ -0,0 +1,154 @@
+from tensorflow.python.client import timeline
+from collections import defaultdict
+from pathlib import Path
+import tensorflow as tf
+import keras.backend as K
+import json
+import os
+
+# Profiling can be switched on without code edits, e.g.
+#   FACESWAP_PROFILE_CALLS=5 FACESWAP_PROFILE_DIR=./profiles jupyter notebook
+ENV_PROFILE_CALLS = "FACESWAP_PROFILE_CALLS"
+ENV_PROFILE_DIR = "FACESWAP_PROFILE_DIR"
+
+class TimelineProfiler():
+    """
+    This class runs K.functions built by function() with full trace RunOptions for the next N calls,
+    and dumps a Chrome-trace JSON timeline plus an op-type cost summary for every traced call.
+
+    Attributes:
+        log_dir: string, directory where timelines and summaries are written
+        remaining_calls: dict, number of calls left to be traced for each wrapped function
+    """
+    def __init__(self, log_dir="./profiles"):
+        self.log_dir = log_dir
+        self.remaining_calls = defaultdict(int)
+        self.call_counts = defaultdict(int)
+        self.functions = {}
+
+    @classmethod
+    def from_env(cls):
+        profiler = cls(log_dir=os.environ.get(ENV_PROFILE_DIR, "./profiles"))
+        num_calls = int(os.environ.get(ENV_PROFILE_CALLS, 0))
+        if num_calls > 0:
+            profiler.enable(num_calls)
+        return profiler
+
+    def function(self, inputs, outputs, updates=None, name="function"):
+        """
+        Same as K.function(inputs, outputs, updates), but the returned function can be traced on demand.
+        Untraced calls go straight to a plain K.function.
+        """
+        profiled_fn = ProfiledFunction(inputs, outputs, updates, name, self)
+        self.functions[name] = profiled_fn
+        if self.remaining_calls["*"] > 0:
+            self.remaining_calls[name] = self.remaining_calls["*"]
+        return profiled_fn
+
+    def enable(self, num_calls=1, names=None, log_dir=None):
+        """
+        Trace the next num_calls calls of the given function names (all wrapped functions if None).
+        """
+        if log_dir is not None:
+            self.log_dir = log_dir
+        if names is None:
+            names = list(self.functions.keys()) + ["*"]
+        for name in names:
+            self.remaining_calls[name] = num_calls
+
+    def disable(self):
+        self.remaining_calls.clear()
+
+    def should_trace(self, name):
+        return self.remaining_calls[name] > 0
+
+    def record(self, name, run_metadata):
+        self.remaining_calls[name] -= 1
+        self.call_counts[name] += 1
+        idx = self.call_counts[name]
+        Path(self.log_dir).mkdir(parents=True, exist_ok=True)
+
+        tl = timeline.Timeline(run_metadata.step_stats)
+        with open(f"{self.log_dir}/timeline_{name}_{idx}.json", "w") as f:
+            f.write(tl.generate_chrome_trace_format())
+
+        summary = op_type_summary(run_metadata)
+        with open(f"{self.log_dir}/op_summary_{name}_{idx}.json", "w") as f:
+            json.dump(summary, f, indent=2)
+        print(f"Profiled {name} (call {idx}): timeline and op summary saved to {self.log_dir}.")
+
+class ProfiledFunction():
+    """
+    Drop-in replacement for a Keras backend Function.
+    Traced calls run a second K.function of the same inputs, outputs and updates that passes
+    full trace RunOptions and a RunMetadata to the session (K.function session kwargs).
+
+    Attributes:
+        fn: the plain K.function
+        traced_fn: the tracing K.function, built on the first traced call
+        name: string, name used for output files
+        profiler: TimelineProfiler instance
+        last_run_metadata: tf.RunMetadata of the latest traced call
+    """
+    def __init__(self, inputs, outputs, updates, name, profiler):
+        self.inputs = inputs
+        self.outputs = outputs
+        self.updates = updates or []
+        self.name = name
+        self.profiler = profiler
+        self.fn = K.function(inputs, outputs, self.updates, name=name)
+        self.traced_fn = None
+        self.run_metadata = None
+        self.last_run_metadata = None
+
+    def __call__(self, inputs):
+        if not self.profiler.should_trace(self.name):
+            return self.fn(inputs)
+        return self._traced_call(inputs)
+
+    def _traced_call(self, inputs):
+        if self.traced_fn is None:
+            self.run_metadata = tf.RunMetadata()
+            self.traced_fn = K.function(self.inputs, self.outputs, self.updates, name=f"{self.name}_traced",
+                                        options=tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE),
+                                        run_metadata=self.run_metadata)
+        # Depending on the Keras version the session merges into or replaces run_metadata
+        self.run_metadata.Clear()
+        outputs = self.traced_fn(inputs)
+        self.last_run_metadata = tf.RunMetadata()
+        self.last_run_metadata.CopyFrom(self.run_metadata)
+        self.profiler.record(self.name, self.last_run_metadata)
+        return outputs
+
+def op_type_summary(run_metadata, graph=None):
+    """
+    Aggregate execution time (microseconds) of traced nodes by op type, sorted by total cost.
+    """
+    graph = graph or K.get_session().graph
+    costs = defaultdict(lambda: {"count": 0, "total_us": 0})
+    for dev_stats in run_metadata.step_stats.dev_stats:
+        for node_stats in dev_stats.node_stats:
+            op_name = node_stats.node_name.split(":")[0]
+            try:
+                op_type = graph.get_operation_by_name(op_name).type
+            except (KeyError, ValueError):
+                op_type = op_name.split("/")[-1]
+            costs[op_type]["count"] += 1
+            costs[op_type]["total_us"] += node_stats.all_end_rel_micros
+    total = sum(c["total_us"] for c in costs.values()) or 1
+    summary = []
+    for op_type, c in sorted(costs.items(), key=lambda kv: -kv[1]["total_us"]):
+        summary.append({"op_type": op_type, "count": c["count"],
+                        "total_us": c["total_us"], "percent": 100. * c["total_us"] / total})
+    return summary
+
+def peak_memory_bytes(run_metadata):
+    """
+    Peak bytes in use of every allocator during a traced call, e.g. {"cpu": 123456}.
+    """
+    peaks = defaultdict(int)
+    for dev_stats in run_metadata.step_stats.dev_stats:
+        for node_stats in dev_stats.node_stats:
+            for mem in node_stats.memory:
+                peaks[mem.allocator_name] = max(peaks[mem.allocator_name], mem.allocator_bytes_in_use, mem.peak_bytes)
+    return dict(peaks)
@@ -0,0 +1,58 @@
+"""
+Warm start: the pretrained encoder stays fixed for the first freeze_encoder_iters generator updates, also when
+it is loaded after the training functions are built.
+"""
+import sys
+from pathlib import Path
+import pytest
+
+REPO_DIR = Path(__file__).resolve().parents[1]
+if str(REPO_DIR) not in sys.path:
+    sys.path.insert(0, str(REPO_DIR))
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("tensorflow")
+pytest.importorskip("keras")
+pytest.importorskip("h5py")
+import keras.backend as K
+from networks.faceswap_gan_model import FaceswapGANModel
+
+RES = 64
+ARCH_CONFIG = {'IMAGE_SHAPE': (RES, RES, 3), 'use_self_attn': False, 'norm': "none", 'model_capacity': "lite"}
+LOSS_WEIGHTS = {'w_D': 0.1, 'w_recon': 1., 'w_edge': 0.1, 'w_eyes': 30., 'w_pl': (0.01, 0.1, 0.3, 0.1)}
+LOSS_CONFIG = {'gan_training': "mixup_LSGAN", 'use_PL': False, 'PL_before_activ': False, 'use_mask_hinge_loss': False,
+               'm_mask': 0., 'lr_factor': 1., 'use_cyclic_loss': False}
+
+def random_batch(rng, batch_size=2):
+    warped, target = [rng.uniform(-1, 1, (batch_size, RES, RES, 3)) for _ in range(2)]
+    bm_eyes = (rng.uniform(size=(batch_size, RES, RES, 3)) > 0.9).astype(np.float32)
+    layout = rng.uniform(0, 1, (batch_size, RES, RES, 3))
+    return warped, target, bm_eyes, layout
+
+def encoder_weights(model):
+    return [w.copy() for w in model.encoder.get_weights()]
+
+@pytest.mark.parametrize("build_first", [True, False])
+def test_pretrained_encoder_is_frozen(tmp_path, build_first):
+    K.clear_session()
+    K.set_learning_phase(1)
+    rng = np.random.RandomState(0)
+    freeze_encoder_iters = 2
+    model = FaceswapGANModel(**ARCH_CONFIG)
+    model.save_weights(str(tmp_path), legacy_files=False)
+    if build_first:
+        model.build_train_functions(loss_weights=LOSS_WEIGHTS, **LOSS_CONFIG)
+        model.load_pretrained_encoder(str(tmp_path), freeze_encoder_iters=freeze_encoder_iters)
+    else:
+        model.load_pretrained_encoder(str(tmp_path), freeze_encoder_iters=freeze_encoder_iters)
+        model.build_train_functions(loss_weights=LOSS_WEIGHTS, **LOSS_CONFIG)
+
+    pretrained = encoder_weights(model)
+    for _ in range(freeze_encoder_iters):
+        model.train_one_batch_G(random_batch(rng), random_batch(rng))
+        for w, w_pretrained in zip(encoder_weights(model), pretrained):
+            np.testing.assert_array_equal(w, w_pretrained)
+    assert not model.encoder_frozen
+    model.train_one_batch_G(random_batch(rng), random_batch(rng))
+    assert any(not np.array_equal(w, w_pretrained) for w, w_pretrained in zip(encoder_weights(model), pretrained))
+    K.clear_session()
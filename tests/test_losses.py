@@ -0,0 +1,189 @@
+"""
+The loss terms built from a shared GeneratorOutputContext (and batched netD/VGGFace passes) must give the
+same values as the original loss builders, which are reproduced below as reference implementations.
+"""
+import sys
+from pathlib import Path
+import pytest
+
+REPO_DIR = Path(__file__).resolve().parents[1]
+if str(REPO_DIR) not in sys.path:
+    sys.path.insert(0, str(REPO_DIR))
+
+np = pytest.importorskip("numpy")
+tf = pytest.importorskip("tensorflow")
+pytest.importorskip("keras")
+import keras.backend as K
+from keras.models import Model
+from keras.layers import Input, Conv2D, LeakyReLU, Lambda, BatchNormalization, concatenate
+from networks import losses
+from networks.losses import GeneratorOutputContext, calc_loss, first_order, inference_mode_model
+from networks.instance_normalization import InstanceNormalization
+
+RES = 32
+LAM = 0.3
+WEIGHTS = {"w_D": 0.1, "w_recon": 1., "w_edge": 0.1, "w_eyes": 30., "w_pl": (0.01, 0.1, 0.3, 0.1)}
+
+class FixedBeta():
+    """
+    Stands in for tf.contrib.distributions.Beta so that old and new graphs use the same mixup factor.
+    """
+    def __init__(self, *args):
+        pass
+    def sample(self):
+        return K.constant(LAM)
+
+# Reference implementations (before the shared generator output context)
+
+def reference_adversarial_loss(netD, real, fake_abgr, distorted, gan_training="mixup_LSGAN", **weights):
+    alpha = Lambda(lambda x: x[:,:,:, :1])(fake_abgr)
+    fake_bgr = Lambda(lambda x: x[:,:,:, 1:])(fake_abgr)
+    fake = alpha * fake_bgr + (1-alpha) * distorted
+    if gan_training == "mixup_LSGAN":
+        lam = FixedBeta(0.2, 0.2).sample()
+        mixup = lam * concatenate([real, distorted]) + (1 - lam) * concatenate([fake, distorted])
+        pred_fake = netD(concatenate([fake, distorted]))
+        pred_mixup = netD(mixup)
+        loss_D = calc_loss(pred_mixup, lam * K.ones_like(pred_mixup), "l2")
+        loss_G = weights['w_D'] * calc_loss(pred_fake, K.ones_like(pred_fake), "l2")
+        mixup2 = lam * concatenate([real, distorted]) + (1 - lam) * concatenate([fake_bgr, distorted])
+        pred_fake_bgr = netD(concatenate([fake_bgr, distorted]))
+        pred_mixup2 = netD(mixup2)
+        loss_D += calc_loss(pred_mixup2, lam * K.ones_like(pred_mixup2), "l2")
+        loss_G += weights['w_D'] * calc_loss(pred_fake_bgr, K.ones_like(pred_fake_bgr), "l2")
+    else:
+        real_pred = netD(concatenate([real, distorted]))
+        fake_pred = netD(concatenate([fake, distorted]))
+        loss_D = K.mean(K.square(real_pred - K.ones_like(fake_pred)))/2
+        loss_D += K.mean(K.square(fake_pred - K.zeros_like(fake_pred)))/2
+        loss_G = weights['w_D'] * K.mean(K.square(fake_pred - K.ones_like(fake_pred)))
+        fake_pred2 = netD(concatenate([fake_bgr, distorted]))
+        loss_D += K.mean(K.square(real_pred - K.mean(fake_pred2,axis=0) - K.ones_like(fake_pred2)))/2
+        loss_D += K.mean(K.square(fake_pred2 - K.mean(real_pred,axis=0) - K.zeros_like(fake_pred2)))/2
+        loss_G += weights['w_D'] * K.mean(K.square(real_pred - K.mean(fake_pred2,axis=0) - K.zeros_like(fake_pred2)))/2
+        loss_G += weights['w_D'] * K.mean(K.square(fake_pred2 - K.mean(real_pred,axis=0) - K.ones_like(fake_pred2)))/2
+    return loss_D, loss_G
+
+def reference_reconstruction_loss(real, fake_abgr, mask_eyes, model_outputs, **weights):
+    fake_bgr = Lambda(lambda x: x[:,:,:, 1:])(fake_abgr)
+    loss_G = 0
+    loss_G += weights['w_recon'] * calc_loss(fake_bgr, real, "l1")
+    loss_G += weights['w_eyes'] * K.mean(K.abs(mask_eyes*(fake_bgr - real)))
+    for out in model_outputs[:-1]:
+        out_size = out.get_shape().as_list()
+        resized_real = tf.image.resize_images(real, out_size[1:3])
+        loss_G += weights['w_recon'] * calc_loss(out, resized_real, "l1")
+    return loss_G
+
+def reference_edge_loss(real, fake_abgr, mask_eyes, **weights):
+    fake_bgr = Lambda(lambda x: x[:,:,:, 1:])(fake_abgr)
+    loss_G = 0
+    loss_G += weights['w_edge'] * calc_loss(first_order(fake_bgr, axis=1), first_order(real, axis=1), "l1")
+    loss_G += weights['w_edge'] * calc_loss(first_order(fake_bgr, axis=2), first_order(real, axis=2), "l1")
+    shape_mask_eyes = mask_eyes.get_shape().as_list()
+    resized_mask_eyes = tf.image.resize_images(mask_eyes, [shape_mask_eyes[1]-1, shape_mask_eyes[2]-1])
+    loss_G += weights['w_eyes'] * K.mean(K.abs(resized_mask_eyes * \
+                                               (first_order(fake_bgr, axis=1) - first_order(real, axis=1))))
+    loss_G += weights['w_eyes'] * K.mean(K.abs(resized_mask_eyes * \
+                                               (first_order(fake_bgr, axis=2) - first_order(real, axis=2))))
+    return loss_G
+
+def reference_perceptual_loss(real, fake_abgr, distorted, mask_eyes, vggface_feats, **weights):
+    alpha = Lambda(lambda x: x[:,:,:, :1])(fake_abgr)
+    fake_bgr = Lambda(lambda x: x[:,:,:, 1:])(fake_abgr)
+    fake = alpha * fake_bgr + (1-alpha) * distorted
+    def preprocess_vggface(x):
+        x = (x + 1)/2 * 255
+        x -= [91.4953, 103.8827, 131.0912]
+        return x
+    real_sz224 = tf.image.resize_images(real, [224, 224])
+    real_sz224 = Lambda(preprocess_vggface)(real_sz224)
+    lam = FixedBeta(0.2, 0.2).sample()
+    mixup = lam*fake_bgr + (1-lam)*fake
+    fake_sz224 = tf.image.resize_images(mixup, [224, 224])
+    fake_sz224 = Lambda(preprocess_vggface)(fake_sz224)
+    real_feat112, real_feat55, real_feat28, real_feat7 = vggface_feats(real_sz224)
+    fake_feat112, fake_feat55, fake_feat28, fake_feat7 = vggface_feats(fake_sz224)
+    loss_G = 0
+    def instnorm(): return InstanceNormalization()
+    loss_G += weights['w_pl'][0] * calc_loss(instnorm()(fake_feat7), instnorm()(real_feat7), "l2")
+    loss_G += weights['w_pl'][1] * calc_loss(instnorm()(fake_feat28), instnorm()(real_feat28), "l2")
+    loss_G += weights['w_pl'][2] * calc_loss(instnorm()(fake_feat55), instnorm()(real_feat55), "l2")
+    loss_G += weights['w_pl'][3] * calc_loss(instnorm()(fake_feat112), instnorm()(real_feat112), "l2")
+    return loss_G
+
+# Small stand-ins of netD and VGGFace
+
+def build_netD():
+    inp = Input(shape=(RES, RES, 6))
+    x = LeakyReLU(0.2)(Conv2D(8, 4, strides=2, padding="same")(inp))
+    x = LeakyReLU(0.2)(Conv2D(16, 4, strides=2, padding="same")(x))
+    return Model(inp, Conv2D(1, 4, padding="same")(x))
+
+def build_vggface_feats():
+    inp = Input(shape=(224, 224, 3))
+    feat112 = Conv2D(4, 3, strides=2, padding="same", activation="relu")(inp)
+    feat55 = Conv2D(4, 3, strides=2, padding="valid", activation="relu")(feat112)
+    feat28 = Conv2D(8, 3, strides=2, padding="same", activation="relu")(feat55)
+    feat7 = Conv2D(8, 4, strides=4, padding="same", activation="relu")(feat28)
+    return Model(inp, [feat112, feat55, feat28, feat7])
+
+@pytest.fixture
+def session(monkeypatch):
+    monkeypatch.setattr(losses, "Beta", FixedBeta)
+    K.clear_session()
+    K.set_learning_phase(0)
+    yield K.get_session()
+    K.clear_session()
+
+@pytest.mark.parametrize("gan_training", ["mixup_LSGAN", "relativistic_avg_LSGAN"])
+def test_losses_unchanged(session, gan_training):
+    real, distorted, mask_eyes = [Input(shape=(RES, RES, 3)) for _ in range(3)]
+    fake_abgr = Input(shape=(RES, RES, 4))
+    out16 = Input(shape=(RES//2, RES//2, 3))
+    model_outputs = [out16, fake_abgr]
+    netD, vggface_feats = build_netD(), build_vggface_feats()
+
+    ctx = GeneratorOutputContext(real, fake_abgr, distorted, mask_eyes, model_outputs)
+    new_D, new_adv_G = losses.adversarial_loss(netD, ctx, gan_training, **WEIGHTS)
+    new = [new_D, new_adv_G,
+           losses.reconstruction_loss(ctx, **WEIGHTS),
+           losses.edge_loss(ctx, **WEIGHTS),
+           losses.perceptual_loss(ctx, vggface_feats, **WEIGHTS)]
+    ref_D, ref_adv_G = reference_adversarial_loss(netD, real, fake_abgr, distorted, gan_training, **WEIGHTS)
+    ref = [ref_D, ref_adv_G,
+           reference_reconstruction_loss(real, fake_abgr, mask_eyes, model_outputs, **WEIGHTS),
+           reference_edge_loss(real, fake_abgr, mask_eyes, **WEIGHTS),
+           reference_perceptual_loss(real, fake_abgr, distorted, mask_eyes, vggface_feats, **WEIGHTS)]
+
+    rng = np.random.RandomState(0)
+    batch_size = 4
+    feed = [rng.uniform(-1, 1, (batch_size, RES, RES, 3)),
+            rng.uniform(-1, 1, (batch_size, RES, RES, 3)),
+            (rng.uniform(0, 1, (batch_size, RES, RES, 3)) > 0.8).astype(np.float32),
+            np.concatenate([rng.uniform(0, 1, (batch_size, RES, RES, 1)),
+                            rng.uniform(-1, 1, (batch_size, RES, RES, 3))], axis=-1),
+            rng.uniform(-1, 1, (batch_size, RES//2, RES//2, 3))]
+    fn = K.function([real, distorted, mask_eyes, fake_abgr, out16], new + ref)
+    values = fn(feed)
+    names = ["adversarial_D", "adversarial_G", "reconstruction", "edge", "perceptual"]
+    for name, new_value, ref_value in zip(names, values[:len(new)], values[len(new):]):
+        np.testing.assert_allclose(new_value, ref_value, rtol=1e-5, atol=1e-6, err_msg=name)
+
+def test_inference_mode_model_uses_moving_statistics():
+    K.clear_session()
+    inp = Input(shape=(8, 8, 3))
+    x = BatchNormalization()(Conv2D(4, 3, padding="same")(inp))
+    model = Model(inp, Conv2D(2, 1)(x))
+    inference_model = inference_mode_model(model)
+
+    x = Input(shape=(8, 8, 3))
+    fn = K.function([x, K.learning_phase()], [model(x), inference_model(x)])
+    batch = np.random.RandomState(0).uniform(-1, 1, (4, 8, 8, 3))
+    train_out, train_inference_out = fn([batch, 1])
+    test_out, test_inference_out = fn([batch, 0])
+    # The new model ignores the learning phase, the original model still uses batch statistics in training
+    np.testing.assert_allclose(train_inference_out, test_out, rtol=1e-5, atol=1e-6)
+    np.testing.assert_allclose(test_inference_out, test_out, rtol=1e-5, atol=1e-6)
+    assert not np.allclose(train_out, test_out, atol=1e-3)
+    K.clear_session()
@@ -0,0 +1,38 @@
+"""
+chunked_attention must give the same outputs and gradients as full attention, including its recomputed backprop.
+"""
+import sys
+from pathlib import Path
+import pytest
+
+REPO_DIR = Path(__file__).resolve().parents[1]
+if str(REPO_DIR) not in sys.path:
+    sys.path.insert(0, str(REPO_DIR))
+
+np = pytest.importorskip("numpy")
+tf = pytest.importorskip("tensorflow")
+pytest.importorskip("keras")
+import keras.backend as K
+from networks.nn_blocks import chunked_attention
+
+def full_attention(q, k, v):
+    return K.batch_dot(K.softmax(K.batch_dot(q, K.permute_dimensions(k, (0, 2, 1)))), v)
+
+@pytest.mark.parametrize("chunk_size", [4, 5, 16])
+def test_chunked_attention_matches_full_attention(chunk_size):
+    K.clear_session()
+    rng = np.random.RandomState(0)
+    batch_size, n, d, c = 2, 16, 4, 6
+    q, k, v = [K.placeholder(shape=(batch_size, n, nc)) for nc in [d, d, c]]
+    # Random projection of the outputs, so that every output element has its own gradient
+    w = K.constant(rng.uniform(-1, 1, (batch_size, n, c)))
+    chunked, full = chunked_attention(q, k, v, chunk_size), full_attention(q, k, v)
+    grads_chunked = K.gradients(K.sum(chunked * w), [q, k, v])
+    grads_full = K.gradients(K.sum(full * w), [q, k, v])
+
+    fn = K.function([q, k, v], [chunked, full] + grads_chunked + grads_full)
+    values = fn([rng.normal(size=(batch_size, n, nc)) for nc in [d, d, c]])
+    np.testing.assert_allclose(values[0], values[1], rtol=1e-5, atol=1e-6)
+    for name, grad_chunked, grad_full in zip(["q", "k", "v"], values[2:5], values[5:]):
+        np.testing.assert_allclose(grad_chunked, grad_full, rtol=1e-4, atol=1e-5, err_msg=f"gradient of {name}")
+    K.clear_session()
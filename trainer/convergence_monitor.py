@@ -0,0 +1,107 @@
+from pathlib import Path
+import numpy as np
+
+class ConvergenceMonitor():
+    """
+    This class periodically evaluates reconstruction error on a fixed held-out batch of A and B faces,
+    fits a linear trend over the recent evaluations and detects plateaus.
+
+    On a plateau, training is either stopped (action="stop") or the learning rate is stepped down
+    (action="lr_decay", see FaceswapGANModel.set_lr_factor) until min_lr_factor is reached.
+    A final checkpoint is written when training is stopped.
+
+    Attributes:
+        history: list of (iteration, error) tuples of the current learning rate stage
+        lr_factor: float, current learning rate factor
+        num_plateaus: int, number of consecutive evaluations without sufficient improvement
+
+    Example:
+        monitor = ConvergenceMonitor(model, val_batchA.get_next_batch(), val_batchB.get_next_batch(),
+                                     lr_factor=loss_config['lr_factor'])
+        while gen_iterations <= TOTAL_ITERS:
+            ... # train one batch
+            if monitor.update(gen_iterations):
+                break
+    """
+    def __init__(self, model, holdout_A, holdout_B, lr_factor=1., eval_interval=500, window=10,
+                 min_rel_improvement=0.01, patience=2, action="stop", lr_decay_factor=0.5,
+                 min_lr_factor=0.1, checkpoint_path="./models"):
+        if action not in ["stop", "lr_decay"]:
+            raise ValueError(f"action should be either stop or lr_decay, received {action}.")
+        if window < 2:
+            raise ValueError(f"window should be at least 2 evaluations, received {window}.")
+        self.model = model
+        self.holdout_A = model.unpack_batch(holdout_A)[:4]
+        self.holdout_B = model.unpack_batch(holdout_B)[:4]
+        self.lr_factor = lr_factor
+        self.eval_interval = eval_interval
+        self.window = window
+        self.min_rel_improvement = min_rel_improvement
+        self.patience = patience
+        self.action = action
+        self.lr_decay_factor = lr_decay_factor
+        self.min_lr_factor = min_lr_factor
+        self.checkpoint_path = checkpoint_path
+
+        self.history = []
+        self.num_plateaus = 0
+        self.stopped_at = None
+
+    def evaluate(self):
+        """
+        Mean L1 reconstruction error (BGR output vs. target) over the held-out batches of both sides.
+        """
+        errs = []
+        for path_bgr, (warped, target, _, layout) in [(self.model.path_bgr_A, self.holdout_A),
+                                                      (self.model.path_bgr_B, self.holdout_B)]:
+            pred = path_bgr([warped, layout])[0]
+            errs.append(np.mean(np.abs(pred - target)))
+        return float(np.mean(errs))
+
+    def relative_improvement(self):
+        """
+        Error decrease over the last window evaluations, estimated by a linear fit
+        and normalized by the mean error of the window.
+        """
+        iters, errs = zip(*self.history[-self.window:])
+        slope, _ = np.polyfit(iters, errs, 1)
+        return -slope * (iters[-1] - iters[0]) / max(np.mean(errs), 1e-8)
+
+    def update(self, iteration):
+        """
+        Returns:
+            should_stop: bool, True once the model has converged and the final checkpoint is written
+        """
+        if iteration % self.eval_interval != 0 or self.stopped_at is not None:
+            return self.stopped_at is not None
+        self.history.append((iteration, self.evaluate()))
+        if len(self.history) < self.window:
+            return False
+
+        rel_improvement = self.relative_improvement()
+        if rel_improvement >= self.min_rel_improvement:
+            self.num_plateaus = 0
+            return False
+        self.num_plateaus += 1
+        if self.num_plateaus < self.patience:
+            return False
+
+        new_lr_factor = self.lr_factor * self.lr_decay_factor
+        if self.action == "lr_decay" and new_lr_factor >= self.min_lr_factor:
+            print (f"[Iter {iteration}] Reconstruction error plateaued (relative improvement {rel_improvement:.4f}). "
+                   f"Decaying lr_factor {self.lr_factor} -> {new_lr_factor}.")
+            self.model.set_lr_factor(new_lr_factor)
+            self.lr_factor = new_lr_factor
+            self.history = []
+            self.num_plateaus = 0
+            return False
+
+        print (f"[Iter {iteration}] Reconstruction error converged at {self.history[-1][1]:.4f} "
+               f"(relative improvement {rel_improvement:.4f}). Stop training.")
+        self.stopped_at = iteration
+        self.save_checkpoint()
+        return True
+
+    def save_checkpoint(self):
+        Path(self.checkpoint_path).mkdir(parents=True, exist_ok=True)
+        self.model.save_weights(path=self.checkpoint_path)
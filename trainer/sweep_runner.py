@@ -0,0 +1,275 @@
+import os
+import sys
+import csv
+import copy
+import glob
+import json
+import time
+import itertools
+import subprocess
+import numpy as np
+from pathlib import Path
+
+REPO_DIR = Path(__file__).resolve().parents[1]
+if str(REPO_DIR) not in sys.path:
+    sys.path.insert(0, str(REPO_DIR))
+LOSS_KEYS = ['ttl', 'adv', 'recon', 'edge', 'pl']
+
+def set_by_path(config, key, value):
+    """
+    Set config["arch_config"]["norm"] for key "arch_config.norm".
+    """
+    *parents, leaf = key.split(".")
+    for k in parents:
+        config = config.setdefault(k, {})
+    config[leaf] = value
+
+def sample_value(space, rng):
+    # Lists are sampled uniformly, dicts describe continuous ranges: {"uniform": [lo, hi]} or {"log_uniform": [lo, hi]}
+    if isinstance(space, list):
+        return space[rng.randint(len(space))]
+    if "uniform" in space:
+        return float(rng.uniform(*space["uniform"]))
+    if "log_uniform" in space:
+        lo, hi = np.log(space["log_uniform"])
+        return float(np.exp(rng.uniform(lo, hi)))
+    raise ValueError(f"Receive an unknown search space: {space}.")
+
+def expand_spec(spec):
+    """
+    Expand a sweep spec into a list of (params, job config) tuples.
+
+    A spec looks like
+        {
+            "base": {"arch_config": {...}, "loss_config": {...}, "loss_weights": {...}, "da_config": {...},
+                     "data": {"img_dirA": ..., "img_dirB": ..., "img_dirA_bm_eyes": ..., ...},
+                     "batch_size": 8, "num_iters": 2000},
+            "search": "grid", # or "random"
+            "params": {"arch_config.norm": ["instancenorm", "batchnorm"],
+                       "loss_weights.w_D": {"log_uniform": [0.01, 1.]}},
+            "num_trials": 8, # random search only
+            "seed": 0
+        }
+    """
+    search = spec.get("search", "grid")
+    params = spec.get("params", {})
+    if search == "grid":
+        for space in params.values():
+            if not isinstance(space, list):
+                raise ValueError(f"Grid search requires lists of values, received {space}.")
+        keys = list(params.keys())
+        trials = [dict(zip(keys, values)) for values in itertools.product(*[params[k] for k in keys])]
+    elif search == "random":
+        rng = np.random.RandomState(spec.get("seed", 0))
+        trials = [{k: sample_value(space, rng) for k, space in params.items()}
+                  for _ in range(spec["num_trials"])]
+    else:
+        raise ValueError(f"search should be either grid or random, received {search}.")
+
+    jobs = []
+    for trial in trials:
+        config = copy.deepcopy(spec["base"])
+        for k, v in trial.items():
+            set_by_path(config, k, v)
+        jobs.append((trial, config))
+    return jobs
+
+def get_filenames(data):
+    fns_A = sorted(glob.glob(data["img_dirA"]+"/*.*"))
+    fns_B = sorted(glob.glob(data["img_dirB"]+"/*.*"))
+    assert len(fns_A), "No image found in " + str(data["img_dirA"])
+    assert len(fns_B), "No image found in " + str(data["img_dirB"])
+    return fns_A, fns_B
+
+def run_worker(config_path):
+    """
+    Run one short training job described by config_path and write result.json next to it.
+    Thread budgets are applied before TensorFlow is imported.
+    """
+    with open(config_path, "r") as f:
+        config = json.load(f)
+    job_dir = Path(config_path).parent
+    num_threads = config.get("num_threads", 1)
+    os.environ["OMP_NUM_THREADS"] = str(num_threads)
+    if config.get("cpus") and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, config["cpus"])
+
+    import tensorflow as tf
+    import keras.backend as K
+    from networks.faceswap_gan_model import FaceswapGANModel
+    from data_loader.data_loader import DataLoader
+    from data_loader.image_cache import set_image_cache
+
+    K.set_session(tf.Session(config=tf.ConfigProto(intra_op_parallelism_threads=num_threads,
+                                                   inter_op_parallelism_threads=2)))
+    K.set_learning_phase(1)
+    if config.get("cache_dir"):
+        set_image_cache(config["cache_dir"])
+
+    arch_config = config["arch_config"]
+    arch_config['IMAGE_SHAPE'] = tuple(arch_config['IMAGE_SHAPE'])
+    loss_config = config["loss_config"]
+    da_config = config["da_config"]
+    data = config["data"]
+    batch_size = config.get("batch_size", 8)
+    num_iters = config.get("num_iters", 1000)
+    warmup_iters = config.get("warmup_iters", 50)
+    metric_window = config.get("metric_window", 100)
+
+    model = FaceswapGANModel(**arch_config)
+    if loss_config['use_PL']:
+        from keras_vggface.vggface import VGGFace
+        vggface = VGGFace(include_top=False, model='resnet50', input_shape=(224, 224, 3))
+        model.build_pl_model(vggface_model=vggface, before_activ=loss_config["PL_before_activ"])
+    model.build_train_functions(loss_weights=config["loss_weights"], **loss_config)
+
+    fns_A, fns_B = get_filenames(data)
+    resolution = arch_config['IMAGE_SHAPE'][0]
+    train_batchA = DataLoader(fns_A, fns_A + fns_B, batch_size, data.get("img_dirA_bm_eyes"),
+                              data.get("img_dirA_layout"), resolution, num_threads, K.get_session(),
+                              use_target_pyramid=loss_config.get('use_target_pyramid', False), **da_config)
+    train_batchB = DataLoader(fns_B, fns_A + fns_B, batch_size, data.get("img_dirB_bm_eyes"),
+                              data.get("img_dirB_layout"), resolution, num_threads, K.get_session(),
+                              use_target_pyramid=loss_config.get('use_target_pyramid', False), **da_config)
+
+    errDs, errGAs, errGBs = [], [], []
+    warmup_iters = min(warmup_iters, num_iters - 1)
+    t0 = time.time()
+    for i in range(num_iters):
+        if i == warmup_iters:
+            t0 = time.time()
+        errDA, errDB = model.train_one_batch_D(data_A=train_batchA.get_next_batch(),
+                                               data_B=train_batchB.get_next_batch())
+        errGA, errGB = model.train_one_batch_G(data_A=train_batchA.get_next_batch(),
+                                               data_B=train_batchB.get_next_batch())
+        errDs.append((errDA[0] + errDB[0]) / 2)
+        errGAs.append(errGA)
+        errGBs.append(errGB)
+    elapsed = time.time() - t0
+
+    result = {"num_iters": num_iters, "batch_size": batch_size}
+    result["iters_per_sec"] = (num_iters - warmup_iters) / elapsed
+    result["samples_per_sec"] = result["iters_per_sec"] * batch_size * 4 # D and G steps of both sides
+    result["loss_D"] = float(np.mean(errDs[-metric_window:]))
+    for i, k in enumerate(LOSS_KEYS):
+        result[f"loss_GA_{k}"] = float(np.mean([err[i] for err in errGAs[-metric_window:]]))
+        result[f"loss_GB_{k}"] = float(np.mean([err[i] for err in errGBs[-metric_window:]]))
+    result["loss_recon"] = (result["loss_GA_recon"] + result["loss_GB_recon"]) / 2
+    with open(f"{job_dir}/result.json", "w") as f:
+        json.dump(result, f, indent=2)
+    if config.get("save_weights", False):
+        model.save_weights(path=str(job_dir))
+
+class SweepRunner():
+    """
+    Run the jobs of a sweep spec (see expand_spec) as concurrent worker processes.
+
+    Each job gets a disjoint set of CPU cores (cpus_per_job) and the same number of TF/OpenMP threads.
+    Images, eye masks and layouts are decoded once into a memory-mapped cache shared read-only by all jobs.
+    Loss and throughput metrics of all jobs are collected into report.json and report.csv.
+
+    Example:
+        runner = SweepRunner(spec, output_dir="./sweeps/norm_vs_wD", cpus_per_job=4)
+        rows = runner.run()
+    """
+    def __init__(self, spec, output_dir="./sweeps", cpus_per_job=4, max_parallel=None, use_image_cache=True):
+        if hasattr(os, "sched_getaffinity"):
+            cpus = sorted(os.sched_getaffinity(0))
+        else:
+            cpus = list(range(os.cpu_count()))
+        self.spec = spec
+        self.output_dir = output_dir
+        self.cpus_per_job = min(cpus_per_job, len(cpus))
+        self.max_parallel = max_parallel or max(1, len(cpus) // self.cpus_per_job)
+        self.cpu_slots = [cpus[(i*self.cpus_per_job) % len(cpus):][:self.cpus_per_job]
+                          for i in range(self.max_parallel)]
+        self.use_image_cache = use_image_cache
+        self.jobs = expand_spec(spec)
+
+    def build_cache(self):
+        from data_loader.image_cache import cache_filenames, build_image_cache
+        data = self.spec["base"]["data"]
+        da_config = self.spec["base"]["da_config"]
+        fns_A, fns_B = get_filenames(data)
+        fns = []
+        for fns_side, side in [(fns_A, "A"), (fns_B, "B")]:
+            fns += cache_filenames(fns_side,
+                                   data.get(f"img_dir{side}_bm_eyes") if da_config.get("use_bm_eyes") else None,
+                                   data.get(f"img_dir{side}_layout") if da_config.get("use_layout") else None)
+        return build_image_cache(fns, f"{self.output_dir}/image_cache")
+
+    def launch(self, idx, config, cpus):
+        job_dir = Path(f"{self.output_dir}/job_{idx:03d}")
+        job_dir.mkdir(parents=True, exist_ok=True)
+        config = dict(config, cpus=cpus, num_threads=len(cpus))
+        with open(job_dir / "config.json", "w") as f:
+            json.dump(config, f, indent=2)
+        log = open(job_dir / "log.txt", "w")
+        # Jobs keep the current working directory so that relative data paths (and image cache keys) match
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join([str(REPO_DIR), os.environ.get("PYTHONPATH", "")]))
+        proc = subprocess.Popen([sys.executable, "-m", "trainer.sweep_runner", "--worker", str(job_dir / "config.json")],
+                                env=env, stdout=log, stderr=subprocess.STDOUT)
+        return proc, log
+
+    def run(self, poll_interval=5):
+        Path(self.output_dir).mkdir(parents=True, exist_ok=True)
+        cache_dir = self.build_cache() if self.use_image_cache else None
+
+        pending = list(range(len(self.jobs)))
+        running = {} # slot index -> (job index, process, log file)
+        returncodes = {}
+        t0 = time.time()
+        while pending or running:
+            for slot, (idx, proc, log) in list(running.items()):
+                if proc.poll() is not None:
+                    log.close()
+                    returncodes[idx] = proc.returncode
+                    del running[slot]
+                    print (f"Job {idx} finished with return code {proc.returncode} ({time.time()-t0:.0f}s).")
+            for slot in range(self.max_parallel):
+                if slot not in running and pending:
+                    idx = pending.pop(0)
+                    config = dict(self.jobs[idx][1], cache_dir=cache_dir)
+                    running[slot] = (idx, *self.launch(idx, config, self.cpu_slots[slot]))
+            time.sleep(poll_interval)
+        return self.collect_report(returncodes)
+
+    def collect_report(self, returncodes={}):
+        rows = []
+        for idx, (params, _) in enumerate(self.jobs):
+            row = {"job": idx, **params}
+            fn = f"{self.output_dir}/job_{idx:03d}/result.json"
+            if Path(fn).exists():
+                with open(fn, "r") as f:
+                    row.update(json.load(f))
+                row["status"] = "done"
+            else:
+                row["status"] = f"failed ({returncodes.get(idx)})"
+            rows.append(row)
+        rows.sort(key=lambda row: row.get("loss_recon", float("inf")))
+
+        with open(f"{self.output_dir}/report.json", "w") as f:
+            json.dump(rows, f, indent=2)
+        fieldnames = list(dict.fromkeys(k for row in rows for k in row))
+        with open(f"{self.output_dir}/report.csv", "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames)
+            writer.writeheader()
+            writer.writerows(rows)
+        print (f"Sweep report of {len(rows)} jobs is saved to {self.output_dir}/report.csv.")
+        return rows
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Hyperparameter sweep of faceswap-GAN training.")
+    parser.add_argument("spec", nargs="?", help="sweep spec json file")
+    parser.add_argument("--worker", help="run a single job config (used by SweepRunner)")
+    parser.add_argument("--output_dir", default="./sweeps")
+    parser.add_argument("--cpus_per_job", type=int, default=4)
+    parser.add_argument("--max_parallel", type=int, default=None)
+    args = parser.parse_args()
+    if args.worker:
+        run_worker(args.worker)
+    else:
+        with open(args.spec, "r") as f:
+            spec = json.load(f)
+        SweepRunner(spec, args.output_dir, args.cpus_per_job, args.max_parallel).run()
@@ -0,0 +1,273 @@
+import os
+import sys
+import json
+import time
+import platform
+import tempfile
+import subprocess
+import numpy as np
+from pathlib import Path
+
+REPO_DIR = Path(__file__).resolve().parents[1]
+if str(REPO_DIR) not in sys.path:
+    sys.path.insert(0, str(REPO_DIR))
+DEFAULT_CONFIG_PATH = str(Path.home() / ".faceswap_gan" / "thread_configs.json")
+WORKLOADS = ["train", "convert"]
+
+def available_cpus():
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count()))
+
+def physical_cpus(cpus):
+    """
+    One logical CPU per physical core (hyperthreads removed), based on Linux sysfs topology.
+    """
+    selected, seen = [], set()
+    for cpu in cpus:
+        fn = f"/sys/devices/system/cpu/cpu{cpu}/topology/thread_siblings_list"
+        try:
+            with open(fn, "r") as f:
+                siblings = f.read().strip()
+        except IOError:
+            return list(cpus)
+        if siblings not in seen:
+            seen.add(siblings)
+            selected.append(cpu)
+    return selected
+
+def machine_type():
+    """
+    Key of the persisted configurations, e.g. "x86_64|Intel(R) Xeon(R) CPU @ 2.20GHz|8cpus".
+    """
+    cpu_model = platform.processor() or "unknown"
+    try:
+        with open("/proc/cpuinfo", "r") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    cpu_model = line.split(":", 1)[1].strip()
+                    break
+    except IOError:
+        pass
+    return f"{platform.machine()}|{cpu_model}|{len(available_cpus())}cpus"
+
+def candidate_configs(cpus=None):
+    """
+    Candidate splits of the CPUs between TF intra-op threads, inter-op threads and data loader workers,
+    on all logical CPUs and on physical cores only.
+    """
+    cpus = cpus or available_cpus()
+    cpu_sets = [cpus]
+    if len(physical_cpus(cpus)) < len(cpus):
+        cpu_sets.append(physical_cpus(cpus))
+    candidates = []
+    for cpu_set in cpu_sets:
+        num_cpus = len(cpu_set)
+        for loader_workers in sorted({1, max(1, num_cpus//4), max(1, num_cpus//2)}):
+            for inter_op in sorted({1, 2, max(1, num_cpus//4)}):
+                candidates.append({
+                    "cpus": cpu_set,
+                    "intra_op": max(1, num_cpus - loader_workers),
+                    "inter_op": inter_op,
+                    "loader_workers": loader_workers
+                })
+    return candidates
+
+def load_thread_configs(config_path=DEFAULT_CONFIG_PATH):
+    if not Path(config_path).exists():
+        return {}
+    with open(config_path, "r") as f:
+        return json.load(f)
+
+def get_best_config(workload="train", config_path=DEFAULT_CONFIG_PATH):
+    return load_thread_configs(config_path).get(machine_type(), {}).get(workload, {}).get("config")
+
+def apply_thread_config(config):
+    """
+    Pin the process to config["cpus"] and make TF use the tuned thread pools.
+    OMP_NUM_THREADS (MKL/oneDNN builds) only takes effect if this runs before TensorFlow is imported.
+
+    Returns:
+        session: tf.Session, also set as the Keras session
+    """
+    os.environ["OMP_NUM_THREADS"] = str(config["intra_op"])
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, config["cpus"])
+    import tensorflow as tf
+    import keras.backend as K
+    session = tf.Session(config=tf.ConfigProto(intra_op_parallelism_threads=config["intra_op"],
+                                               inter_op_parallelism_threads=config["inter_op"]))
+    K.set_session(session)
+    return session
+
+def create_session(workload="train", config_path=DEFAULT_CONFIG_PATH):
+    """
+    Create the Keras session with the tuned configuration of this machine type, if any.
+
+    Returns:
+        num_loader_workers: int, use as num_cpus of DataLoader
+    """
+    config = get_best_config(workload, config_path)
+    if config is None:
+        print (f"No tuned thread configuration of {workload} for {machine_type()}. TF defaults are used.")
+        return os.cpu_count()
+    apply_thread_config(config)
+    print (f"Thread configuration of {workload}: intra_op={config['intra_op']}, inter_op={config['inter_op']}, "
+           f"loader_workers={config['loader_workers']}, {len(config['cpus'])} cpus.")
+    return config["loader_workers"]
+
+def calibrate_train(settings, config):
+    """
+    Iterations per second of the real training step (D and G updates) with DataLoader inputs.
+    """
+    import keras.backend as K
+    from networks.faceswap_gan_model import FaceswapGANModel
+    from data_loader.data_loader import DataLoader
+    from trainer.sweep_runner import get_filenames
+
+    K.set_learning_phase(1)
+    arch_config = dict(settings["arch_config"], IMAGE_SHAPE=tuple(settings["arch_config"]["IMAGE_SHAPE"]))
+    model = FaceswapGANModel(**arch_config)
+    model.build_train_functions(loss_weights=settings["loss_weights"], **settings["loss_config"])
+
+    data = settings["data"]
+    fns_A, fns_B = get_filenames(data)
+    loaders = [DataLoader(fns, fns_A + fns_B, settings.get("batch_size", 8), data.get(f"img_dir{side}_bm_eyes"),
+                          data.get(f"img_dir{side}_layout"), arch_config['IMAGE_SHAPE'][0],
+                          config["loader_workers"], K.get_session(), **settings["da_config"])
+               for fns, side in [(fns_A, "A"), (fns_B, "B")]]
+    def step():
+        model.train_one_batch_D(data_A=loaders[0].get_next_batch(), data_B=loaders[1].get_next_batch())
+        model.train_one_batch_G(data_A=loaders[0].get_next_batch(), data_B=loaders[1].get_next_batch())
+    return step
+
+def calibrate_convert(settings, config):
+    """
+    Frames per second of face detection plus the generator forward pass on sample frames.
+    """
+    import cv2
+    import glob
+    import keras.backend as K
+    from networks.faceswap_gan_model import FaceswapGANModel
+    from detector.face_detector import MTCNNFaceDetector
+
+    K.set_learning_phase(0)
+    arch_config = dict(settings["arch_config"], IMAGE_SHAPE=tuple(settings["arch_config"]["IMAGE_SHAPE"]))
+    model = FaceswapGANModel(mode="inference", direction="AtoB", **arch_config)
+    if settings.get("models_dir"):
+        model.load_weights(path=settings["models_dir"])
+    fd = MTCNNFaceDetector(sess=K.get_session(), model_path=settings.get("mtcnn_weights_dir", "./mtcnn_weights/"))
+    frames = [cv2.imread(fn)[..., ::-1] for fn in sorted(glob.glob(settings["frames_dir"] + "/*.*"))]
+    assert len(frames), "No frame found in " + str(settings["frames_dir"])
+    res = arch_config['IMAGE_SHAPE'][0]
+    state = {"idx": 0}
+    def step():
+        frame = frames[state["idx"] % len(frames)]
+        state["idx"] += 1
+        faces, _ = fd.detect_face(frame)
+        for x0, y1, x1, y0, _ in faces:
+            face = frame[int(x0):int(x1), int(y0):int(y1), :]
+            if face.size == 0:
+                continue
+            face = cv2.resize(face, (res, res)) / 255. * 2 - 1
+            model.path_abgr_B([[face], [np.zeros_like(face)]])
+    return step
+
+def run_calibration(job_path):
+    with open(job_path, "r") as f:
+        job = json.load(f)
+    config = job["config"]
+    apply_thread_config(config)
+    build_step = calibrate_train if job["workload"] == "train" else calibrate_convert
+    step = build_step(job["settings"], config)
+    for _ in range(job["num_warmup"]):
+        step()
+    t0 = time.time()
+    for _ in range(job["num_steps"]):
+        step()
+    return job["num_steps"] / (time.time() - t0)
+
+class ThreadAutotuner():
+    """
+    Find the split of CPU cores between TF intra-op/inter-op thread pools and data loader workers
+    that maximizes throughput of a real workload, and persist it per machine type.
+
+    Each candidate is calibrated in a fresh process, since TF thread pools are fixed at session creation.
+
+    Attributes:
+        workload: "train" (steps/s of train_one_batch_D + train_one_batch_G) or "convert" (frames/s of detection + generator)
+        settings: dict, workload settings. train: arch_config, loss_config, loss_weights, da_config, data, batch_size
+                  (see trainer/sweep_runner.py). convert: arch_config, frames_dir, models_dir, mtcnn_weights_dir.
+        results: list of (candidate, throughput) of the last run
+
+    Example:
+        ThreadAutotuner("train", settings).run()
+        # later, before building the model
+        num_cpus = create_session("train")
+    """
+    def __init__(self, workload, settings, config_path=DEFAULT_CONFIG_PATH, candidates=None,
+                 num_warmup=5, num_steps=20):
+        if workload not in WORKLOADS:
+            raise ValueError(f"workload should be either train or convert, received {workload}.")
+        self.workload = workload
+        self.settings = settings
+        self.config_path = config_path
+        self.candidates = candidates or candidate_configs()
+        self.num_warmup = num_warmup
+        self.num_steps = num_steps
+        self.results = []
+
+    def calibrate(self, config):
+        job = {"workload": self.workload, "settings": self.settings, "config": config,
+               "num_warmup": self.num_warmup, "num_steps": self.num_steps}
+        with tempfile.NamedTemporaryFile("w", suffix=".json", delete=False) as f:
+            json.dump(job, f)
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join([str(REPO_DIR), os.environ.get("PYTHONPATH", "")]))
+        out = subprocess.run([sys.executable, "-m", "trainer.thread_autotuner", "--calibrate", f.name],
+                             env=env, stdout=subprocess.PIPE)
+        os.remove(f.name)
+        if out.returncode != 0:
+            return None
+        return float(out.stdout.decode("utf-8").strip().splitlines()[-1])
+
+    def run(self):
+        self.results = []
+        for i, config in enumerate(self.candidates):
+            throughput = self.calibrate(config)
+            self.results.append((config, throughput))
+            print (f"[{i+1}/{len(self.candidates)}] intra_op={config['intra_op']} inter_op={config['inter_op']} "
+                   f"loader_workers={config['loader_workers']} cpus={len(config['cpus'])}: "
+                   + (f"{throughput:.2f} steps/s" if throughput is not None else "failed"))
+        succeeded = [r for r in self.results if r[1] is not None]
+        if not succeeded:
+            raise RuntimeError(f"All {len(self.candidates)} calibration runs of {self.workload} failed.")
+        best, throughput = max(succeeded, key=lambda r: r[1])
+        self.save(best, throughput)
+        return best
+
+    def save(self, config, throughput):
+        configs = load_thread_configs(self.config_path)
+        configs.setdefault(machine_type(), {})[self.workload] = {
+            "config": config,
+            "throughput": throughput,
+            "tuned_at": time.strftime("%Y-%m-%d %H:%M:%S")
+        }
+        Path(self.config_path).parent.mkdir(parents=True, exist_ok=True)
+        with open(self.config_path, "w") as f:
+            json.dump(configs, f, indent=2)
+        print (f"Best {self.workload} configuration ({throughput:.2f} steps/s) is saved to {self.config_path}.")
+
+if __name__ == "__main__":
+    import argparse
+    parser = argparse.ArgumentParser(description="Tune TF thread pools and loader workers of faceswap-GAN.")
+    parser.add_argument("--calibrate", help="run a single calibration job (used by ThreadAutotuner)")
+    parser.add_argument("--workload", choices=WORKLOADS, default="train")
+    parser.add_argument("--settings", help="workload settings json file")
+    parser.add_argument("--config_path", default=DEFAULT_CONFIG_PATH)
+    args = parser.parse_args()
+    if args.calibrate:
+        print (run_calibration(args.calibrate))
+    else:
+        with open(args.settings, "r") as f:
+            settings = json.load(f)
+        ThreadAutotuner(args.workload, settings, args.config_path).run()
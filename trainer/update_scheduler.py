@@ -0,0 +1,121 @@
+import numpy as np
+import time
+
+class AdaptiveUpdateScheduler():
+    """
+    This class wraps train_one_batch_D/train_one_batch_G of FaceswapGANModel and adapts the number of
+    discriminator steps per generator step to the balance of the adversarial game.
+
+    The ratio is lowered (down to min_d_ratio, possibly skipping D steps) while the running discriminator loss
+    is below d_loss_low, i.e. the discriminator is dominating, and raised (up to max_d_ratio) while it is
+    above d_loss_high.
+
+    Attributes:
+        d_ratio: float, current number of D steps per G step
+        ema_loss_D, ema_loss_G: exponential moving averages of the discriminator/generator (adversarial) losses
+        num_D_steps, num_G_steps, num_D_skipped: step counters
+        avg_D_step_time: float, running average of D step duration in seconds
+
+    Example:
+        scheduler = AdaptiveUpdateScheduler(model)
+        while gen_iterations <= TOTAL_ITERS:
+            errDA, errDB, errGA, errGB = scheduler.step(train_batchA.get_next_batch, train_batchB.get_next_batch)
+            ...
+        scheduler.show_report()
+    """
+    def __init__(self, model, init_d_ratio=1., min_d_ratio=0.2, max_d_ratio=2.,
+                 d_loss_low=0.05, d_loss_high=0.2, ema_decay=0.98, adjust_step=0.05, warmup_steps=100):
+        assert 0 < min_d_ratio <= init_d_ratio <= max_d_ratio, "Receive invalid D:G ratio bounds."
+        self.model = model
+        self.d_ratio = init_d_ratio
+        self.init_d_ratio = init_d_ratio
+        self.min_d_ratio = min_d_ratio
+        self.max_d_ratio = max_d_ratio
+        self.d_loss_low = d_loss_low
+        self.d_loss_high = d_loss_high
+        self.ema_decay = ema_decay
+        self.adjust_step = adjust_step
+        self.warmup_steps = warmup_steps
+
+        self.ema_loss_D = None
+        self.ema_loss_G = None
+        self.d_credit = 0.
+        self.num_D_steps = 0
+        self.num_G_steps = 0
+        self.num_D_skipped = 0
+        self.avg_D_step_time = 0.
+        self.last_errD = (None, None)
+
+    @staticmethod
+    def _mean_loss(errs, idx=0):
+        losses = [err[idx] for err in errs if err is not None]
+        return float(np.mean(losses)) if losses else None
+
+    def _update_ema(self, ema, value):
+        if value is None:
+            return ema
+        if ema is None:
+            return value
+        return self.ema_decay * ema + (1 - self.ema_decay) * value
+
+    def _adjust_ratio(self):
+        if self.num_G_steps < self.warmup_steps or self.ema_loss_D is None:
+            return
+        if self.ema_loss_D < self.d_loss_low:
+            self.d_ratio = max(self.min_d_ratio, self.d_ratio - self.adjust_step)
+        elif self.ema_loss_D > self.d_loss_high:
+            self.d_ratio = min(self.max_d_ratio, self.d_ratio + self.adjust_step)
+
+    def step(self, get_batch_A, get_batch_B):
+        """
+        Run the scheduled D steps (possibly none) followed by one G step.
+
+        Arguments:
+            get_batch_A, get_batch_B: callables returning a new batch of side A/B, e.g. DataLoader.get_next_batch
+
+        Returns:
+            errDA, errDB: outputs of the latest D step (from a previous call if D was skipped)
+            errGA, errGB: outputs of the G step
+        """
+        self.d_credit += self.d_ratio
+        if self.d_credit < 1:
+            self.num_D_skipped += 1
+        while self.d_credit >= 1:
+            t0 = time.time()
+            self.last_errD = self.model.train_one_batch_D(data_A=get_batch_A(), data_B=get_batch_B())
+            dt = time.time() - t0
+            self.avg_D_step_time += (dt - self.avg_D_step_time) / (self.num_D_steps + 1)
+            self.num_D_steps += 1
+            self.d_credit -= 1
+            self.ema_loss_D = self._update_ema(self.ema_loss_D, self._mean_loss(self.last_errD))
+
+        errGA, errGB = self.model.train_one_batch_G(data_A=get_batch_A(), data_B=get_batch_B())
+        self.num_G_steps += 1
+        self.ema_loss_G = self._update_ema(self.ema_loss_G, self._mean_loss([errGA, errGB], idx=1))
+        self._adjust_ratio()
+        errDA, errDB = self.last_errD
+        return errDA, errDB, errGA, errGB
+
+    def get_report(self):
+        """
+        Compute saved (or spent) compared to the initial fixed D:G ratio.
+        """
+        baseline_D_steps = self.init_d_ratio * self.num_G_steps
+        saved_D_steps = baseline_D_steps - self.num_D_steps
+        return {
+            "num_G_steps": self.num_G_steps,
+            "num_D_steps": self.num_D_steps,
+            "num_D_skipped": self.num_D_skipped,
+            "d_ratio": self.d_ratio,
+            "ema_loss_D": self.ema_loss_D,
+            "ema_loss_G": self.ema_loss_G,
+            "saved_D_steps": saved_D_steps,
+            "saved_seconds": saved_D_steps * self.avg_D_step_time,
+        }
+
+    def show_report(self):
+        report = self.get_report()
+        print(f"[D:G scheduler] G steps: {report['num_G_steps']} D steps: {report['num_D_steps']} "
+              f"(skipped {report['num_D_skipped']}) current D:G ratio: {report['d_ratio']:.2f}")
+        print(f"[D:G scheduler] saved {report['saved_D_steps']:.0f} D steps, "
+              f"about {report['saved_seconds']:.1f} seconds of compute.")